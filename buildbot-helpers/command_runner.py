@@ -82,8 +82,8 @@ class CommandRunner(object):
             job.log.write("\nFailed with OSError; requeuing in %i seconds\n" %
                           self.retry_time)
             # Wait to requeue it
-            # If we die, then it's still in cur, and will be moved back into
-            # 'new' eventually
+            # The schedule is kept on disk, so it will be moved back into
+            # 'new' even if we die
             self.q.requeue(job.item_id, self.retry_time, self.max_retries)
 
     def monitor(self):
@@ -169,23 +169,25 @@ class PulsePusher(object):
             come_back_soon = False
             try:
                 while True:
-                    item = self.queuedir.pop()
-                    if not item:
-                        break
                     if len(events) > 50:
                         come_back_soon = True
                         break
+                    items = self.queuedir.pop_many(10)
+                    if not items:
+                        break
 
+                    item_ids.extend(item_id for item_id, fp in items)
                     try:
-                        item_id, fp = item
-                        item_ids.append(item_id)
-                        log.debug("Loading %s", item)
-                        events.extend(json.load(fp))
-                    except:
-                        log.exception("Error loading %s", item_id)
-                        raise
+                        for item_id, fp in items:
+                            try:
+                                log.debug("Loading %s", item_id)
+                                events.extend(json.load(fp))
+                            except:
+                                log.exception("Error loading %s", item_id)
+                                raise
                     finally:
-                        fp.close()
+                        for item_id, fp in items:
+                            fp.close()
                 log.info("Loaded %i events", len(events))
                 self.send(events)
                 for item_id in item_ids:
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import sqlalchemy as sa
+import os
 import time
 import json
+import threading
 
 import logging
 log = logging.getLogger(__name__)
@@ -41,55 +43,278 @@ def query_to_str(statement, bind=None):
     return compiler.process(statement)
 
 
-def cleaner_upper(select_query, delete_queries):
+class Checkpoint(object):
     """
-    Cleans stuff up.
+    Remembers how far each cleanup has got, in a JSON file, so that an
+    interrupted run can pick up where it left off.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.positions = {}
+        if os.path.exists(filename):
+            self.positions = json.load(open(filename))
+
+    def get(self, name):
+        return self.positions.get(name)
+
+    def set(self, name, position):
+        self.lock.acquire()
+        try:
+            self.positions[name] = position
+            tmp = self.filename + ".tmp"
+            json.dump(self.positions, open(tmp, "w"))
+            os.rename(tmp, self.filename)
+        finally:
+            self.lock.release()
+
+
+# How many ids to put in one IN (...) clause
+IN_CHUNK_SIZE = 500
+# How many ids to delete in one transaction
+DELETE_CHUNK_SIZE = 100
 
-    Runs select query, which should return a list of ids to delete.
-    Chunks of ids are passed to each query of delete_queries.
 
-    delete queries should be functions that accept a list of ids to delete.
+def chunks(items, size=IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Throttle(object):
+    """
+    Decides how wide a range of ids each batch covers, and how long to wait
+    between batches.
+
+    The width is doubled while batches take less than half of `target_time`,
+    and halved when they take longer than it.  It's also narrowed whenever a
+    batch finds more than `max_ids` ids, so that a dense range after a run
+    of sparse ones doesn't send a huge batch.  Before each batch, we wait
+    until none of `replicas` is more than `max_lag` seconds behind; with no
+    replicas, we sleep for `sleep_factor` times as long as the last batch
+    took instead.
+    """
+    min_width = 100
+    max_width = 1000000
+    max_ids = 10000
+    # How often to ask the replicas how far behind they are
+    lag_interval = 1.0
+
+    def __init__(self, target_time=1.0, width=1000, replicas=None,
+                 max_lag=30, sleep_factor=4.0):
+        self.target_time = target_time
+        self.width = width
+        self.replicas = replicas or []
+        self.max_lag = max_lag
+        self.sleep_factor = sleep_factor
+        self.lock = threading.Lock()
+        self.lag = 0
+        self.lag_checked = 0
+
+    def batch_done(self, elapsed, found=0):
+        """Records that a batch took `elapsed` seconds, and found `found`
+        ids"""
+        self.lock.acquire()
+        try:
+            if found > self.max_ids:
+                self.width = max(self.min_width,
+                                 self.width * self.max_ids / found)
+            elif elapsed < self.target_time / 2:
+                self.width = min(self.max_width, self.width * 2)
+            elif elapsed > self.target_time:
+                self.width = max(self.min_width, self.width / 2)
+        finally:
+            self.lock.release()
+
+    def replication_lag(self):
+        """Returns how many seconds the furthest behind replica is behind
+        its master"""
+        self.lock.acquire()
+        try:
+            if time.time() - self.lag_checked > self.lag_interval:
+                lag = 0
+                for replica in self.replicas:
+                    row = replica.execute("SHOW SLAVE STATUS").fetchone()
+                    if row is None:
+                        continue
+                    if row['Seconds_Behind_Master'] is None:
+                        # replication isn't running; don't make it worse
+                        lag = max(lag, self.max_lag + 1)
+                    else:
+                        lag = max(lag, row['Seconds_Behind_Master'])
+                self.lag = lag
+                self.lag_checked = time.time()
+            return self.lag
+        finally:
+            self.lock.release()
+
+    def wait(self, elapsed):
+        """Waits before the next batch; the last one took `elapsed`
+        seconds"""
+        if not self.replicas:
+            sleep_time = elapsed * self.sleep_factor
+            log.debug("sleeping for %.2fs", sleep_time)
+            time.sleep(sleep_time)
+            return
+        while True:
+            lag = self.replication_lag()
+            if lag <= self.max_lag:
+                break
+            log.info("replication lag is %is; waiting", lag)
+            time.sleep(self.lag_interval)
+
+
+def count_ids(db, ids, delete_columns):
+    """
+    Returns how many rows delete_ids would delete for each of delete_columns
+    """
+    counts = []
+    for column in delete_columns:
+        n = 0
+        for chunk in chunks(ids, DELETE_CHUNK_SIZE):
+            q = sa.select([sa.func.count()], column.in_(chunk))
+            n += db.execute(q).fetchone()[0]
+        counts.append(n)
+    return counts
 
-    Returns once select_query no longer returns any results
 
-    Sleeps between rounds
+def delete_ids(db, ids, delete_columns, chunk_size=DELETE_CHUNK_SIZE):
     """
-    while True:
-        t = time.time()
-        log.debug("finding rows: %s", query_to_str(select_query))
-        rows = select_query.execute()
-        log.info("found %i rows in %.2fs", rows.rowcount, time.time() - t)
-        if rows.rowcount == 0:
-            break
-
-        # Delete 100 at a time
-        ids = [row[0] for row in rows]
-        chunk_size = 100
-        for i in range(0, len(ids), chunk_size):
-            for q in delete_queries:
-                t = time.time()
-                q(ids[i:i + chunk_size])
-                sleep_time = max(0.1, (time.time() - t) * 4.0)
-                log.debug("sleeping for %.2fs", sleep_time)
-                time.sleep(sleep_time)
-
-
-def deleter(column):
+    Deletes the rows whose delete_columns match ids, in the order given,
+    `chunk_size` ids at a time.  Each chunk is deleted from all of the
+    tables in one transaction.
     """
-    Returns a function that accepts a list of ids, and deletes
-    rows that match.
+    conn = db.connect()
+    try:
+        for chunk in chunks(ids, chunk_size):
+            trans = conn.begin()
+            try:
+                for column in delete_columns:
+                    q = column.table.delete().where(column.in_(chunk))
+                    log.debug(query_to_str(q))
+                    n = conn.execute(q).rowcount
+                    log.debug("deleted %i rows from %s", n,
+                              column.table.name)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+    finally:
+        conn.close()
+
+
+def range_cleaner(name, range_column, select_query, delete_columns,
+                  throttle=None, checkpoint=None, jobs=1, bounds=None,
+                  dry_run=False):
     """
-    def delete_func(ids):
-        t = time.time()
-        q = column.table.delete().where(column.in_(ids))
-        log.debug(query_to_str(q))
-        n = q.execute().rowcount
-        log.info("deleted %i rows from %s in %.2fs", n, column.table.name,
-                 time.time() - t)
-    return delete_func
+    Cleans stuff up, one range of range_column values at a time.
+
+    select_query should select the ids to delete; for each range it's
+    narrowed to rows where range_column is in the range, so range_column
+    should be a primary key (or at least indexed).  The ids found are passed
+    to delete_ids with delete_columns, so list dependent tables first.
 
+    bounds is a query returning the lowest and highest values of
+    range_column worth looking at; by default, those in its table.  If
+    checkpoint (a Checkpoint) is given, we start from wherever the last
+    cleanup called `name` got to, if it was interrupted.  Up to `jobs`
+    ranges are cleaned at once.
 
-def cleanup_statusdb_builds(meta, cutoff):
+    With dry_run, nothing is deleted (and the checkpoint is left alone);
+    instead we log how many rows would have been deleted from each table.
+    """
+    if throttle is None:
+        throttle = Throttle()
+    db = range_column.table.bind
+    if bounds is None:
+        bounds = sa.select([sa.func.min(range_column),
+                            sa.func.max(range_column)])
+    low, high = bounds.execute().fetchone()
+    if low is None:
+        log.info("%s: nothing to do", name)
+        return
+    if checkpoint and checkpoint.get(name) is not None:
+        low = max(low, checkpoint.get(name))
+    log.info("%s: cleaning up %s from %s to %s", name, range_column, low,
+             high)
+
+    lock = threading.Lock()
+    # The next range to clean up starts at state['next']; in_flight holds
+    # the start of each range being cleaned up now
+    state = {'next': low, 'deleted': 0, 'error': None,
+             'counts': [0] * len(delete_columns)}
+    in_flight = set()
+
+    def worker():
+        elapsed = 0
+        while True:
+            throttle.wait(elapsed)
+            lock.acquire()
+            try:
+                if state['error'] or state['next'] > high:
+                    return
+                start = state['next']
+                end = start + throttle.width
+                state['next'] = end
+                in_flight.add(start)
+            finally:
+                lock.release()
+
+            t = time.time()
+            try:
+                q = select_query.where(range_column >= start).\
+                    where(range_column < end)
+                ids = [row[0] for row in q.execute()]
+                counts = None
+                if ids and dry_run:
+                    counts = count_ids(db, ids, delete_columns)
+                elif ids:
+                    delete_ids(db, ids, delete_columns)
+            except Exception, e:
+                log.exception("%s: failed to clean up %s to %s", name,
+                              start, end)
+                state['error'] = e
+                return
+            elapsed = time.time() - t
+            throttle.batch_done(elapsed, len(ids))
+
+            lock.acquire()
+            try:
+                state['deleted'] += len(ids)
+                if counts:
+                    state['counts'] = [a + b for a, b in
+                                       zip(state['counts'], counts)]
+                in_flight.remove(start)
+                # Everything before the earliest range still being worked
+                # on is done
+                if checkpoint and not dry_run:
+                    checkpoint.set(name, min(in_flight or [state['next']]))
+            finally:
+                lock.release()
+            log.info("%s: deleted %i ids from %s to %s in %.2fs", name,
+                     len(ids), start, end, elapsed)
+
+    if jobs == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for i in range(jobs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    if state['error']:
+        raise state['error']
+    if dry_run:
+        for column, count in zip(delete_columns, state['counts']):
+            log.info("%s: would delete %i rows from %s", name, count,
+                     column.table.name)
+        return
+    if checkpoint:
+        # The next run starts from scratch
+        checkpoint.set(name, None)
+    log.info("%s: deleted %i ids", name, state['deleted'])
+
+
+def cleanup_statusdb_builds(meta, cutoff, **kwargs):
     log.info("Cleaning up builds before %s", cutoff)
     t_builds = sa.Table('builds', meta, autoload=True)
     t_steps = sa.Table('steps', meta, autoload=True)
@@ -98,20 +323,21 @@ def cleanup_statusdb_builds(meta, cutoff):
                                       autoload=True)
 
     builds_q = sa.select([t_builds.c.id]).\
-        where(t_builds.c.starttime < cutoff).\
-        order_by(t_builds.c.starttime.asc()).\
-        limit(10000)
-
-    cleaner_upper(builds_q, [
-        deleter(t_steps.c.build_id),
-        deleter(t_properties.c.build_id),
-        deleter(t_schedulerdb_requests.c.status_build_id),
-        deleter(t_builds.c.id),
-    ])
+        where(t_builds.c.starttime < cutoff)
+    bounds = sa.select([sa.func.min(t_builds.c.id),
+                        sa.func.max(t_builds.c.id)]).\
+        where(t_builds.c.starttime < cutoff)
+
+    range_cleaner("builds before %s" % cutoff, t_builds.c.id, builds_q, [
+        t_steps.c.build_id,
+        t_properties.c.build_id,
+        t_schedulerdb_requests.c.status_build_id,
+        t_builds.c.id,
+    ], bounds=bounds, **kwargs)
     log.info("Finished cleaning up builds")
 
 
-def cleanup_statusdb_orphaned_steps(meta):
+def cleanup_statusdb_orphaned_steps(meta, **kwargs):
     log.info("Cleaning up orphaned steps")
     t_builds = sa.Table('builds', meta, autoload=True)
     t_steps = sa.Table('steps', meta, autoload=True)
@@ -123,15 +349,15 @@ def cleanup_statusdb_orphaned_steps(meta):
         from_obj=[t_steps.outerjoin(t_builds, t_steps.c.build_id ==
                                     t_builds.c.id)],
         distinct=True,
-    ).limit(10000)
+    )
 
-    cleaner_upper(q, [
-        deleter(t_steps.c.build_id),
-    ])
+    range_cleaner("orphaned_steps", t_steps.c.id, q, [
+        t_steps.c.build_id,
+    ], **kwargs)
     log.info("Finished cleaning up orphaned steps")
 
 
-def cleanup_statusdb_orphaned_properties(meta):
+def cleanup_statusdb_orphaned_properties(meta, **kwargs):
     log.info("Cleaning up orphaned build properties")
     t_builds = sa.Table('builds', meta, autoload=True)
     t_properties = sa.Table('build_properties', meta, autoload=True)
@@ -143,11 +369,11 @@ def cleanup_statusdb_orphaned_properties(meta):
         from_obj=[t_properties.outerjoin(t_builds, t_properties.c.build_id ==
                                          t_builds.c.id)],
         distinct=True,
-    ).limit(10000)
+    )
 
-    cleaner_upper(q, [
-        deleter(t_properties.c.build_id),
-    ])
+    range_cleaner("orphaned_properties", t_properties.c.id, q, [
+        t_properties.c.build_id,
+    ], **kwargs)
     log.info("Finished cleaning up orphaned build properties")
 
 
@@ -172,67 +398,94 @@ PERBUILD_CLASSES = (
     "buildbotcustom.scheduler.Scheduler-props",
     "buildbotcustom.scheduler.BuilderChooserScheduler-props")
 
-_change_cache = {}
-
+t_changes = sa.sql.table('changes', sa.sql.column('changeid'),
+                         sa.sql.column('when_timestamp'))
+t_schedulers = sa.sql.table('schedulers', sa.sql.column('schedulerid'))
 
-def get_change_date(db, changeid):
-    if changeid in _change_cache:
-        return _change_cache[changeid]
 
-    q = sa.text("SELECT when_timestamp FROM changes WHERE changeid=:changeid")
-    results = db.execute(q, changeid=changeid)
-    row = results.fetchone()
-    if row:
-        _change_cache[changeid] = row.when_timestamp
-        return row.when_timestamp
-    else:
-        _change_cache[changeid] = None
-        return None
+def get_change_dates(db, changeids):
+    """
+    Returns a dict mapping each of changeids that exists to its
+    when_timestamp, looking them up IN_CHUNK_SIZE at a time
+    """
+    dates = {}
+    for chunk in chunks(sorted(set(changeids))):
+        q = sa.select([t_changes.c.changeid, t_changes.c.when_timestamp]).\
+            where(t_changes.c.changeid.in_(chunk))
+        for row in db.execute(q):
+            dates[row.changeid] = row.when_timestamp
+    return dates
 
 
-def should_delete(db, s, cutoff):
-    state = json.loads(s.state)
+def should_delete(s, state, change_dates, cutoff):
     if s.class_name in IGNORABLE_CLASSES:
         # Not sure if we have enough data here to make a decision...
         return False
     elif s.class_name in PERBUILD_CLASSES:
         assert "last_processed" in state
-        change_time = get_change_date(db, state['last_processed'])
-        if change_time < cutoff:
-            return True
+        change_time = change_dates.get(state['last_processed'])
+        # Schedulers whose last change is gone are old enough too
+        return change_time is None or change_time < cutoff
     else:
         log.warning("unhandled scheduler class for scheduler %s: %s %s",
                     s.schedulerid, s.class_name, s.name)
         return False
 
 
-def cleanup_schedulerdb_schedulers(db):
+def cleanup_schedulerdb_schedulers(db, dry_run=False):
     now = time.time()
     regular_cutoff = now - 7 * 86400  # 1 week
     release_cutoff = now - 60 * 86400  # 2 months
 
-    # Get all the schedulers from the db
+    # Get all the schedulers from the db, and the last change each of the
+    # per-build ones has processed
     q = sa.text("SELECT * FROM schedulers")
-    schedulers = db.execute(q)
+    schedulers = []
+    for s in db.execute(q):
+        try:
+            if s.class_name in PERBUILD_CLASSES:
+                state = json.loads(s.state)
+            else:
+                state = None
+            schedulers.append((s, state))
+        except Exception:
+            log.exception("couldn't process scheduler %s: %s", s.schedulerid,
+                          s.name)
+    changeids = [state['last_processed'] for s, state in schedulers
+                 if state and 'last_processed' in state]
+    change_dates = get_change_dates(db, changeids)
+    log.info("found %i schedulers; looked up %i of their changes, of which "
+             "%i exist", len(schedulers), len(set(changeids)),
+             len(change_dates))
+
     to_delete = []
-    for s in schedulers:
+    for s, state in schedulers:
         if s.name.startswith("release-"):
             cutoff = release_cutoff
         else:
             cutoff = regular_cutoff
 
         try:
-            if should_delete(db, s, cutoff):
+            if should_delete(s, state, change_dates, cutoff):
                 to_delete.append(s)
         except Exception:
             log.exception("couldn't process scheduler %s: %s", s.schedulerid,
                           s.name)
 
     for s in to_delete:
-        log.info("deleting scheduler %s: %s %s %s", s.schedulerid,
+        log.info("%s scheduler %s: %s %s %s",
+                 "would delete" if dry_run else "deleting", s.schedulerid,
                  s.class_name, s.name, s.state)
-        q = sa.text("DELETE FROM schedulers WHERE schedulerid=:schedulerid")
-        db.execute(q, schedulerid=s.schedulerid)
+    if dry_run:
+        log.info("would delete %i schedulers", len(to_delete))
+        return
+
+    deleted = 0
+    for chunk in chunks([s.schedulerid for s in to_delete]):
+        q = t_schedulers.delete().\
+            where(t_schedulers.c.schedulerid.in_(chunk))
+        deleted += db.execute(q).rowcount
+    log.info("deleted %i schedulers", deleted)
 
 
 if __name__ == '__main__':
@@ -243,6 +496,12 @@ if __name__ == '__main__':
         loglevel=logging.INFO,
         logfile=None,
         skip_orphans=False,
+        checkpoint=None,
+        replicas=[],
+        max_lag=30,
+        batch_time=1.0,
+        jobs=1,
+        dry_run=False,
     )
     parser.add_option("-l", "--logfile", dest="logfile")
     parser.add_option("--status-db", dest="status_db")
@@ -252,6 +511,23 @@ if __name__ == '__main__':
                       "format is YYYY-MM-DD")
     parser.add_option("--skip-orphans", dest="skip_orphans",
                       action="store_true")
+    parser.add_option("--checkpoint", dest="checkpoint",
+                      help="file to record progress in, so that an "
+                      "interrupted cleanup can be resumed")
+    parser.add_option("--replica", dest="replicas", action="append",
+                      help="status db replica to watch the replication lag "
+                      "of; may be given more than once")
+    parser.add_option("--max-lag", dest="max_lag", type="int",
+                      help="pause while a replica is more than this many "
+                      "seconds behind (default 30)")
+    parser.add_option("--batch-time", dest="batch_time", type="float",
+                      help="aim for batches taking this many seconds "
+                      "(default 1)")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="number of batches to delete at once (default 1)")
+    parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true",
+                      help="don't delete anything; report how many rows "
+                      "each step would delete")
     parser.add_option("-v", "--verbose", dest="loglevel", action="store_const",
                       const=logging.DEBUG, help="run verbosely")
     parser.add_option("-q", "--quiet", dest="loglevel", action="store_const",
@@ -281,12 +557,22 @@ if __name__ == '__main__':
     if options.status_db:
         status_db = sa.create_engine(options.status_db)
         meta = sa.MetaData(bind=status_db)
-        cleanup_statusdb_builds(meta, options.cutoff)
+        kwargs = dict(
+            throttle=Throttle(
+                target_time=options.batch_time,
+                replicas=[sa.create_engine(r) for r in options.replicas],
+                max_lag=options.max_lag),
+            jobs=options.jobs,
+            dry_run=options.dry_run,
+        )
+        if options.checkpoint:
+            kwargs['checkpoint'] = Checkpoint(options.checkpoint)
+        cleanup_statusdb_builds(meta, options.cutoff, **kwargs)
         if not options.skip_orphans:
-            cleanup_statusdb_orphaned_steps(meta)
-            cleanup_statusdb_orphaned_properties(meta)
+            cleanup_statusdb_orphaned_steps(meta, **kwargs)
+            cleanup_statusdb_orphaned_properties(meta, **kwargs)
 
     if options.scheduler_db:
         scheduler_db = sa.create_engine(options.scheduler_db)
 
-        cleanup_schedulerdb_schedulers(scheduler_db)
+        cleanup_schedulerdb_schedulers(scheduler_db, dry_run=options.dry_run)
@@ -3,6 +3,7 @@ import os
 import re
 import math
 import time
+import sqlite3
 
 
 def format_hist(h, units=1):
@@ -26,32 +27,124 @@ def format_hist(h, units=1):
     return "\n".join(retval)
 
 
-def scan_builder(builder, starttime, endtime, minutes_per_block, times, change_as_submittime=True):
-    """Scans the build pickle files in the builder directory, and updates the dictionary `times`."""
-    if not os.path.exists(builder):
-        return
-    for f in os.listdir(builder):
-        if re.match("^\d+$", f):
-            try:
-                b = cPickle.load(open('%s/%s' % (builder, f)))
-            except:
-                continue
+def parse_build(path):
+    """Returns (change time, request time, start time, reason) for the build
+    pickled in `path`, or None if it can't be loaded. The change and
+    request times are None if the build has no changes or requests."""
+    try:
+        b = cPickle.load(open(path))
+        change_time = request_time = None
+        if b.changes:
+            change_time = b.changes[0].when
+        if b.requests:
+            request_time = b.requests[0].submittedAt
+        return change_time, request_time, b.started, b.reason
+    except:
+        return None
+
+
+class BuildIndex(object):
+    """An sqlite index of when the builds in builder directories were
+    submitted and started, so that reports don't have to unpickle every
+    build every time.
 
-            if 'rebuild' in b.reason:
-                # Skip rebuilds, they mess up the wait times
-                continue
+    update() brings a builder's entries up to date; only builds whose
+    pickles are new, or have been modified since, are loaded."""
 
-            if change_as_submittime:
-                if len(b.changes) == 0:
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS builds (
+                builder TEXT,
+                buildnumber INTEGER,
+                mtime REAL,
+                change_time REAL,
+                request_time REAL,
+                started REAL,
+                reason TEXT,
+                PRIMARY KEY (builder, buildnumber)
+            );
+            CREATE INDEX IF NOT EXISTS builds_change_time
+                ON builds (builder, change_time);
+            CREATE INDEX IF NOT EXISTS builds_request_time
+                ON builds (builder, request_time);
+        """)
+
+    def update(self, builder, jobs=1):
+        """Re-reads the builds in the `builder` directory that have changed
+        since the last update, `jobs` at a time (one per CPU if `jobs` is 0
+        or None)."""
+        indexed = dict(self.db.execute(
+            "SELECT buildnumber, mtime FROM builds WHERE builder = ?",
+            (builder,)))
+        todo = []
+        if os.path.exists(builder):
+            for f in os.listdir(builder):
+                if not re.match("^\d+$", f):
                     continue
-                submittime = b.changes[0].when
-            else:
-                submittime = b.requests[0].submittedAt
+                buildnumber = int(f)
+                mtime = os.path.getmtime(os.path.join(builder, f))
+                if indexed.pop(buildnumber, None) != mtime:
+                    todo.append((buildnumber, mtime))
+        # Whatever is left has been deleted
+        self.db.executemany(
+            "DELETE FROM builds WHERE builder = ? AND buildnumber = ?",
+            [(builder, buildnumber) for buildnumber in indexed])
+
+        paths = [os.path.join(builder, str(n)) for n, mtime in todo]
+        if jobs == 1 or len(paths) < 2:
+            builds = map(parse_build, paths)
+        else:
+            # multiprocessing is only needed, and only available from python
+            # 2.6, for parallel jobs
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs or None)
+            try:
+                builds = pool.map(parse_build, paths, chunksize=100)
+            finally:
+                pool.close()
+                pool.join()
+
+        rows = []
+        for (buildnumber, mtime), build in zip(todo, builds):
+            # Builds that can't be loaded are still recorded, so that we
+            # don't try them again until they change
+            rows.append((builder, buildnumber, mtime) +
+                        (build or (None, None, None, None)))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def wait_times(self, builder, starttime, endtime,
+                   change_as_submittime=True):
+        """Yields (submit time, start time, reason) for builds of `builder`
+        submitted between starttime and endtime"""
+        if change_as_submittime:
+            column = "change_time"
+        else:
+            column = "request_time"
+        q = "SELECT %s, started, reason FROM builds " \
+            "WHERE builder = ? AND %s > ? AND %s < ?" % (column, column,
+                                                          column)
+        return self.db.execute(q, (builder, starttime, endtime))
+
+
+def scan_builder(builder, starttime, endtime, minutes_per_block, times, change_as_submittime=True, index=None, jobs=1):
+    """Scans the builds in the builder directory, and updates the dictionary
+    `times`. The builds are looked up in `index` (a BuildIndex), which is
+    brought up to date first; without one, every build is loaded."""
+    if index is None:
+        index = BuildIndex(":memory:")
+    index.update(builder, jobs)
+    for submittime, started, reason in index.wait_times(
+            builder, starttime, endtime, change_as_submittime):
+        if reason and 'rebuild' in reason:
+            # Skip rebuilds, they mess up the wait times
+            continue
 
-            if starttime < submittime < endtime:
-                w = int(math.floor(
-                    (b.started - submittime) / (minutes_per_block * 60.0)))
-                times[w] = times.get(w, 0) + 1
+        w = int(math.floor(
+            (started - submittime) / (minutes_per_block * 60.0)))
+        times[w] = times.get(w, 0) + 1
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -64,6 +157,8 @@ if __name__ == "__main__":
         directory=None,
         starttime=time.time() - 24 * 3600,
         endtime=time.time(),
+        index=".print_waits.sqlite",
+        jobs=1,
     )
 
     def add_builder(option, opt_str, value, parser, *args, **kwargs):
@@ -90,6 +185,12 @@ if __name__ == "__main__":
     parser.add_option("-a", "--address", dest="addresses", action="append")
     parser.add_option("-S", "--smtp", dest="smtp")
     parser.add_option("-f", "--from", dest="sender")
+    parser.add_option("-i", "--index", dest="index",
+                      help="index of build times to keep, relative to the "
+                      "builders' directory (default .print_waits.sqlite)")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="number of processes to read builds missing from "
+                      "the index with; 0 for one per CPU (default 1)")
 
     options, args = parser.parse_args()
 
@@ -103,13 +204,14 @@ if __name__ == "__main__":
     text.append("Wait time report for %s for jobs submitted since %s\n"
                 % (options.name, time.ctime(options.starttime)))
 
+    index = BuildIndex(options.index)
     hist = {}
     for platform, builders in options.builders.items():
         hist[platform] = {}
         for builder in builders:
             scan_builder(builder, options.starttime, options.endtime,
                          options.minutes_per_block, hist[platform],
-                         options.change_as_submittime)
+                         options.change_as_submittime, index, options.jobs)
 
     allhist = {}
     for i in set([x for y in hist.keys() for x in hist[y]]):
@@ -15,15 +15,31 @@ are provided, subdirectories within those dirs will also be purged. This will
 obviously only increase the available space if the other base_dirs are on the
 same mountpoint, but this can be useful for, e.g., cleaning up scratchbox.
 
+The sizes and mtimes of directories are kept in an index file (by default
+~/.purge_builds.index), so a directory's size is only measured again once it
+has changed.  The directories to delete are picked up front from the index,
+and the predicted and actually reclaimed space are reported.
+
+With --deferred, directories are only renamed to *.deleteme, which is quick,
+and a background process deletes them afterwards.  Space that is waiting to be
+freed this way counts towards the required free space.
+
 example:
     python %prog -s 6 /builds/moz2_slave /scratchbox/users/cltbld/home/cltbld/build
 """
 
 import os
+import stat
+import errno
 import shutil
+import time
 import sys
 from fnmatch import fnmatch
 import re
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 DEFAULT_BASE_DIRS = [".."]
 
@@ -117,6 +133,265 @@ def rmdirRecursive(dir):
     os.rmdir(dir)
 
 
+# clobberer/clobberer.py has copies of fast_rmtree and of Reaper's forking
+# code.  Both scripts are run on their own, without lib/python, so keep the
+# copies in sync.
+def fast_rmtree(dir):
+    """Delete dir and everything under it, like rmdirRecursive, but
+    without the extra stat and chmod calls for every file.  Permissions are
+    only fixed up when a removal fails, and things that have already gone
+    (e.g., deleted by another reaper) are ignored."""
+    def ignore_missing(func, path):
+        try:
+            func(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def fix_perms(func, path):
+        try:
+            ignore_missing(func, path)
+        except OSError, e:
+            if e.errno not in (errno.EACCES, errno.EPERM):
+                raise
+            os.chmod(os.path.dirname(path), 0700)
+            if not os.path.islink(path):
+                os.chmod(path, 0700)
+            ignore_missing(func, path)
+
+    try:
+        st = os.lstat(dir)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISDIR(st.st_mode):
+        fix_perms(os.remove, dir)
+        return
+
+    # depth-first, without recursion; each directory is removed once the
+    # loop gets back to it with its contents gone
+    stack = [(dir, False)]
+    while stack:
+        d, emptied = stack.pop()
+        if emptied:
+            fix_perms(os.rmdir, d)
+            continue
+        try:
+            names = os.listdir(d)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                continue
+            if e.errno not in (errno.EACCES, errno.EPERM):
+                raise
+            os.chmod(d, 0700)
+            names = os.listdir(d)
+        stack.append((d, True))
+        for name in names:
+            full_name = os.path.join(d, name)
+            try:
+                st = os.lstat(full_name)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            if stat.S_ISDIR(st.st_mode):
+                stack.append((full_name, False))
+            else:
+                fix_perms(os.remove, full_name)
+
+
+def dir_size(dir):
+    "Returns the number of bytes of disk used under directory `dir`"
+    total = 0
+    # files hardlinked within dir (e.g., in hg shares) only count once
+    seen = set()
+    for root, dirs, files in os.walk(dir):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+    return total
+
+
+class Reaper(object):
+    """Collects renamed directories, and deletes them in a background
+    process with L{start}.  C{pending} is the number of bytes that will be
+    freed when it's done."""
+
+    def __init__(self):
+        self.paths = []
+        self.sizes = {}
+        self.pending = 0
+
+    def add(self, path, size=None):
+        """Add path to the directories to delete.  `size` is how much space
+        it's expected to free; if it's not given, it's measured."""
+        path = os.path.abspath(path)
+        for p in self.paths:
+            if path == p or path.startswith(p + os.sep):
+                # already going
+                return
+        # anything under path that was added before is covered by path now
+        for p in [p for p in self.paths if p.startswith(path + os.sep)]:
+            self.paths.remove(p)
+            self.pending -= self.sizes.pop(p)
+        if size is None:
+            size = dir_size(path)
+        self.sizes[path] = size
+        self.pending += self.sizes[path]
+        self.paths.append(path)
+
+    def start(self):
+        """Delete the collected directories in a detached, low-priority
+        process.  Where that's not possible, they're deleted right away."""
+        paths, self.paths = self.paths, []
+        self.sizes = {}
+        self.pending = 0
+        if not paths:
+            return
+        if os.name == 'nt' or not hasattr(os, 'fork'):
+            for path in paths:
+                rmdirRecursive(path)
+            return
+
+        pid = os.fork()
+        if pid:
+            # wait for the intermediate child, which exits straight away
+            os.waitpid(pid, 0)
+            return
+
+        # in the intermediate child: detach from our session, so that
+        # buildbot doesn't kill the reaper or wait for it when the step ends
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.nice(19)
+            for path in paths:
+                try:
+                    fast_rmtree(path)
+                except OSError:
+                    pass
+        finally:
+            os._exit(0)
+
+
+class DiskIndex(object):
+    """A record of the mtimes and sizes of directories, and of the layout of
+    hg share directories, kept in `filename` between runs.
+
+    A directory's size is only measured again when its mtime has changed, or
+    when the measurement is more than `max_age` seconds old, since changes
+    deep inside a directory don't always change its mtime.  Sizes are
+    therefore predictions, and callers should check the space actually
+    freed."""
+
+    max_age = 24 * 3600
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # path -> [mtime, size or None, time size was measured]
+        self.dirs = {}
+        # directory -> [mtime, subdirectory names], see find_hg_dirs
+        self.walks = {}
+        # paths used in this run; anything else is dropped on save
+        self.seen = set()
+        if filename and os.path.exists(filename):
+            try:
+                data = json.load(open(filename))
+                self.dirs = data['dirs']
+                self.walks = data['walks']
+            except (ValueError, KeyError, IOError):
+                print >>sys.stderr, "Ignoring unreadable index %s" % filename
+
+    def save(self):
+        if not self.filename:
+            return
+        data = dict(
+            dirs=dict((p, e) for p, e in self.dirs.iteritems()
+                      if p in self.seen),
+            walks=dict((p, e) for p, e in self.walks.iteritems()
+                       if p in self.seen))
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'w')
+        json.dump(data, f)
+        f.close()
+        os.rename(tmp, self.filename)
+
+    def mtime(self, path):
+        """Returns the mtime of directory `path`, or None if it isn't a
+        directory"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode):
+            return None
+        path = os.path.abspath(path)
+        self.seen.add(path)
+        entry = self.dirs.get(path)
+        if not entry or entry[0] != st.st_mtime:
+            self.dirs[path] = [st.st_mtime, None, None]
+        return st.st_mtime
+
+    def size(self, path):
+        "Returns the predicted number of bytes freed by deleting `path`"
+        path = os.path.abspath(path)
+        self.seen.add(path)
+        entry = self.dirs.get(path)
+        if not entry:
+            self.mtime(path)
+            entry = self.dirs.get(path, [None, None, None])
+        if entry[1] is None or time.time() - entry[2] > self.max_age:
+            entry[1:] = [dir_size(path), time.time()]
+        return entry[1]
+
+    def forget(self, path):
+        self.dirs.pop(os.path.abspath(path), None)
+
+    def find_hg_dirs(self, share_dir):
+        """Returns the hg repositories under share_dir, like an os.walk
+        that stops at repositories, but only listing directories whose mtime
+        has changed since the last run"""
+        hg_dirs = []
+        stack = [share_dir]
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = os.stat(d).st_mtime
+            except OSError:
+                continue
+            key = os.path.abspath(d)
+            self.seen.add(key)
+            entry = self.walks.get(key)
+            if entry and entry[0] == mtime:
+                subdirs = entry[1]
+            else:
+                subdirs = [n for n in os.listdir(d)
+                           if os.path.isdir(os.path.join(d, n)) and
+                           not os.path.islink(os.path.join(d, n))]
+                self.walks[key] = [mtime, subdirs]
+            for name in subdirs:
+                p = os.path.join(d, name)
+                path = os.path.join(p, '.hg')
+                if os.path.exists(path) or \
+                        os.path.exists(path + clobber_suffix):
+                    hg_dirs.append(p)
+                else:
+                    stack.append(p)
+        return hg_dirs
+
+
 def str2seconds(s):
     """ Accepts time intervals resembling:
          30d  (30 days)
@@ -133,7 +408,38 @@ def str2seconds(s):
         raise ValueError("Unhandled time format '%s'" % s)
 
 
-def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
+def delete_dir(d, reaper=None, size=None):
+    """Delete directory d, by way of d.deleteme.  If `reaper` is given, d is
+    renamed and added to it, expecting to free `size` bytes."""
+    try:
+        clobber_path = d + clobber_suffix
+        if reaper:
+            # Prevent repeated moving.
+            if d.endswith(clobber_suffix):
+                reaper.add(d, size)
+            else:
+                if os.path.exists(clobber_path):
+                    # an earlier reaper hasn't finished with it yet
+                    reaper.add(clobber_path)
+                    clobber_path = "%s.%d%s" % (d, time.time(),
+                                                clobber_suffix)
+                os.rename(d, clobber_path)
+                reaper.add(clobber_path, size)
+            return
+        if os.path.exists(clobber_path):
+            rmdirRecursive(clobber_path)
+        # Prevent repeated moving.
+        if d.endswith(clobber_suffix):
+            rmdirRecursive(d)
+        else:
+            shutil.move(d, clobber_path)
+            rmdirRecursive(clobber_path)
+    except:
+        print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+
+
+def purge(base_dirs, gigs, ignore, max_age, dry_run=False, reaper=None,
+          index=None):
     """Delete directories under `base_dirs` until `gigs` GB are free.
 
     Delete any directories older than max_age.
@@ -144,8 +450,16 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
       rel-*:40d
 
     Will not delete rel-* directories until they are over 40 days old.
+
+    If `reaper` is given, directories are renamed and added to it rather
+    than deleted, and the space it will free counts as free.
+
+    Directory sizes come from `index`, a DiskIndex, which is used to pick
+    all of the directories to delete before deleting any.
     """
     gigs *= 1024 * 1024 * 1024
+    if index is None:
+        index = DiskIndex()
 
     # convert 'ignore' to a dict resembling { directory: cutoff_time }
     # where a cutoff time of -1 means 'never expire'.
@@ -157,9 +471,9 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
         if os.path.exists(base_dir):
             for d in os.listdir(base_dir):
                 p = os.path.join(base_dir, d)
-                if not os.path.isdir(p):
+                mtime = index.mtime(p)
+                if mtime is None:
                     continue
-                mtime = os.path.getmtime(p)
                 skip = False
                 for pattern, cutoff_time in ignore.iteritems():
                     if (fnmatch(d, pattern)):
@@ -174,52 +488,74 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
 
     dirs.sort()
 
-    while dirs:
-        mtime, d = dirs.pop(0)
+    def available():
+        pending = reaper.pending if reaper else 0
+        return freespace(base_dirs[0]) + pending
 
+    # Plan the deletions: everything older than max_age, and then the oldest
+    # of the rest until their predicted sizes make up for the missing space
+    before = available()
+    plan = []
+    predicted = 0
+    while dirs:
+        mtime, d = dirs[0]
         # If we're newer than max_age, and don't need any more free space,
         # we're all done here
         if (not max_age) or (mtime > max_age):
-            if freespace(base_dirs[0]) >= gigs:
+            if before + predicted >= gigs:
                 break
+        dirs.pop(0)
+        size = index.size(d)
+        plan.append((d, size))
+        predicted += size
 
+    if not plan:
+        return
+    print "Deleting %d directories, predicted to free %1.1f MB" % \
+        (len(plan), predicted / (1024 * 1024.0))
+    for d, size in plan:
         print "Deleting", d
         if not dry_run:
-            try:
-                clobber_path = d + clobber_suffix
-                if os.path.exists(clobber_path):
-                    rmdirRecursive(clobber_path)
-                # Prevent repeated moving.
-                if d.endswith(clobber_suffix):
-                    rmdirRecursive(d)
-                else:
-                    shutil.move(d, clobber_path)
-                    rmdirRecursive(clobber_path)
-            except:
-                print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+            delete_dir(d, reaper, size)
+            index.forget(d)
+    if dry_run:
+        return
+
+    after = available()
+    print "Predicted %1.1f MB, reclaimed %1.1f MB%s" % \
+        (predicted / (1024 * 1024.0), (after - before) / (1024 * 1024.0),
+         " (to be freed in the background)" if reaper else "")
+
+    # The predictions can be off, e.g., for directories that are hardlinked
+    # elsewhere, or that changed since they were measured; if we're still
+    # short, go on one directory at a time
+    while dirs and available() < gigs:
+        mtime, d = dirs.pop(0)
+        print "Deleting", d
+        delete_dir(d, reaper)
+        index.forget(d)
 
 
-def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
+def purge_hg_shares(share_dir, gigs, max_age, dry_run=False, reaper=None,
+                    index=None):
     """Deletes old hg directories under share_dir"""
+    if index is None:
+        index = DiskIndex()
     # Find hg directories
-    hg_dirs = []
-    for root, dirs, files in os.walk(share_dir):
-        for d in dirs[:]:
-            path = os.path.join(root, d, '.hg')
-            if os.path.exists(path) or os.path.exists(path + clobber_suffix):
-                hg_dirs.append(os.path.join(root, d))
-                # Remove d from the list so we don't go traversing down into it
-                dirs.remove(d)
+    hg_dirs = index.find_hg_dirs(share_dir)
 
     # Now we have a list of hg directories, call purge on them
-    purge(hg_dirs, gigs, [], max_age, dry_run)
+    purge(hg_dirs, gigs, [], max_age, dry_run, reaper, index)
 
     # Clean up empty directories
     for d in hg_dirs:
         if not os.path.exists(os.path.join(d, '.hg')):
             print "Cleaning up", d
             if not dry_run:
-                rmdirRecursive(d)
+                if reaper:
+                    reaper.add(d)
+                else:
+                    rmdirRecursive(d)
 
 if __name__ == '__main__':
     import time
@@ -252,9 +588,20 @@ if __name__ == '__main__':
     parser.add_option('', '--dry-run', action='store_true',
                       dest='dry_run',
                       help='''do not delete anything, just print out what would be
-deleted.  note that since no directories are deleted, if the amount of free
-disk space in base_dir(s) is less than the required size, then ALL directories
-will be listed in the order in which they would be deleted.''')
+deleted.  the directories are picked using the sizes recorded in the index,
+so they are the ones that would be deleted if those sizes are right.''')
+
+    parser.add_option('', '--deferred', action='store_true',
+                      dest='deferred', default=False,
+                      help='''rename directories to *.deleteme and delete them
+            in a background process, rather than waiting for them to be
+            deleted.  Space still to be freed by the background process counts
+            towards the required free space.''')
+
+    parser.add_option('', '--index-file', dest='index_file',
+                      default=os.path.expanduser('~/.purge_builds.index'),
+                      help='file to keep directory sizes in between runs '
+                      '(default ~/.purge_builds.index)')
 
     parser.add_option('', '--max-age', dest='max_age', type='int',
                       help='''maximum age (in days) for directories.  If any directory
@@ -277,13 +624,21 @@ will be listed in the order in which they would be deleted.''')
     else:
         cutoff_time = None
 
-    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run)
+    if options.deferred:
+        reaper = Reaper()
+    else:
+        reaper = None
+    index = DiskIndex(options.index_file)
+
+    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run,
+          reaper, index)
 
     # Try to cleanup shared hg repos. We run here even if we've freed enough
     # space so we can be sure and delete repositories older than max_age
     if 'HG_SHARE_BASE_DIR' in os.environ:
         purge_hg_shares(os.environ['HG_SHARE_BASE_DIR'],
-                        options.share_size, cutoff_time, options.dry_run)
+                        options.share_size, cutoff_time, options.dry_run,
+                        reaper, index)
 
     # tooltool cache cleanup
     if 'TOOLTOOL_HOME' in os.environ and 'TOOLTOOL_CACHE' in os.environ:
@@ -294,14 +649,23 @@ will be listed in the order in which they would be deleted.''')
         except:
             print "Warning: impossible to cleanup tooltool cache"
 
-    after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+    def available():
+        pending = reaper.pending if reaper else 0
+        return (freespace(base_dirs[0]) + pending) / (1024 * 1024 * 1024.0)
+    after = available()
 
     # Try to cleanup the current dir if we still need space and it will
     # actually help.
     if after < options.size:
         # We skip the tools dir here because we've usually just cloned it.
-        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run)
-        after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run,
+              reaper, index)
+        after = available()
+
+    if reaper:
+        reaper.start()
+    if not options.dry_run:
+        index.save()
 
     if after < options.size:
         print "Error: unable to free %1.2f GB of space. " % options.size + \
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import sqlalchemy as sa
+
+import cleanup_db
+from cleanup_db import Checkpoint, Throttle, range_cleaner, \
+    cleanup_statusdb_builds, cleanup_statusdb_orphaned_steps, \
+    cleanup_schedulerdb_schedulers
+
+SCHEMA = """
+CREATE TABLE builds (id INTEGER PRIMARY KEY, starttime INTEGER);
+CREATE TABLE steps (id INTEGER PRIMARY KEY, build_id INTEGER);
+CREATE TABLE build_properties (id INTEGER PRIMARY KEY, build_id INTEGER);
+CREATE TABLE schedulerdb_requests (id INTEGER PRIMARY KEY,
+                                   status_build_id INTEGER);
+"""
+
+
+class TestCleanupDb(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = sa.create_engine(
+            'sqlite:///%s' % os.path.join(self.tmpdir, 'status.db'),
+            connect_args=dict(timeout=30))
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                self.db.execute(statement)
+        # builds 1-500 start at their id; each has two steps and a property
+        self.db.execute("INSERT INTO builds VALUES (?, ?)",
+                        [(i, i) for i in range(1, 501)])
+        self.db.execute("INSERT INTO steps (build_id) VALUES (?)",
+                        [(i,) for i in range(1, 501) for j in range(2)])
+        self.db.execute("INSERT INTO build_properties (build_id) VALUES (?)",
+                        [(i,) for i in range(1, 501)])
+        self.db.execute("INSERT INTO schedulerdb_requests (status_build_id) "
+                        "VALUES (?)", [(i,) for i in range(1, 501, 10)])
+        self.meta = sa.MetaData(bind=self.db)
+        self.throttle = Throttle(width=7, sleep_factor=0)
+        self.throttle.min_width = 1
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _count(self, table, column, below):
+        return self.db.execute("SELECT count(*) FROM %s WHERE %s < ?" %
+                               (table, column), below).fetchone()[0]
+
+    def _assertCleanedUpTo(self, cutoff):
+        self.assertEquals(self._count('builds', 'id', cutoff), 0)
+        self.assertEquals(self._count('builds', 'id', 1000), 501 - cutoff)
+        self.assertEquals(self._count('steps', 'build_id', cutoff), 0)
+        self.assertEquals(self._count('steps', 'build_id', 1000),
+                          (501 - cutoff) * 2)
+        self.assertEquals(self._count('build_properties', 'build_id', cutoff),
+                          0)
+        self.assertEquals(self._count('schedulerdb_requests',
+                                      'status_build_id', cutoff), 0)
+
+    def testCleanupBuilds(self):
+        cleanup_statusdb_builds(self.meta, 300, throttle=self.throttle)
+        self._assertCleanedUpTo(300)
+
+    def testCleanupBuildsParallel(self):
+        cleanup_statusdb_builds(self.meta, 300, throttle=self.throttle,
+                                jobs=3)
+        self._assertCleanedUpTo(300)
+
+    def testBatchWidthAdapts(self):
+        throttle = Throttle(target_time=1.0, width=1000)
+        throttle.batch_done(0.1)
+        self.assertEquals(throttle.width, 2000)
+        throttle.batch_done(0.7)
+        self.assertEquals(throttle.width, 2000)
+        throttle.batch_done(3.0)
+        self.assertEquals(throttle.width, 1000)
+
+    def testBatchWidthCappedByIds(self):
+        throttle = Throttle(target_time=1.0, width=100000)
+        throttle.max_ids = 1000
+        # A fast batch that found too many ids still narrows the range
+        throttle.batch_done(0.1, 4000)
+        self.assertEquals(throttle.width, 25000)
+        throttle.batch_done(0.1, 1000)
+        self.assertEquals(throttle.width, 50000)
+        throttle.batch_done(0.1, 10 ** 9)
+        self.assertEquals(throttle.width, throttle.min_width)
+
+    def testDeleteIdsInChunks(self):
+        t_builds = sa.Table('builds', self.meta, autoload=True)
+        t_steps = sa.Table('steps', self.meta, autoload=True)
+        deletes = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            if statement.startswith('DELETE'):
+                deletes.append((statement.split()[2], len(parameters)))
+        sa.event.listen(self.db, 'before_cursor_execute',
+                        before_cursor_execute)
+        cleanup_db.delete_ids(self.db, range(1, 251),
+                              [t_steps.c.build_id, t_builds.c.id],
+                              chunk_size=100)
+
+        # Each chunk deletes the steps before their builds
+        self.assertEquals(deletes, [('steps', 100), ('builds', 100),
+                                    ('steps', 100), ('builds', 100),
+                                    ('steps', 50), ('builds', 50)])
+        self.assertEquals(self._count('builds', 'id', 251), 0)
+        self.assertEquals(self._count('steps', 'build_id', 251), 0)
+        self.assertEquals(self._count('builds', 'id', 1000), 250)
+
+    def testResumeFromCheckpoint(self):
+        checkpoint = Checkpoint(os.path.join(self.tmpdir, 'checkpoint'))
+        name = "builds before 300"
+        # Pretend an earlier run got as far as build 100, and then died
+        checkpoint.set(name, 100)
+
+        deleted = []
+        orig_delete_ids = cleanup_db.delete_ids
+
+        def delete_ids(db, ids, delete_columns):
+            deleted.extend(ids)
+            orig_delete_ids(db, ids, delete_columns)
+        cleanup_db.delete_ids = delete_ids
+        try:
+            cleanup_statusdb_builds(
+                self.meta, 300, throttle=self.throttle,
+                checkpoint=Checkpoint(checkpoint.filename))
+        finally:
+            cleanup_db.delete_ids = orig_delete_ids
+
+        self.assertEquals(sorted(deleted), range(100, 300))
+        self.assertEquals(self._count('builds', 'id', 100), 99)
+        # Finishing clears the checkpoint
+        self.assertEquals(Checkpoint(checkpoint.filename).get(name), None)
+
+    def testCheckpointAfterFailure(self):
+        checkpoint = Checkpoint(os.path.join(self.tmpdir, 'checkpoint'))
+        t_builds = sa.Table('builds', self.meta, autoload=True)
+        t_missing = sa.Table('missing', self.meta,
+                             sa.Column('build_id', sa.Integer))
+        q = sa.select([t_builds.c.id]).where(t_builds.c.id > 50)
+        self.assertRaises(sa.exc.OperationalError, range_cleaner, "test",
+                          t_builds.c.id, q,
+                          [t_missing.c.build_id, t_builds.c.id],
+                          throttle=self.throttle, checkpoint=checkpoint)
+        # Ranges without anything to delete are done
+        self.assertTrue(0 < checkpoint.get("test") <= 51)
+        # The failed batch was rolled back
+        self.assertEquals(self._count('builds', 'id', 1000), 500)
+
+    def testDryRun(self):
+        cleanup_statusdb_builds(self.meta, 300, throttle=self.throttle,
+                                dry_run=True)
+        self.assertEquals(self._count('builds', 'id', 1000), 500)
+        self.assertEquals(self._count('steps', 'build_id', 1000), 1000)
+
+    def testCleanupOrphanedSteps(self):
+        self.db.execute("DELETE FROM builds WHERE id < 200")
+        cleanup_statusdb_orphaned_steps(self.meta, throttle=self.throttle)
+        self.assertEquals(self._count('steps', 'build_id', 200), 0)
+        self.assertEquals(self._count('steps', 'build_id', 1000), 301 * 2)
+
+
+class TestCleanupSchedulers(TestCase):
+    def setUp(self):
+        self.db = sa.create_engine('sqlite:///:memory:')
+        self.db.execute("CREATE TABLE changes (changeid INTEGER PRIMARY KEY, "
+                        "when_timestamp INTEGER)")
+        self.db.execute("CREATE TABLE schedulers (schedulerid INTEGER "
+                        "PRIMARY KEY, name TEXT, class_name TEXT, state TEXT)")
+        now = time.time()
+        old = now - 30 * 86400
+        self.db.execute("INSERT INTO changes VALUES (?, ?)",
+                        [(1, old), (2, now)])
+        perbuild = "buildbot.schedulers.basic.Scheduler"
+        self.db.execute("INSERT INTO schedulers VALUES (?, ?, ?, ?)", [
+            # last change is old
+            (1, "s1", perbuild, json.dumps({"last_processed": 1})),
+            # last change is recent
+            (2, "s2", perbuild, json.dumps({"last_processed": 2})),
+            # release schedulers are kept for longer
+            (3, "release-s3", perbuild, json.dumps({"last_processed": 1})),
+            # last change is gone
+            (4, "s4", perbuild, json.dumps({"last_processed": 3})),
+            (5, "s5", "buildbot.schedulers.timed.Nightly", "{}"),
+        ])
+
+    def _schedulers(self):
+        return [r[0] for r in self.db.execute(
+            "SELECT schedulerid FROM schedulers ORDER BY schedulerid")]
+
+    def testCleanup(self):
+        cleanup_schedulerdb_schedulers(self.db)
+        self.assertEquals(self._schedulers(), [2, 3, 5])
+
+    def testDryRun(self):
+        cleanup_schedulerdb_schedulers(self.db, dry_run=True)
+        self.assertEquals(self._schedulers(), [1, 2, 3, 4, 5])
@@ -0,0 +1,105 @@
+import os
+import shutil
+import cPickle
+import tempfile
+from unittest import TestCase
+
+import print_waits
+from print_waits import BuildIndex, scan_builder
+
+
+class Change(object):
+    def __init__(self, when):
+        self.when = when
+
+
+class Request(object):
+    def __init__(self, submittedAt):
+        self.submittedAt = submittedAt
+
+
+class Build(object):
+    def __init__(self, submitted, started, reason="scheduler"):
+        self.changes = [Change(submitted)]
+        self.requests = [Request(submitted + 60)]
+        self.started = started
+        self.reason = reason
+
+
+class TestPrintWaits(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        os.mkdir('builder')
+        # build i was submitted at 1000 * i, and waited i minutes to start
+        for i in range(10):
+            self._write(i, Build(1000 * i, 1000 * i + 60 * i))
+        self._write(10, Build(10000, 10600, "The web-page 'rebuild' button"))
+        open(os.path.join('builder', 'builder'), 'w').write('not a build')
+        open(os.path.join('builder', '11'), 'w').write('corrupt')
+        self.index = BuildIndex('index.sqlite')
+
+        self.loaded = []
+        self.orig_parse_build = print_waits.parse_build
+
+        def parse_build(path):
+            self.loaded.append(path)
+            return self.orig_parse_build(path)
+        print_waits.parse_build = parse_build
+
+    def tearDown(self):
+        print_waits.parse_build = self.orig_parse_build
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, n, build):
+        path = os.path.join('builder', str(n))
+        cPickle.dump(build, open(path, 'w'))
+        # Make sure rewritten builds look modified
+        os.utime(path, (n, os.path.getmtime(path) + n))
+
+    def _scan(self, starttime=0, endtime=100000, change_as_submittime=True):
+        times = {}
+        scan_builder('builder', starttime, endtime, 1, times,
+                     change_as_submittime, self.index)
+        return times
+
+    def testScan(self):
+        self.assertEquals(self._scan(500, 5500),
+                          {1: 1, 2: 1, 3: 1, 4: 1, 5: 1})
+        # requests were submitted a minute after the change
+        self.assertEquals(self._scan(500, 5500, False),
+                          {0: 1, 1: 1, 2: 1, 3: 1, 4: 1})
+
+    def testScanWithoutIndex(self):
+        times = {}
+        scan_builder('builder', 500, 5500, 1, times)
+        self.assertEquals(times, {1: 1, 2: 1, 3: 1, 4: 1, 5: 1})
+
+    def testIncrementalUpdate(self):
+        self._scan()
+        self.assertEquals(len(self.loaded), 12)
+        del self.loaded[:]
+
+        # Nothing has changed; nothing is loaded.  Build 0 isn't after
+        # starttime
+        self.assertEquals(len(self._scan()), 9)
+        self.assertEquals(self.loaded, [])
+
+        # A new build, a changed build, and a deleted build
+        self._write(12, Build(12000, 12000))
+        self._write(3, Build(3000, 3000 + 60 * 30))
+        os.unlink(os.path.join('builder', '9'))
+        times = self._scan()
+        self.assertEquals(sorted(self.loaded),
+                          [os.path.join('builder', '12'),
+                           os.path.join('builder', '3')])
+        self.assertEquals(times, {0: 1, 1: 1, 2: 1, 4: 1, 5: 1, 6: 1, 7: 1,
+                                  8: 1, 30: 1})
+
+    def testParallelBackfill(self):
+        print_waits.parse_build = self.orig_parse_build
+        times = {}
+        scan_builder('builder', 500, 5500, 1, times, True, self.index, 2)
+        self.assertEquals(times, {1: 1, 2: 1, 3: 1, 4: 1, 5: 1})
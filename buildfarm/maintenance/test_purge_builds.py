@@ -1,8 +1,64 @@
+import os
+import stat
+import errno
+import time
+import shutil
+import tempfile
 from unittest import TestCase
-from purge_builds import isImportant
 
+import mock
 
-class TestPurge(TestCase):
+import purge_builds
+from purge_builds import fast_rmtree, dir_size, purge, Reaper, DiskIndex
+
+GB = 1024 * 1024 * 1024.0
+
+
+class FakeDisk(object):
+    """Stands in for freespace(): `free` bytes, plus the size of each
+    directory in `sizes` that has been deleted"""
+
+    def __init__(self, free=0):
+        self.free = free
+        self.sizes = {}
+
+    def __call__(self, path):
+        return self.free + sum(size for d, size in self.sizes.items()
+                               if not os.path.exists(d))
+
+
+class PurgeTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmpdir, 'builds')
+        os.mkdir(self.base)
+        self.disk = FakeDisk()
+        self.orig_freespace = purge_builds.freespace
+        purge_builds.freespace = self.disk
+
+    def tearDown(self):
+        purge_builds.freespace = self.orig_freespace
+        for root, dirs, files in os.walk(self.tmpdir):
+            for d in dirs:
+                os.chmod(os.path.join(root, d), 0700)
+        shutil.rmtree(self.tmpdir)
+
+    def _makeDir(self, name, age, nbytes=4096, base=None):
+        """Make directory `name` under the base dir with a file of `nbytes`
+        bytes in it, last modified `age` days ago"""
+        d = os.path.join(base or self.base, name)
+        os.makedirs(d)
+        open(os.path.join(d, 'file'), 'wb').write('x' * nbytes)
+        mtime = time.time() - age * 86400
+        os.utime(d, (mtime, mtime))
+        self.disk.sizes[d] = dir_size(d)
+        return d
+
+    def _remaining(self, base=None):
+        return sorted(os.listdir(base or self.base))
+
+
+class TestIgnore(PurgeTestCase):
 
     importantDirsPattern = ['release-*', '*-nightly', 'info']
     importantDirs = ['mozilla-central-linux64-nightly',
@@ -23,9 +79,303 @@ class TestPurge(TestCase):
                         ]
 
     def testImportantDirs(self):
-        for d in self.importantDirs:
-            self.assertTrue(isImportant(d, self.importantDirsPattern))
+        for d in self.importantDirs + self.notImportantDirs:
+            self._makeDir(d, 30)
+        # everything is past max_age
+        purge([self.base], 0, self.importantDirsPattern, time.time())
+        self.assertEquals(self._remaining(), sorted(self.importantDirs))
+
+    def testExpiry(self):
+        self._makeDir('rel-old', 50)
+        self._makeDir('rel-new', 30)
+        purge([self.base], 0, ['rel-*:40d'], time.time())
+        self.assertEquals(self._remaining(), ['rel-new'])
+
+
+class TestFastRmtree(PurgeTestCase):
+    def setUp(self):
+        PurgeTestCase.setUp(self)
+        self.tree = os.path.join(self.tmpdir, 'tree')
+        os.makedirs(os.path.join(self.tree, 'a', 'b'))
+        for f in ('f1', 'a/f2', 'a/b/f3'):
+            open(os.path.join(self.tree, f), 'w').write(f)
+        os.symlink('a', os.path.join(self.tree, 'link'))
+
+    def _checkPerms(self, func):
+        """Wraps func so that it fails like it would for an unprivileged user
+        in a directory without write permission, whoever runs the tests"""
+        def checked(path):
+            if not os.stat(os.path.dirname(path)).st_mode & stat.S_IWUSR:
+                raise OSError(errno.EACCES, "Permission denied", path)
+            return func(path)
+        return checked
+
+    def testDelete(self):
+        fast_rmtree(self.tree)
+        self.assertFalse(os.path.exists(self.tree))
+        # the symlink was removed, not followed
+        fast_rmtree(self.tree)
+
+    def testReadOnly(self):
+        for d in ('a/b', 'a', ''):
+            os.chmod(os.path.join(self.tree, d), 0500)
+        with mock.patch('os.remove', self._checkPerms(os.remove)), \
+                mock.patch('os.rmdir', self._checkPerms(os.rmdir)):
+            fast_rmtree(self.tree)
+        self.assertFalse(os.path.exists(self.tree))
+
+    def testVanished(self):
+        real_listdir = os.listdir
+
+        def listdir(path):
+            names = real_listdir(path)
+            if path == self.tree:
+                # another reaper gets there first
+                os.remove(os.path.join(self.tree, 'f1'))
+                shutil.rmtree(os.path.join(self.tree, 'a'))
+                names.append('never-there')
+            return names
+        with mock.patch('os.listdir', listdir):
+            fast_rmtree(self.tree)
+        self.assertFalse(os.path.exists(self.tree))
+
+    def testMissing(self):
+        fast_rmtree(os.path.join(self.tmpdir, 'missing'))
+
+
+class TestReaper(PurgeTestCase):
+    def testNested(self):
+        reaper = Reaper()
+        inner = self._makeDir('outer/inner', 0)
+        reaper.add(inner, 100)
+        reaper.add(os.path.join(self.base, 'outer'), 1000)
+        reaper.add(inner, 100)
+        self.assertEquals(reaper.paths, [os.path.join(self.base, 'outer')])
+        self.assertEquals(reaper.pending, 1000)
+
+    def testDeferredPurge(self):
+        self.disk.free = 100 * 4096
+        old = self._makeDir('old', 3)
+        self._makeDir('older', 5)
+        self._makeDir('new', 1)
+        size = self.disk.sizes[old]
+        reaper = Reaper()
+        # just enough space is needed that deleting 'older' and 'old' covers
+        # it.  Renaming them doesn't free anything yet, but that mustn't
+        # cause 'new' to be deleted too.
+        purge([self.base], (self.disk.free + size * 2) / GB, [], None,
+              reaper=reaper)
+        self.assertEquals(self._remaining(),
+                          ['new', 'old.deleteme', 'older.deleteme'])
+        self.assertEquals(reaper.pending, size * 2)
+        self.assertEquals(sorted(reaper.paths),
+                          [os.path.join(self.base, 'old.deleteme'),
+                           os.path.join(self.base, 'older.deleteme')])
+
+    def testDeferredPurgeEarlierLeftovers(self):
+        # a .deleteme from a run whose reaper didn't finish
+        self._makeDir('old.deleteme', 3)
+        old = self._makeDir('old', 3)
+        reaper = Reaper()
+        purge([self.base], 0, [], time.time(), reaper=reaper)
+        self.assertFalse(os.path.exists(old))
+        # 'old' was renamed aside, rather than into the earlier leftovers
+        self.assertEquals(len(reaper.paths), 2)
+        for path in reaper.paths:
+            self.assertTrue(os.path.isdir(path))
+            self.assertTrue(path.endswith('.deleteme'))
+
+    def _waitForDeletion(self, path):
+        for i in range(100):
+            if not os.path.exists(path):
+                return
+            time.sleep(0.1)
+        self.fail("%s wasn't deleted" % path)
+
+    def testBackgroundDelete(self):
+        d = self._makeDir('old', 3)
+        reaper = Reaper()
+        reaper.add(d)
+        reaper.start()
+        self.assertEquals((reaper.paths, reaper.pending), ([], 0))
+        self._waitForDeletion(d)
+
+    def testNoFork(self):
+        d = self._makeDir('old', 3)
+        reaper = Reaper()
+        reaper.add(d)
+        fork = os.fork
+        del os.fork
+        try:
+            reaper.start()
+        finally:
+            os.fork = fork
+        # deleted before start() returned
+        self.assertFalse(os.path.exists(d))
+        self.assertEquals((reaper.paths, reaper.pending), ([], 0))
+
+
+class TestDiskIndex(PurgeTestCase):
+    def setUp(self):
+        PurgeTestCase.setUp(self)
+        self.filename = os.path.join(self.tmpdir, 'index')
+        self.measured = []
+
+        def counting_dir_size(d):
+            self.measured.append(d)
+            return dir_size(d)
+        purge_builds.dir_size = counting_dir_size
+
+    def tearDown(self):
+        purge_builds.dir_size = dir_size
+        PurgeTestCase.tearDown(self)
+
+    def testSizeReused(self):
+        d = self._makeDir('a', 1)
+        index = DiskIndex(self.filename)
+        index.mtime(d)
+        self.assertEquals(index.size(d), self.disk.sizes[d])
+        self.assertEquals(index.size(d), self.disk.sizes[d])
+        index.save()
+
+        index = DiskIndex(self.filename)
+        index.mtime(d)
+        self.assertEquals(index.size(d), self.disk.sizes[d])
+        self.assertEquals(self.measured, [d])
+
+    def testChangedMtime(self):
+        d = self._makeDir('a', 1)
+        index = DiskIndex(self.filename)
+        index.mtime(d)
+        size = index.size(d)
+        open(os.path.join(d, 'new'), 'wb').write('x' * 8192)
+        os.utime(d, None)
+        index.mtime(d)
+        self.assertTrue(index.size(d) > size)
+        self.assertEquals(len(self.measured), 2)
+
+    def testMaxAge(self):
+        d = self._makeDir('a', 1)
+        index = DiskIndex(self.filename)
+        index.mtime(d)
+        size = index.size(d)
+        # the directory's mtime doesn't change when a subdirectory does
+        open(os.path.join(d, 'file'), 'ab').write('x' * 8192)
+        index.size(d)
+        self.assertEquals(len(self.measured), 1)
+
+        index.dirs[d][2] -= index.max_age + 1
+        self.assertTrue(index.size(d) > size)
+        self.assertEquals(len(self.measured), 2)
+
+    def testUnseenDropped(self):
+        a = self._makeDir('a', 1)
+        b = self._makeDir('b', 1)
+        index = DiskIndex(self.filename)
+        index.size(a)
+        index.size(b)
+        index.save()
+
+        index = DiskIndex(self.filename)
+        index.size(a)
+        index.save()
+        self.assertEquals(DiskIndex(self.filename).dirs.keys(), [a])
+
+    def testUnreadable(self):
+        open(self.filename, 'w').write('garbage')
+        with mock.patch('sys.stderr'):
+            index = DiskIndex(self.filename)
+        self.assertEquals(index.dirs, {})
+        d = self._makeDir('a', 1)
+        self.assertEquals(index.size(d), self.disk.sizes[d])
+
+    def testFindHgDirs(self):
+        share = os.path.join(self.tmpdir, 'share')
+        for repo in ('a/repo1', 'b/c/repo2'):
+            os.makedirs(os.path.join(share, repo, '.hg'))
+        index = DiskIndex(self.filename)
+        found = [os.path.join(share, 'a/repo1'),
+                 os.path.join(share, 'b/c/repo2')]
+        self.assertEquals(sorted(index.find_hg_dirs(share)), found)
+        index.save()
+
+        listed = []
+        real_listdir = os.listdir
+
+        def listdir(path):
+            listed.append(path)
+            return real_listdir(path)
+        with mock.patch('os.listdir', listdir):
+            index = DiskIndex(self.filename)
+            self.assertEquals(sorted(index.find_hg_dirs(share)), found)
+            self.assertEquals(listed, [])
+
+            # only the directory that changed is listed again
+            b = os.path.join(share, 'b')
+            os.makedirs(os.path.join(b, 'repo3', '.hg'))
+            os.utime(b, (1, 1))
+            found.append(os.path.join(b, 'repo3'))
+            self.assertEquals(sorted(index.find_hg_dirs(share)),
+                              sorted(found))
+            self.assertEquals(listed, [b])
+
+
+class TestPlan(PurgeTestCase):
+    def setUp(self):
+        PurgeTestCase.setUp(self)
+        self.index = DiskIndex()
+        for name, age in (('older', 20), ('old', 15), ('a', 3), ('b', 2),
+                          ('c', 1)):
+            self._makeDir(name, age)
+        self.size = self.disk.sizes[os.path.join(self.base, 'a')]
+        self.max_age = time.time() - 10 * 86400
+
+    def _purge(self, nsizes, max_age=True, dry_run=False):
+        """Purge until there's enough space for `nsizes` of the test
+        directories"""
+        if max_age:
+            max_age = self.max_age
+        purge([self.base], nsizes * self.size / GB, [], max_age, dry_run,
+              index=self.index)
+
+    def testMaxAge(self):
+        # everything older than max_age goes, needed or not
+        self._purge(0)
+        self.assertEquals(self._remaining(), ['a', 'b', 'c'])
+
+    def testShortfall(self):
+        # and then the oldest of the rest, until there's enough space
+        self._purge(3)
+        self.assertEquals(self._remaining(), ['b', 'c'])
+
+    def testNoMaxAge(self):
+        self._purge(1, max_age=False)
+        self.assertEquals(self._remaining(), ['a', 'b', 'c', 'old'])
+
+    def testDryRun(self):
+        self._purge(5, dry_run=True)
+        self.assertEquals(self._remaining(), ['a', 'b', 'c', 'old', 'older'])
+
+    def testPlannedFromIndex(self):
+        planned = []
+        orig_delete_dir = purge_builds.delete_dir
+
+        def delete_dir(d, reaper=None, size=None):
+            planned.append((os.path.basename(d), size))
+            orig_delete_dir(d, reaper, size)
+        purge_builds.delete_dir = delete_dir
+        try:
+            self._purge(3)
+        finally:
+            purge_builds.delete_dir = orig_delete_dir
+        self.assertEquals(planned, [('older', self.size), ('old', self.size),
+                                    ('a', self.size)])
 
-    def testNotImportantDirs(self):
-        for d in self.notImportantDirs:
-            self.assertFalse(isImportant(d, self.importantDirsPattern))
+    def testFallback(self):
+        # the index thinks 'old' is far bigger than it is, so the plan stops
+        # short, and the rest is deleted one directory at a time
+        old = os.path.join(self.base, 'old')
+        self.index.mtime(old)
+        self.index.dirs[old][1:] = [self.size * 10, time.time()]
+        self._purge(4)
+        self.assertEquals(self._remaining(), ['c'])
@@ -1,5 +1,5 @@
 #!/usr/bin/python
-from util.post_file import post_multipart
+from util.post_file import post_multipart, MultipartPoster
 import sys
 import string
 try:
@@ -11,8 +11,10 @@ except ImportError:
 class GraphPost(object):
 
     def __init__(self, server, selector, branch, resultsname, testresult,
-                 sourcestamp, buildid, timestamp):
+                 sourcestamp, buildid, timestamp, poster=None):
         self.server = server
+        # a MultipartPoster to post with, or None for a new connection
+        self.poster = poster
         self.selector = selector
         self.branch = branch
         self.resultsname = resultsname
@@ -52,9 +54,13 @@ class GraphPost(object):
         testname, testlongname, testval, prettyval = self.testresult
         testval = str(testval).strip(string.letters)
         data = self.constructString(testlongname, testval)
-        content = post_multipart(self.server, self.selector,
-                                 [("key", "value")],
-                                 [("filename", "data", data)])
+        if self.poster:
+            content = self.poster.post(self.selector, [("key", "value")],
+                                       [("filename", "data", data)])
+        else:
+            content = post_multipart(self.server, self.selector,
+                                     [("key", "value")],
+                                     [("filename", "data", data)])
         self.doTinderboxPrint(content, testlongname, testname, prettyval)
 
 
@@ -70,6 +76,10 @@ def main():
     parser.add_option("--sourcestamp", dest="sourcestamp")
     parser.add_option("--resultsname", dest="resultsname")
     parser.add_option("--properties-file", dest="propertiesFile")
+    parser.add_option("--no-keepalive", dest="keepalive",
+                      action="store_false", default=True,
+                      help="post each result on a new connection, rather "
+                      "than posting them all over one keep-alive connection")
 
     options, args = parser.parse_args()
 
@@ -77,13 +87,22 @@ def main():
     properties = json.load(open(options.propertiesFile))
     testresults = properties['properties']['testresults']
 
-    for testresult in testresults:
-        gp = GraphPost(server=options.server, selector=options.selector,
-                       branch=options.branch, resultsname=options.resultsname,
-                       testresult=testresult,
-                       sourcestamp=options.sourcestamp, buildid=options.buildid,
-                       timestamp=options.timestamp)
-        gp.postResult()
+    poster = None
+    if options.keepalive:
+        poster = MultipartPoster(options.server)
+    try:
+        for testresult in testresults:
+            gp = GraphPost(server=options.server, selector=options.selector,
+                           branch=options.branch,
+                           resultsname=options.resultsname,
+                           testresult=testresult,
+                           sourcestamp=options.sourcestamp,
+                           buildid=options.buildid,
+                           timestamp=options.timestamp, poster=poster)
+            gp.postResult()
+    finally:
+        if poster:
+            poster.close()
 
 if __name__ == '__main__':
     main()
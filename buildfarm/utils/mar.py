@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 """%prog [options] -x|-t|-c marfile [files]
+       %prog [options] -k keyfile -V marfile [marfile ...]
 
 Utility for managing mar files"""
 
@@ -12,7 +13,10 @@ Utility for managing mar files"""
 
 import struct
 import os
+import sys
 import bz2
+import mmap
+import shutil
 import hashlib
 import tempfile
 from subprocess import Popen, PIPE
@@ -79,6 +83,109 @@ def generate_signature(fp, updatefunc):
         updatefunc(block)
 
 
+def generate_signature_data(data, updatefunc):
+    """Like generate_signature, but for a buffer `data` (e.g., an mmap of the
+    MAR file). Everything after the signatures is handed to `updatefunc` in
+    one piece, without copying it"""
+    # Magic, index_offset, file size and number of signatures
+    updatefunc(data[0:20])
+    num_sigs = unpackint(data[16:20])
+    pos = 20
+    for i in range(num_sigs):
+        # signature algo and size, but not the signature itself
+        updatefunc(data[pos:pos + 8])
+        pos += 8 + unpackint(data[pos + 4:pos + 8])
+    updatefunc(buffer(data, pos))
+
+
+def _map_file(name):
+    f = open(name, 'rb')
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    return data
+
+
+def _makedirs(dirname):
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+
+def _extract_member(data, offset, size, flags, dstpath, decompress):
+    """Write the `size` bytes at `offset` in buffer `data` (e.g., an mmap of
+    the MAR file) to `dstpath`, decompressing them with BZ2 if
+    `decompress` is set"""
+    _makedirs(os.path.dirname(dstpath))
+    if decompress:
+        decomp = bz2.BZ2Decompressor()
+    output = open(dstpath, "wb")
+    pos = offset
+    end = offset + size
+    while pos < end:
+        block = data[pos:min(pos + 1024 * 1024, end)]
+        pos += len(block)
+        if decompress:
+            block = decomp.decompress(block)
+        output.write(block)
+    output.close()
+    os.chmod(dstpath, flags)
+
+
+def _compress_file(path, dstpath):
+    """Compress `path` into `dstpath` with BZ2"""
+    f = open(path, 'rb')
+    output = open(dstpath, 'wb')
+    comp = bz2.BZ2Compressor(9)
+    while True:
+        block = f.read(512 * 1024)
+        if not block:
+            break
+        output.write(comp.compress(block))
+    output.write(comp.flush())
+    output.close()
+    f.close()
+
+
+# Each worker process maps the MAR file it extracts from once
+_worker_data = None
+
+
+def _init_extract_worker(marname):
+    global _worker_data
+    _worker_data = _map_file(marname)
+
+
+def _extract_worker(args):
+    _extract_member(_worker_data, *args)
+
+
+def _compress_worker(args):
+    _compress_file(*args)
+
+
+def _verify_worker(args):
+    marname, keyfile = args
+    try:
+        m = MarFile(marname, signature_versions=[(1, keyfile)])
+        try:
+            if not m.signatures:
+                return marname, "no signatures"
+            m.verify_signatures()
+        finally:
+            m.close()
+    except Exception, e:
+        return marname, str(e) or e.__class__.__name__
+    return marname, None
+
+
+def _pool(jobs, *args):
+    # multiprocessing is only needed, and only available from python 2.6, for
+    # parallel jobs
+    import multiprocessing
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    return multiprocessing.Pool(jobs, *args)
+
+
 class MarSignature:
     """Represents a signature"""
     size = None
@@ -191,12 +298,16 @@ class MarFile:
 
     _longint_fmt = ">L"
 
+    # Whether members are compressed with BZ2
+    compressed = False
+
     def __init__(self, name, mode="r", signature_versions=[]):
         if mode not in "rw":
             raise ValueError("Mode must be either 'r' or 'w'")
 
         self.name = name
         self.mode = mode
+        self._data = None
         if mode == 'w':
             self.fileobj = open(name, 'wb')
         else:
@@ -228,11 +339,12 @@ class MarFile:
             # Write the magic and placeholder for the index
             self.fileobj.write("MAR1" + packint(self.index_offset))
 
-            # Write placeholder for file size
-            self.fileobj.write(struct.pack(">Q", 0))
+            if signature_versions:
+                # Write placeholder for file size
+                self.fileobj.write(struct.pack(">Q", 0))
 
-            # Write num_signatures
-            self.fileobj.write(packint(len(signature_versions)))
+                # Write num_signatures
+                self.fileobj.write(packint(len(signature_versions)))
 
             for algo_id, keyfile in signature_versions:
                 sig = MarSignature(algo_id, keyfile)
@@ -291,9 +403,7 @@ class MarFile:
         if not self.signatures:
             return
 
-        fp = self.fileobj
-
-        generate_signature(fp, self._update_signatures)
+        generate_signature_data(self.data, self._update_signatures)
 
         for sig in self.signatures:
             if not sig.verify_signature():
@@ -329,7 +439,9 @@ class MarFile:
         if not fileobj:
             info.name = name or os.path.normpath(path)
             info.size = os.path.getsize(path)
-            info.flags = flags or os.stat(path).st_mode & 0777
+            if flags is None:
+                flags = os.stat(path).st_mode & 0777
+            info.flags = flags
             info._offset = self.index_offset
 
             f = open(path, 'rb')
@@ -340,7 +452,8 @@ class MarFile:
                     break
                 self.fileobj.write(block)
         else:
-            assert flags
+            # 0 is a valid mode, so only a missing flags is an error
+            assert flags is not None
             info.name = name or path
             info.size = 0
             info.flags = flags
@@ -364,6 +477,51 @@ class MarFile:
             for f in files:
                 self.add(os.path.join(root, f))
 
+    def add_files(self, paths, jobs=1):
+        """Adds each of `paths`, which may be files or directories, to this
+        MAR file as `add` does.
+
+        If the members are compressed, up to `jobs` files are compressed at
+        once in separate processes (all CPUs if `jobs` is 0 or None).  The
+        members are written in the same order as with `add`."""
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, names in os.walk(path):
+                    files.extend(os.path.join(root, f) for f in names)
+            else:
+                files.append(path)
+
+        if jobs == 1 or not self.compressed:
+            for f in files:
+                self.add(f)
+            return
+
+        tmpdir = tempfile.mkdtemp()
+        pool = _pool(jobs)
+        try:
+            tasks = [(f, os.path.join(tmpdir, str(i)))
+                     for i, f in enumerate(files)]
+            # imap returns results in order, as soon as each is ready; the
+            # files compressed ahead of their turn wait in tmpdir
+            results = pool.imap(_compress_worker, tasks)
+            for f, tmp in tasks:
+                results.next()
+                compressed = open(tmp, 'rb')
+                # add the compressed data as-is
+                MarFile.add(self, f, name=os.path.normpath(f),
+                            fileobj=compressed,
+                            flags=os.stat(f).st_mode & 0777)
+                compressed.close()
+                os.unlink(tmp)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(tmpdir)
+
     def close(self):
         """Close the MAR file, writing out the new index if required.
 
@@ -371,21 +529,26 @@ class MarFile:
         if self.mode == "w" and self.rewrite_index:
             self._write_index()
 
-        # Update file size
-        self.fileobj.seek(0, 2)
-        totalsize = self.fileobj.tell()
-        self.fileobj.seek(8)
-        # print "File size is", totalsize, repr(struct.pack(">Q", totalsize))
-        self.fileobj.write(struct.pack(">Q", totalsize))
+        # Update file size; MARs without signatures don't have one
+        if self.mode == "w" and self.signature_versions:
+            self.fileobj.seek(0, 2)
+            totalsize = self.fileobj.tell()
+            self.fileobj.seek(8)
+            # print "File size is", totalsize, repr(struct.pack(">Q", totalsize))
+            self.fileobj.write(struct.pack(">Q", totalsize))
 
         if self.mode == "w" and self.signatures:
             self.fileobj.flush()
-            fileobj = open(self.name, 'rb')
-            generate_signature(fileobj, self._update_signatures)
+            data = _map_file(self.name)
+            generate_signature_data(data, self._update_signatures)
+            data.close()
             for sig in self.signatures:
                 # print sig._offset
                 sig.write_signature(self.fileobj)
 
+        if self._data is not None:
+            self._data.close()
+            self._data = None
         self.fileobj.close()
         self.fileobj = None
 
@@ -412,52 +575,82 @@ class MarFile:
         self.fileobj.seek(4)
         self.fileobj.write(packint(self.index_offset))
 
-    def extractall(self, path=".", members=None):
+    @property
+    def data(self):
+        """A read-only mmap of the MAR file, for reading members at random
+        without seeking `fileobj`"""
+        if self.mode != "r":
+            raise ValueError("File not opened for reading")
+        if self._data is None:
+            self._data = mmap.mmap(self.fileobj.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        return self._data
+
+    def read(self, member):
+        """Returns the data of `member`, as stored in the MAR file"""
+        return self.data[member._offset:member._offset + member.size]
+
+    def extractall(self, path=".", members=None, jobs=1):
         """Extracts members into `path`. If members is None (the default), then
-        all members are extracted."""
+        all members are extracted.
+
+        Up to `jobs` members are extracted at once in separate processes (all
+        CPUs if `jobs` is 0 or None)."""
         if members is None:
             members = self.members
+        if jobs == 1:
+            for m in members:
+                self.extract(m, path)
+            return
+
+        # create the directories up front, so the workers don't race to
         for m in members:
-            self.extract(m, path)
+            _makedirs(os.path.dirname(os.path.join(path, m.name)))
+        # biggest first, so that one big member doesn't hold up the end
+        tasks = [(m._offset, m.size, m.flags, os.path.join(path, m.name),
+                  self.compressed)
+                 for m in sorted(members, key=lambda m: m.size, reverse=True)]
+        pool = _pool(jobs, _init_extract_worker, (self.name,))
+        try:
+            for result in pool.imap_unordered(_extract_worker, tasks):
+                pass
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
     def extract(self, member, path="."):
         """Extract `member` into `path` which defaults to the current
         directory."""
-        dstpath = os.path.join(path, member.name)
-        dirname = os.path.dirname(dstpath)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        _extract_member(self.data, member._offset, member.size, member.flags,
+                        os.path.join(path, member.name), self.compressed)
+
 
-        self.fileobj.seek(member._offset)
-        open(dstpath, "wb").write(self.fileobj.read(member.size))
-        os.chmod(dstpath, member.flags)
+def verify_mars(marnames, keyfile, jobs=1):
+    """Verifies the signatures of each of `marnames` against `keyfile`.
+
+    Up to `jobs` files are verified at once in separate processes (all CPUs
+    if `jobs` is 0 or None). Returns a list of (marname, error) tuples in the
+    same order as `marnames`, where error is None if the file verified."""
+    tasks = [(marname, keyfile) for marname in marnames]
+    if jobs == 1:
+        return map(_verify_worker, tasks)
+    pool = _pool(jobs)
+    try:
+        return pool.map(_verify_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class BZ2MarFile(MarFile):
     """Subclass of MarFile that compresses/decompresses members using BZ2.
 
     BZ2 compression is used for most update MARs."""
-    def extract(self, member, path="."):
-        """Extract and decompress `member` into `path` which defaults to the
-        current directory."""
-        dstpath = os.path.join(path, member.name)
-        dirname = os.path.dirname(dstpath)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-
-        self.fileobj.seek(member._offset)
-        decomp = bz2.BZ2Decompressor()
-        output = open(dstpath, "wb")
-        toread = member.size
-        while True:
-            thisblock = min(128 * 1024, toread)
-            block = self.fileobj.read(thisblock)
-            if not block:
-                break
-            toread -= len(block)
-            output.write(decomp.decompress(block))
-        output.close()
-        os.chmod(dstpath, member.flags)
+
+    compressed = True
 
     def add(self, path, name=None, fileobj=None, mode=None):
         """Adds `path` compressed with BZ2 to this MAR file.
@@ -516,6 +709,7 @@ if __name__ == "__main__":
         chdir=None,
         keyfile=None,
         verify=False,
+        jobs=1,
     )
     parser.add_option("-x", "--extract", action="store_const", const="extract",
                       dest="action", help="extract MAR")
@@ -523,8 +717,14 @@ if __name__ == "__main__":
                       dest="action", help="print out MAR contents")
     parser.add_option("-c", "--create", action="store_const", const="create",
                       dest="action", help="create MAR")
+    parser.add_option("-V", "--verify-all", action="store_const",
+                      const="verify", dest="action",
+                      help="verify the signatures of every MAR given")
     parser.add_option("-j", "--bzip2", action="store_true", dest="bz2",
                       help="compress/decompress members with BZ2")
+    parser.add_option("-J", "--jobs", dest="jobs", type="int",
+                      help="extract or compress this many members, or verify "
+                      "this many MARs, at once; 0 for one per CPU (default 1)")
     parser.add_option("-k", "--keyfile", dest="keyfile",
                       help="sign/verify with given key")
     parser.add_option("-v", "--verify", dest="verify", action="store_true",
@@ -535,11 +735,24 @@ if __name__ == "__main__":
     options, args = parser.parse_args()
 
     if not options.action:
-        parser.error("Must specify something to do (one of -x, -t, -c)")
+        parser.error("Must specify something to do (one of -x, -t, -c, -V)")
 
     if not args:
         parser.error("You must specify at least a marfile to work with")
 
+    if options.action == "verify":
+        if not options.keyfile:
+            parser.error("Must specify a keyfile to verify with")
+        failed = 0
+        for marname, error in verify_mars(args, options.keyfile,
+                                          options.jobs):
+            if error:
+                failed += 1
+                print "FAILED %s: %s" % (marname, error)
+            else:
+                print "OK %s" % marname
+        sys.exit(failed and 1)
+
     marfile, files = args[0], args[1:]
     marfile = os.path.abspath(marfile)
 
@@ -558,7 +771,7 @@ if __name__ == "__main__":
 
     if options.action == "extract":
         m = mar_class(marfile)
-        m.extractall()
+        m.extractall(jobs=options.jobs)
 
     elif options.action == "list":
         m = mar_class(marfile, signature_versions=signatures)
@@ -572,6 +785,5 @@ if __name__ == "__main__":
         if not files:
             parser.error("Must specify at least one file to add to marfile")
         m = mar_class(marfile, "w", signature_versions=signatures)
-        for f in files:
-            m.add(f)
+        m.add_files(files, jobs=options.jobs)
         m.close()
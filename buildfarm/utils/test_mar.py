@@ -0,0 +1,132 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from unittest import TestCase
+
+from nose.plugins.skip import SkipTest
+
+from mar import MarFile, BZ2MarFile, generate_signature, \
+    generate_signature_data, verify_mars
+
+
+class TestMar(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        for i in range(20):
+            d = os.path.join(self.srcdir, 'dir%d' % (i % 3))
+            if not os.path.exists(d):
+                os.makedirs(d)
+            f = os.path.join(d, 'file%d' % i)
+            open(f, 'wb').write(os.urandom(1000) * (i + 1))
+            os.chmod(f, 0644 if i % 2 else 0755)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _create(self, mar_class, name, jobs):
+        m = mar_class(name, "w")
+        m.add_files(['src'], jobs=jobs)
+        m.close()
+        return open(name, 'rb').read()
+
+    def _assertSameTree(self, dir1, dir2):
+        for root, dirs, files in os.walk(dir1):
+            for f in files:
+                p1 = os.path.join(root, f)
+                p2 = os.path.join(dir2, os.path.relpath(p1, dir1))
+                self.assertEquals(open(p1, 'rb').read(), open(p2, 'rb').read())
+                self.assertEquals(os.stat(p1).st_mode, os.stat(p2).st_mode)
+
+    def testParallelCreateMatchesSerial(self):
+        for mar_class in (MarFile, BZ2MarFile):
+            self.assertEquals(self._create(mar_class, 'serial.mar', 1),
+                              self._create(mar_class, 'parallel.mar', 4))
+
+    def testParallelCreateModeZero(self):
+        f = os.path.join('src', 'dir0', 'file0')
+        os.chmod(f, 0)
+        if not os.access(f, os.R_OK):
+            raise SkipTest("can't read mode 0 files unless we're root")
+        serial = self._create(BZ2MarFile, 'serial.mar', 1)
+        self.assertEquals(self._create(BZ2MarFile, 'parallel.mar', 4),
+                          serial)
+        m = BZ2MarFile('parallel.mar')
+        flags = dict((member.name, member.flags) for member in m.members)
+        m.close()
+        self.assertEquals(flags[f], 0)
+
+    def testParallelExtract(self):
+        for mar_class in (MarFile, BZ2MarFile):
+            self._create(mar_class, 'test.mar', 1)
+            m = mar_class('test.mar')
+            m.extractall('serial')
+            m.extractall('parallel', jobs=4)
+            m.close()
+            self._assertSameTree('src', os.path.join('serial', 'src'))
+            self._assertSameTree('src', os.path.join('parallel', 'src'))
+            shutil.rmtree('serial')
+            shutil.rmtree('parallel')
+
+    def testRead(self):
+        self._create(MarFile, 'test.mar', 1)
+        m = MarFile('test.mar')
+        for member in m.members:
+            self.assertEquals(m.read(member), open(member.name, 'rb').read())
+        m.close()
+
+    def _makeKey(self):
+        devnull = open(os.devnull, 'w')
+        try:
+            if subprocess.call(['openssl', 'genrsa', '-out', 'key.pem',
+                                '2048'], stdout=devnull, stderr=devnull):
+                raise OSError
+            subprocess.check_call(['openssl', 'rsa', '-in', 'key.pem',
+                                   '-pubout', '-out', 'pub.pem'],
+                                  stdout=devnull, stderr=devnull)
+        except OSError:
+            raise SkipTest("openssl isn't available")
+
+    def _createSigned(self, name):
+        m = MarFile(name, "w", signature_versions=[(1, 'key.pem')])
+        m.add_files(['src'])
+        m.close()
+
+    def testSignatureDataMatchesFile(self):
+        self._makeKey()
+        self._createSigned('test.mar')
+        m = MarFile('test.mar')
+        from_file = hashlib.sha1()
+        generate_signature(m.fileobj, from_file.update)
+        from_data = hashlib.sha1()
+        generate_signature_data(m.data, from_data.update)
+        m.close()
+        self.assertEquals(from_file.hexdigest(), from_data.hexdigest())
+
+    def testVerifyMars(self):
+        self._makeKey()
+        for name in ('good1.mar', 'good2.mar', 'bad.mar'):
+            self._createSigned(name)
+        # Flip a byte of the first member
+        m = MarFile('bad.mar')
+        offset = m.members[0]._offset
+        m.close()
+        f = open('bad.mar', 'r+b')
+        f.seek(offset)
+        first = f.read(1)
+        f.seek(offset)
+        f.write(chr(ord(first) ^ 1))
+        f.close()
+        self._create(MarFile, 'unsigned.mar', 1)
+
+        names = ['good1.mar', 'bad.mar', 'unsigned.mar', 'good2.mar']
+        for jobs in (1, 2):
+            results = verify_mars(names, 'pub.pem', jobs=jobs)
+            self.assertEquals([r[0] for r in results], names)
+            self.assertEquals([r[1] is None for r in results],
+                              [True, False, False, True])
@@ -1,12 +1,15 @@
 #!/usr/bin/python
 # vim:sts=2 sw=2
 import sys
+import stat
+import errno
 import shutil
 import urllib2
 import urllib
 import os
 import traceback
 import time
+import cPickle
 if os.name == 'nt':
     from win32file import RemoveDirectory, DeleteFile, \
         GetFileAttributesW, SetFileAttributesW, \
@@ -104,7 +107,115 @@ def rmdirRecursive(dir):
     os.rmdir(dir)
 
 
-def do_clobber(dir, dryrun=False, skip=None):
+# fast_rmtree and start_reaper are copies of the code in
+# buildfarm/maintenance/purge_builds.py.  Both scripts are run on their own,
+# without lib/python, so keep the copies in sync.
+def fast_rmtree(dir):
+    """Delete dir and everything under it, like rmdirRecursive, but
+    without the extra stat and chmod calls for every file.  Permissions are
+    only fixed up when a removal fails, and things that have already gone
+    (e.g., deleted by another reaper) are ignored."""
+    def ignore_missing(func, path):
+        try:
+            func(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def fix_perms(func, path):
+        try:
+            ignore_missing(func, path)
+        except OSError, e:
+            if e.errno not in (errno.EACCES, errno.EPERM):
+                raise
+            os.chmod(os.path.dirname(path), 0700)
+            if not os.path.islink(path):
+                os.chmod(path, 0700)
+            ignore_missing(func, path)
+
+    try:
+        st = os.lstat(dir)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISDIR(st.st_mode):
+        fix_perms(os.remove, dir)
+        return
+
+    # depth-first, without recursion; each directory is removed once the
+    # loop gets back to it with its contents gone
+    stack = [(dir, False)]
+    while stack:
+        d, emptied = stack.pop()
+        if emptied:
+            fix_perms(os.rmdir, d)
+            continue
+        try:
+            names = os.listdir(d)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                continue
+            if e.errno not in (errno.EACCES, errno.EPERM):
+                raise
+            os.chmod(d, 0700)
+            names = os.listdir(d)
+        stack.append((d, True))
+        for name in names:
+            full_name = os.path.join(d, name)
+            try:
+                st = os.lstat(full_name)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            if stat.S_ISDIR(st.st_mode):
+                stack.append((full_name, False))
+            else:
+                fix_perms(os.remove, full_name)
+
+
+def start_reaper(paths):
+    """Delete paths in a detached, low-priority background process, so
+    that the build doesn't have to wait.  Where that's not possible, they're
+    deleted right away."""
+    if not paths:
+        return
+    if os.name == 'nt' or not hasattr(os, 'fork'):
+        for path in paths:
+            rmdirRecursive(path)
+        return
+
+    pid = os.fork()
+    if pid:
+        # wait for the intermediate child, which exits straight away
+        os.waitpid(pid, 0)
+        return
+
+    # in the intermediate child: detach from our session, so that buildbot
+    # doesn't kill the reaper or wait for it when the step ends
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.nice(19)
+        for path in paths:
+            try:
+                fast_rmtree(path)
+            except OSError:
+                pass
+    finally:
+        os._exit(0)
+
+
+def do_clobber(dir, dryrun=False, skip=None, deferred=False):
+    """Delete everything in dir except the names in skip.  With deferred,
+    directories are only renamed here, and deleted by a background process
+    once everything has been renamed."""
+    reap = []
     try:
         for f in os.listdir(dir):
             if skip is not None and f in skip:
@@ -124,7 +235,19 @@ def do_clobber(dir, dryrun=False, skip=None):
                         os.unlink(clobber_path)
             elif os.path.isdir(f):
                 print "Removing %s/" % f
-                if not dryrun:
+                if not dryrun and deferred:
+                    # Prevent repeated moving.
+                    if not f.endswith(clobber_suffix):
+                        if os.path.exists(clobber_path):
+                            # an earlier reaper hasn't finished with it yet;
+                            # it's in os.listdir(dir) too, so it'll be
+                            # reaped again
+                            clobber_path = "%s.%d%s" % (f, time.time(),
+                                                        clobber_suffix)
+                        os.rename(f, clobber_path)
+                        f = clobber_path
+                    reap.append(os.path.abspath(f))
+                elif not dryrun:
                     if os.path.exists(clobber_path):
                         rmdirRecursive(clobber_path)
                     # Prevent repeated moving.
@@ -135,20 +258,87 @@ def do_clobber(dir, dryrun=False, skip=None):
                         rmdirRecursive(clobber_path)
     except:
         print "Couldn't clobber properly, bailing out."
+        start_reaper(reap)
         sys.exit(1)
-
-
-def getClobberDates(clobberURL, branch, buildername, builddir, slave, master):
+    start_reaper(reap)
+
+
+class ClobberCache(object):
+    """The server's answers to previous requests, kept in `filename` between
+    runs, so that unchanged answers can be revalidated with their ETag
+    instead of being sent again.  Answers younger than `ttl` seconds are
+    used without asking the server at all."""
+
+    # forget answers that haven't been used for this long
+    max_age = 7 * 24 * 3600
+
+    def __init__(self, filename, ttl=0):
+        self.filename = filename
+        self.ttl = ttl
+        # url -> (etag, time fetched, data)
+        self.entries = {}
+        if os.path.exists(filename):
+            try:
+                self.entries = cPickle.load(open(filename, 'rb'))
+            except:
+                print "Ignoring unreadable clobber cache %s" % filename
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def put(self, url, etag, data):
+        self.entries[url] = (etag, time.time(), data)
+
+    def save(self):
+        now = time.time()
+        for url, (etag, fetched, data) in self.entries.items():
+            if now - fetched > self.max_age:
+                del self.entries[url]
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'wb')
+        cPickle.dump(self.entries, f, 2)
+        f.close()
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.unlink(self.filename)
+        os.rename(tmp, self.filename)
+
+
+def getClobberDates(clobberURL, branch, buildername, builddir, slave, master,
+                    cache=None):
     params = dict(branch=branch, buildername=buildername,
                   builddir=builddir, slave=slave, master=master)
     url = "%s?%s" % (clobberURL, urllib.urlencode(params))
-    print "Checking clobber URL: %s" % url
-    # The timeout arg was added to urlopen() at Python 2.6
-    # Deprecate this test when esr17 reaches EOL
-    if sys.version_info[:2] < (2, 6):
-        data = urllib2.urlopen(url).read().strip()
-    else:
-        data = urllib2.urlopen(url, timeout=30).read().strip()
+
+    entry = None
+    data = None
+    if cache:
+        entry = cache.get(url)
+        if entry and cache.ttl and time.time() - entry[1] < cache.ttl:
+            print "Using cached clobber dates for %s" % url
+            data = entry[2]
+
+    if data is None:
+        print "Checking clobber URL: %s" % url
+        request = urllib2.Request(url)
+        if entry and entry[0]:
+            request.add_header('If-None-Match', entry[0])
+        try:
+            # The timeout arg was added to urlopen() at Python 2.6
+            # Deprecate this test when esr17 reaches EOL
+            if sys.version_info[:2] < (2, 6):
+                response = urllib2.urlopen(request)
+            else:
+                response = urllib2.urlopen(request, timeout=30)
+            data = response.read()
+            etag = response.info().getheader('ETag')
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not entry:
+                raise
+            print "Clobber dates unchanged"
+            etag, data = entry[0], entry[2]
+        if cache:
+            cache.put(url, etag, data)
+    data = data.strip()
 
     retval = {}
     try:
@@ -177,6 +367,19 @@ if __name__ == "__main__":
                       action='append', dest='skip', default=['last-clobber'])
     parser.add_option('-d', '--dir', help='clobber this directory',
                       dest='dir', default='.', type='string')
+    parser.add_option('--deferred', dest='deferred', action='store_true',
+                      default=False,
+                      help="only rename directories to *.deleteme, and delete "
+                      "them in a background process")
+    parser.add_option('--cache-file', dest='cache_file',
+                      default=os.path.expanduser('~/.clobberer_cache'),
+                      help="file to keep the server's answers in, so that "
+                      "unchanged answers aren't sent again")
+    parser.add_option('--cache-ttl', dest='cache_ttl', type='int', default=0,
+                      help="use cached answers up to this many seconds old "
+                      "without asking the server at all.  Note that the "
+                      "server won't see those builds, and forced clobbers "
+                      "can take this long to be noticed (default 0)")
     parser.add_option('-v', '--verbose', help='be more verbose',
                       dest='verbose', action='store_true', default=False)
 
@@ -191,9 +394,23 @@ if __name__ == "__main__":
 
     clobberURL, branch, builder, my_builddir, slave, master = args
 
+    cache = None
+    if options.cache_file:
+        try:
+            cache = ClobberCache(os.path.abspath(options.cache_file),
+                                 options.cache_ttl)
+        except:
+            if options.verbose:
+                traceback.print_exc()
+
     try:
         server_clobber_dates = getClobberDates(
-            clobberURL, branch, builder, my_builddir, slave, master)
+            clobberURL, branch, builder, my_builddir, slave, master, cache)
+        if cache:
+            try:
+                cache.save()
+            except (IOError, OSError):
+                print "Couldn't save clobber cache %s" % cache.filename
     except:
         if options.verbose:
             traceback.print_exc()
@@ -270,7 +487,8 @@ if __name__ == "__main__":
         if clobber:
             # Finally, perform a clobber if we're supposed to
             print "%s:Clobbering..." % builddir
-            do_clobber(builder_dir, options.dryrun, options.skip)
+            do_clobber(builder_dir, options.dryrun, options.skip,
+                       options.deferred)
             write_file(our_clobber_date, "last-clobber")
 
         # If this is the build dir for the current job, display the clobber type in TBPL.
@@ -85,13 +85,15 @@ function getBuilders($slave)
   global $dbh;
   $slave = e($slave);
   $retval = array();
-  $builders = $dbh->query("SELECT DISTINCT builddir from builds where slave=$slave");
-  while ($r = $builders->fetch(PDO::FETCH_ASSOC)) {
-    // Find the most recent build for this builder
-    $builddir = e($r['builddir']);
-    $build = $dbh->query("SELECT buildername, builddir, branch FROM builds WHERE builddir = $builddir ORDER by last_build_time DESC LIMIT 1");
-    $r = $build->fetch(PDO::FETCH_ASSOC);
-    if ($r) {
+  // Find the most recent build for each of this slave's builddirs, all in
+  // one query
+  $builds = $dbh->query("SELECT buildername, builddir, branch FROM builds "
+      ."WHERE builddir IN (SELECT DISTINCT builddir FROM builds WHERE slave=$slave) "
+      ."ORDER BY last_build_time DESC");
+  $seen = array();
+  while ($r = $builds->fetch(PDO::FETCH_ASSOC)) {
+    if (!array_key_exists($r['builddir'], $seen)) {
+      $seen[$r['builddir']] = 1;
       $retval[] = $r;
     }
   }
@@ -591,13 +593,26 @@ foreach ($slave_builders as $sb) {
 }
 
 // Tell the slave what to clobber
+$body = '';
 foreach ($clobber_times as $b => $r) {
   $lastclobber = $r['lastclobber'];
   $who = $r['who'];
-  print "$b:$lastclobber:$who\n";
+  $body .= "$b:$lastclobber:$who\n";
 }
 
-// Finally, update our table of when builds are happening
+// Update our table of when builds are happening; this has to happen even if
+// the slave already has the answer
 $new = updateBuildTime($master, $branch, $buildername, $builddir, $slave);
 
+// Slaves that send back the ETag of the last answer they got only get a body
+// if something changed
+$etag = '"' . md5($body) . '"';
+header("ETag: $etag");
+header("Cache-Control: no-cache");
+if (trim(array_get($_SERVER, 'HTTP_IF_NONE_MATCH')) == $etag) {
+  header('HTTP/1.1 304 Not Modified');
+  exit(0);
+}
+print $body;
+
 ?>
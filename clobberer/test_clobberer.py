@@ -4,8 +4,15 @@ import sqlite3
 import os
 import subprocess
 import urllib
+import urllib2
 import time
 import shutil
+import errno
+import tempfile
+
+import mock
+
+import clobberer
 
 ###
 # For testing, update the values below to be suitable to your testing
@@ -128,7 +135,8 @@ def runClobberer(branch, buildername, builddir, slave, master, periodic=None,
     """Run the clobberer.py script, and return the output"""
     if not os.path.exists(testDir):
         os.makedirs(testDir)
-    cmd = ['python', os.path.abspath('clobberer.py'), '-v']
+    cmd = ['python', os.path.abspath('clobberer.py'), '-v',
+           '--cache-file', 'clobberer-cache']
     if periodic:
         cmd.extend(['-t', str(periodic)])
     if dry_run:
@@ -179,6 +187,31 @@ class TestClobber(TestCase):
                           "mybuilder2", "slave01")
                           )
 
+    def testConditionalGet(self):
+        # Test that an unchanged answer isn't sent again
+        now = int(time.time())
+        setClobber("branch1", "mybuilder", "slave01", None, now)
+        params = dict(branch="branch1", buildername="My Builder",
+                      builddir="mybuilder", slave="slave01", master="master01")
+        url = "%s?%s" % (clobberURL, urllib.urlencode(params))
+        response = urllib2.urlopen(url)
+        etag = response.info().getheader('ETag')
+        self.assert_(etag)
+        self.assert_('mybuilder:%d:testuser' % now in response.read())
+
+        request = urllib2.Request(url)
+        request.add_header('If-None-Match', etag)
+        try:
+            urllib2.urlopen(request)
+            self.fail("expected a 304")
+        except urllib2.HTTPError, e:
+            self.assertEquals(e.code, 304)
+
+        # A new clobber changes the answer
+        setClobber("branch1", "mybuilder", "slave01", None, now + 1)
+        response = urllib2.urlopen(request)
+        self.assertNotEquals(response.info().getheader('ETag'), etag)
+
     def testUpdateBuildWithClobber(self):
         # Test that build entries are getting into the DB properly
         # this time when a clobber is set
@@ -441,3 +474,83 @@ if __name__ == '__main__':
         print "Usage: %s [clobberURL dbFile]" % sys.argv[0]
         sys.exit(1)
     unittest.main()
+
+
+class TestDoClobber(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        # do_clobber works on names relative to the current directory
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _makeDir(self, name):
+        os.makedirs(os.path.join(name, 'sub'))
+        open(os.path.join(name, 'sub', 'file'), 'w').write('data')
+
+    def _clobber(self, **kwargs):
+        """Run a deferred do_clobber, and return the paths handed to the
+        reaper"""
+        with mock.patch.object(clobberer, 'start_reaper') as start_reaper:
+            clobberer.do_clobber('.', deferred=True, **kwargs)
+        self.assertEquals(start_reaper.call_count, 1)
+        return sorted(start_reaper.call_args[0][0])
+
+    def _waitForDeletion(self, path):
+        for i in range(100):
+            if not os.path.exists(path):
+                return
+            time.sleep(0.1)
+        self.fail("%s wasn't deleted" % path)
+
+    def testDeferred(self):
+        self._makeDir('build')
+        self._makeDir('tools')
+        open('last-clobber', 'w').write('0')
+        reaped = self._clobber(skip=['tools'])
+        # directories are only renamed; files are removed straight away
+        self.assertEquals(sorted(os.listdir('.')),
+                          ['build.deleteme', 'tools'])
+        self.assertEquals(reaped, [os.path.abspath('build.deleteme')])
+
+    def testDeferredEarlierLeftovers(self):
+        # a .deleteme from a run whose reaper didn't finish
+        self._makeDir('build.deleteme')
+        self._makeDir('build')
+        with mock.patch.object(clobberer.time, 'time', return_value=1234.5):
+            reaped = self._clobber()
+        self.assertEquals(sorted(os.listdir('.')),
+                          ['build.1234.deleteme', 'build.deleteme'])
+        self.assertEquals(reaped, [os.path.abspath('build.1234.deleteme'),
+                                   os.path.abspath('build.deleteme')])
+
+    def testDeferredFailure(self):
+        self._makeDir('a')
+        self._makeDir('b')
+        rename = os.rename
+
+        def failing_rename(src, dst):
+            if src == 'b':
+                raise OSError(errno.EACCES, "Permission denied")
+            rename(src, dst)
+
+        with mock.patch.object(clobberer, 'start_reaper') as start_reaper, \
+                mock.patch.object(clobberer.os, 'listdir',
+                                  return_value=['a', 'b']), \
+                mock.patch.object(clobberer.os, 'rename', failing_rename):
+            self.assertRaises(SystemExit, clobberer.do_clobber, '.',
+                              deferred=True)
+        # what was renamed before the failure is still reaped
+        start_reaper.assert_called_once_with(
+            [os.path.abspath('a.deleteme')])
+        self.assertTrue(os.path.isdir('b'))
+
+    def testDeferredReaped(self):
+        self._makeDir('build')
+        os.chmod(os.path.join('build', 'sub'), 0500)
+        clobberer.do_clobber('.', deferred=True)
+        self._waitForDeletion('build.deleteme')
+        self.assertEquals(os.listdir('.'), [])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Request latency benchmark for the graphserver webapp.
+
+This fills a scratch sqlite database with branches and machines, then times
+requests for the branch and machine lists and the index page.  With
+--uncached, the engine is thrown away before each request, as the app used to
+do, so the two modes can be compared:
+
+    python benchmark.py --uncached
+    python benchmark.py
+"""
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import optparse
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+
+def populate(dbfile, count):
+    db = sqlite3.connect(dbfile)
+    db.executescript(open(os.path.join(here, 'test', 'test_db.sql')).read())
+    db.executemany('INSERT INTO branches (name) VALUES (?)',
+                   [('branch%d' % i,) for i in range(count)])
+    db.executemany('INSERT INTO machines (os_id, cpu_speed, name, '
+                   'date_added) VALUES (1, "2.0", ?, 0)',
+                   [('machine%d' % i,) for i in range(count)])
+    db.commit()
+    db.close()
+
+
+def main():
+    parser = optparse.OptionParser(__doc__.strip())
+    parser.add_option("--rows", type="int", default=200,
+                      help="number of branches and of machines")
+    parser.add_option("--requests", type="int", default=500,
+                      help="number of requests for each URL")
+    parser.add_option("--uncached", action="store_true",
+                      help="set up the engine and reflect the tables on "
+                      "every request")
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # graphserver opens its logfile in the current directory
+        os.chdir(tmpdir)
+        dbfile = os.path.join(tmpdir, 'graphserver.sqlite')
+        populate(dbfile, options.rows)
+
+        import graphserver
+        app = graphserver.app
+        app.config['DATABASE_URI'] = 'sqlite:///%s' % dbfile
+        if options.uncached:
+            def reset_engine():
+                app.engine = None
+            app.before_request_funcs.setdefault(None, []).insert(
+                0, reset_engine)
+        client = app.test_client()
+
+        for url in ('/branches?format=json', '/machines?format=json', '/'):
+            times = []
+            for i in range(options.requests):
+                start = time.time()
+                client.get(url)
+                times.append(time.time() - start)
+            times.sort()
+            print "%-24s p50 %6.2fms  p95 %6.2fms" % (
+                url, times[len(times) / 2] * 1000,
+                times[int(len(times) * 0.95)] * 1000)
+    finally:
+        os.chdir(here)
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@ class Config(object):
     TESTING = False
     DATABASE_URI = 'sqlite:///:memory:'
     VERSION = 'Default'
+    # seconds to cache the branch and machine lists for
+    CACHE_TIMEOUT = 60
 
 
 class TestConfig(object):
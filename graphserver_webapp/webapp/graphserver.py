@@ -1,6 +1,6 @@
 import sqlite3
 import time
-from flask import Flask, request, redirect, url_for, jsonify
+from flask import Flask, request, redirect, url_for, jsonify, g
 from flask import abort, render_template, flash
 from contextlib import closing
 from sqlalchemy import create_engine, MetaData, Table
@@ -19,13 +19,71 @@ handler.setFormatter(format)
 app.logger.addHandler(handler)
 
 
+app.engine = None
+# cached branch and machine lists, and their JSON renderings:
+# key -> (time, value)
+app.cache = {}
+
+
 def init_db():
-    app.engine = create_engine(
-        app.config['DATABASE_URI'], convert_unicode=True)
+    """Create the engine, with its connection pool, and reflect the tables.
+    This only does any work the first time, or if DATABASE_URI changes."""
+    uri = app.config['DATABASE_URI']
+    if app.engine is not None and app.engine_uri == uri:
+        return
+    # MySQL drops connections that have been idle for a while, so don't
+    # keep pooled connections around for too long
+    app.engine = create_engine(uri, convert_unicode=True, pool_recycle=3600)
+    app.engine_uri = uri
     app.metadata = MetaData(bind=app.engine)
-    app.con = app.engine.connect()
     app.branches = Table('branches', app.metadata, autoload=True)
     app.machines = Table('machines', app.metadata, autoload=True)
+    invalidate_cache()
+
+
+def invalidate_cache():
+    app.cache.clear()
+
+
+def cached(key, func):
+    """Return the cached value for key, calling func to (re)compute it if it
+    is missing or older than CACHE_TIMEOUT seconds.  The timeout picks up
+    changes made by other processes; changes made here invalidate the cache
+    right away."""
+    now = time.time()
+    entry = app.cache.get(key)
+    if entry is None or now - entry[0] > app.config.get('CACHE_TIMEOUT', 60):
+        entry = app.cache[key] = (now, func())
+    return entry[1]
+
+
+def branch_list():
+    return cached('branches', lambda:
+                  g.con.execute(app.branches.select()).fetchall())
+
+
+def machine_list():
+    return cached('machines', lambda:
+                  g.con.execute(app.machines.select()).fetchall())
+
+
+def json_response(key, func):
+    "Return a JSON response for func's result, caching the rendering"
+    body = cached(key + '.json', lambda: jsonify(func()).data)
+    return app.response_class(body, mimetype='application/json')
+
+
+def branches_json():
+    return json_response('branches', branch_list)
+
+
+def machines_json():
+    def machines():
+        machines = {}
+        for r in machine_list():
+            machines[r[0]] = r[4]
+        return machines
+    return json_response('machines', machines)
 
 
 def is_json():
@@ -39,20 +97,23 @@ def is_json():
 @app.before_request
 def before_request():
     init_db()
+    # check out a connection from the pool for this request
+    g.con = app.engine.connect()
 
 
 @app.teardown_request
 def teardown_request(exception):
-    pass
+    # and return it to the pool
+    con = getattr(g, 'con', None)
+    if con is not None:
+        con.close()
 
 
 @app.route('/')
 def show_entries():
-    branch_list = app.engine.execute('select * from branches')
-    machine_list = app.engine.execute('select * from machines')
     version = app.config['VERSION']
-    return render_template('show_entries.html', branch_list=branch_list,
-                           machine_list=machine_list, version=version)
+    return render_template('show_entries.html', branch_list=branch_list(),
+                           machine_list=machine_list(), version=version)
 
 
 @app.route('/branches', methods=['POST'])
@@ -60,7 +121,7 @@ def update_branches():
     if request.form.get('_method') == "delete":
         delete_branch(request.form['id'], request.form['branch_name'])
     else:
-        exists = app.con.execute(app.branches.select(
+        exists = g.con.execute(app.branches.select(
         ).where(app.branches.c.name == request.form['branch_name']))
         if exists.fetchone() != None:
             flash('Branch name "%s" exists, please enter a unique name' %
@@ -70,25 +131,27 @@ def update_branches():
             flash('Branch name cannot be blank')
             app.logger.warning('Branch name cannot be blank')
         else:
-            results = app.con.execute(
+            results = g.con.execute(
                 app.branches.insert(), name=request.form['branch_name'])
+            invalidate_cache()
             flash('New branch "%s" was successfully added' %
                   request.form['branch_name'])
             app.logger.info('New branch "%s" was successfully added' %
                             request.form['branch_name'])
 
     if is_json():
-        return jsonify(app.branches.select().execute().fetchall())
+        return branches_json()
     return redirect(url_for('show_entries'))
 
 
 @app.route('/branches', methods=['DELETE'])
 def delete_branch(id, branch_name):
-    exists = app.con.execute(
+    exists = g.con.execute(
         app.branches.select().where(app.branches.c.id == id))
     if exists.returns_rows:
-        results = app.con.execute(
+        results = g.con.execute(
             app.branches.delete().where(app.branches.c.id == id))
+        invalidate_cache()
         flash('Branch "%s" was successfully deleted' % branch_name)
         app.logger.info('Branch "%s" was successfully deleted' % branch_name)
 
@@ -96,7 +159,7 @@ def delete_branch(id, branch_name):
 @app.route('/branches', methods=['GET'])
 def get_branches():
     if is_json():
-        return jsonify(app.branches.select().execute().fetchall())
+        return branches_json()
     return redirect(url_for('show_entries'))
 
 
@@ -108,7 +171,7 @@ def update_machines():
         errors = False
         for key, value in request.form.items():
             if key == 'machine_name':
-                exists = app.con.execute(app.machines.select().where(
+                exists = g.con.execute(app.machines.select().where(
                     app.machines.c.name == request.form['machine_name']))
                 if exists.fetchone() != None:
                     flash('Machine name "%s" exists, please enter a unique name' % request.form['machine_name'])
@@ -126,7 +189,7 @@ def update_machines():
                     app.logger.warning('"%s" must be a numeric value' % key)
                     errors = True
         if not errors:
-            results = app.con.execute(
+            results = g.con.execute(
                 app.machines.insert(),
                 os_id=int(request.form['os_id']),
                 is_throttling=int(request.form['is_throttling']),
@@ -135,26 +198,24 @@ def update_machines():
                 is_active=int(request.form['is_active']),
                 date_added=int(time.time())
             )
+            invalidate_cache()
             flash('New machine "%s" was successfully added' %
                   request.form['machine_name'])
             app.logger.info('New machine "%s" was successfully added' %
                             request.form['machine_name'])
     if is_json():
-        machines = {}
-        results = app.machines.select().execute().fetchall()
-        for r in results:
-            machines[r[0]] = r[4]
-        return jsonify(machines)
+        return machines_json()
     return redirect(url_for('show_entries'))
 
 
 @app.route('/machines', methods=['DELETE'])
 def delete_machine(id, machine_name):
-    exists = app.con.execute(
+    exists = g.con.execute(
         app.machines.select().where(app.machines.c.id == id))
     if exists.returns_rows:
-        results = app.con.execute(
+        results = g.con.execute(
             app.machines.delete().where(app.machines.c.id == id))
+        invalidate_cache()
         flash('Machine "%s" was successfully deleted' % machine_name)
         app.logger.info('Machine "%s" was successfully deleted' % machine_name)
 
@@ -162,11 +223,7 @@ def delete_machine(id, machine_name):
 @app.route('/machines', methods=['GET'])
 def get_machines():
     if is_json():
-        machines = {}
-        results = app.machines.select().execute().fetchall()
-        for r in results:
-            machines[r[0]] = r[4]
-        return jsonify(machines)
+        return machines_json()
     return redirect(url_for('show_entries'))
 
 if __name__ == '__main__':
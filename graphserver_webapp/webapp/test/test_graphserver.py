@@ -34,6 +34,28 @@ class GraphserverTestCase(unittest.TestCase):
         results = json.loads(resp.data)
         assert results['1'] == 'new_branch'
 
+    def test_cached_branches_json(self):
+        resp = self.app.get('/branches?format=json')
+        results_pre = json.loads(resp.data)
+        engine = graphserver.app.engine
+        rv = self.app.post('/branches', data=dict(
+            branch_name='cached_branch',
+            _method='insert'
+        ))
+        resp = self.app.get('/branches?format=json')
+        results = json.loads(resp.data)
+        assert 'cached_branch' in results.values()
+        branch_id = [k for k, v in results.items() if v == 'cached_branch'][0]
+        rv = self.app.post('/branches', data=dict(
+            id=branch_id,
+            branch_name='cached_branch',
+            _method='delete'
+        ))
+        resp = self.app.get('/branches?format=json')
+        assert json.loads(resp.data) == results_pre
+        # the engine is only set up once
+        assert graphserver.app.engine is engine
+
     def test_delete_branch(self):
         rv = self.app.post('/branches', data=dict(
             id=1,
@@ -4,6 +4,8 @@ import os
 from os import path
 import shutil
 import sys
+import tempfile
+import threading
 from urllib import urlretrieve
 from urllib2 import urlopen
 from urlparse import urljoin
@@ -11,6 +13,7 @@ from urlparse import urljoin
 from release.platforms import getPlatformLocales, buildbot2ftp
 from release.paths import makeCandidatesDir
 from util.commands import get_output, run_cmd
+from util.file import sha1sum
 from util.hg import mercurial, update
 from util.paths import windows2msys, msys2windows
 from util.retry import retry
@@ -96,12 +99,119 @@ def l10nRepackPrep(sourceRepoName, objdir, mozconfigPath, srcMozconfigPath,
                     env=env)
 
 
+def runInThreads(func, argsList):
+    """Call func(*args) for each of argsList, each in a thread of its own,
+    and wait for them all to finish. If any of them raised an exception,
+    the first one is re-raised."""
+    errors = []
+
+    def run(args):
+        try:
+            func(*args)
+        except:
+            errors.append(sys.exc_info())
+
+    if len(argsList) == 1:
+        func(*argsList[0])
+        return
+    threads = [threading.Thread(target=run, args=(args,))
+               for args in argsList]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+class UpdateCache(object):
+    """Previous releases' complete MARs, and the trees they unwrap to, shared
+    between the partials and locales of a parallel repack.
+
+    Everything is kept under `cacheDir`, so a rerun of the same job reuses
+    what an earlier one fetched. The methods are thread-safe, and two threads
+    asking for the same thing wait for a single download or unwrap."""
+
+    def __init__(self, cacheDir):
+        self.cacheDir = path.abspath(cacheDir)
+        for d in ('mars', 'unwrapped'):
+            if not path.isdir(path.join(self.cacheDir, d)):
+                os.makedirs(path.join(self.cacheDir, d))
+        self._lock = threading.Lock()
+        self._keyLocks = {}
+        # MARs that don't exist upstream, e.g. for new locales
+        self._missing = set()
+
+    def _keyLock(self, key):
+        with self._lock:
+            return self._keyLocks.setdefault(key, threading.Lock())
+
+    def downloadUpdate(self, stageServer, productName, version, buildNumber,
+                       platform, locale):
+        """Return the path to the complete MAR for locale in the given
+        release, downloading it if needed; or None if it doesn't exist."""
+        # release.download imports us, by way of release.l10n
+        from release.download import downloadUpdateIgnore404
+        fileName = path.join(self.cacheDir, 'mars',
+                             '%s-%s-build%s.%s.%s.complete.mar' % (
+                                 productName, version, buildNumber, platform,
+                                 locale))
+        with self._keyLock(fileName):
+            if path.exists(fileName):
+                return fileName
+            if fileName in self._missing:
+                return None
+            # Download somewhere private, so that an interrupted download is
+            # never mistaken for a cached MAR
+            tmpDir = tempfile.mkdtemp(dir=self.cacheDir)
+            try:
+                mar = retry(downloadUpdateIgnore404,
+                            args=(stageServer, productName, version,
+                                  buildNumber, platform, locale),
+                            kwargs={'destDir': tmpDir})
+                if mar is None:
+                    self._missing.add(fileName)
+                    return None
+                os.rename(mar, fileName)
+            finally:
+                shutil.rmtree(tmpDir)
+        return fileName
+
+    def unwrap(self, mar, unwrapScript, env):
+        """Return a directory with the contents of the complete MAR `mar`,
+        unwrapping it with `unwrapScript` unless an identical MAR has been
+        unwrapped already. The directory is shared, so callers must not
+        modify it."""
+        with self._keyLock(mar):
+            treeDir = path.join(self.cacheDir, 'unwrapped', sha1sum(mar))
+        with self._keyLock(treeDir):
+            if not path.isdir(treeDir):
+                tmpDir = tempfile.mkdtemp(dir=self.cacheDir)
+                try:
+                    run_cmd(['perl', unwrapScript, mar], cwd=tmpDir, env=env)
+                    os.rename(tmpDir, treeDir)
+                except:
+                    shutil.rmtree(tmpDir, ignore_errors=True)
+                    raise
+        return treeDir
+
+
 def repackLocale(locale, l10nRepoDir, l10nBaseRepo, revision, localeSrcDir,
                  l10nIni, compareLocalesRepo, env, absObjdir, merge=True,
                  productName=None, platform=None,
                  version=None, partialUpdates=None,
                  buildNumber=None, stageServer=None,
-                 mozillaDir=None, mozillaSrcDir=None):
+                 mozillaDir=None, mozillaSrcDir=None,
+                 updateCache=None, makeLock=None):
+    # Several locales may be repacked at once in the same objdir: anything
+    # that runs make there, or touches shared files, holds makeLock.  With an
+    # updateCache, partialUpdates[...]['mar'] are paths into the cache, and
+    # the complete MAR for this locale is unwrapped into a directory of its
+    # own.
+    if makeLock is None:
+        makeLock = threading.Lock()
+    env = env.copy()
+
     repo = "/".join([l10nBaseRepo, locale])
     localeDir = path.join(l10nRepoDir, locale)
     retry(mercurial, args=(repo, localeDir))
@@ -135,8 +245,10 @@ def repackLocale(locale, l10nRepoDir, l10nBaseRepo, revision, localeSrcDir,
     if platform.startswith('win'):
         mar += ".exe"
         mbsdiff += ".exe"
-    current = '%s/current' % posixDistDir
-    previous = '%s/previous' % posixDistDir
+    currentName = 'current'
+    if updateCache:
+        currentName = 'current-%s' % locale
+    current = '%s/%s' % (posixDistDir, currentName)
     updateDir = 'update/%s/%s' % (buildbot2ftp(platform), locale)
     updateAbsDir = '%s/%s' % (posixDistDir, updateDir)
     current_mar = '%s/%s-%s.complete.mar' % (
@@ -151,40 +263,45 @@ def repackLocale(locale, l10nRepoDir, l10nBaseRepo, revision, localeSrcDir,
     env['MAR'] = mar
     env['MBSDIFF'] = mbsdiff
 
-    log.info("Download mar tools")
-    if stageServer:
-        candidates_dir = makeCandidatesDir(productName, version, buildNumber,
-                                           protocol="http", server=stageServer)
-        if not path.isfile(msys2windows(mar)):
-            marUrl = "%(c_dir)s/mar-tools/%(platform)s/%(mar)s" % \
-                dict(c_dir=candidates_dir, platform=platform,
-                     mar=path.basename(mar))
-            run_cmd(['mkdir', '-p', path.dirname(mar)])
-            log.info("Downloading %s to %s", marUrl, mar)
-            urlretrieve(marUrl, msys2windows(mar))
-            if not sys.platform.startswith('win'):
-                run_cmd(['chmod', '755', mar])
-        if not path.isfile(msys2windows(mbsdiff)):
-            mbsdiffUrl = "%(c_dir)s/mar-tools/%(platform)s/%(mbsdiff)s" % \
-                dict(c_dir=candidates_dir, platform=platform,
-                     mbsdiff=path.basename(mbsdiff))
-            run_cmd(['mkdir', '-p', path.dirname(mbsdiff)])
-            log.info("Downloading %s to %s", mbsdiffUrl, mbsdiff)
-            urlretrieve(mbsdiffUrl, msys2windows(mbsdiff))
-            if not sys.platform.startswith('win'):
-                run_cmd(['chmod', '755', mbsdiff])
-    else:
-        log.warning('stageServer not set. mar tools will *not* be downloaded.')
+    with makeLock:
+        log.info("Download mar tools")
+        if stageServer:
+            candidates_dir = makeCandidatesDir(productName, version, buildNumber,
+                                               protocol="http", server=stageServer)
+            if not path.isfile(msys2windows(mar)):
+                marUrl = "%(c_dir)s/mar-tools/%(platform)s/%(mar)s" % \
+                    dict(c_dir=candidates_dir, platform=platform,
+                         mar=path.basename(mar))
+                run_cmd(['mkdir', '-p', path.dirname(mar)])
+                log.info("Downloading %s to %s", marUrl, mar)
+                urlretrieve(marUrl, msys2windows(mar))
+                if not sys.platform.startswith('win'):
+                    run_cmd(['chmod', '755', mar])
+            if not path.isfile(msys2windows(mbsdiff)):
+                mbsdiffUrl = "%(c_dir)s/mar-tools/%(platform)s/%(mbsdiff)s" % \
+                    dict(c_dir=candidates_dir, platform=platform,
+                         mbsdiff=path.basename(mbsdiff))
+                run_cmd(['mkdir', '-p', path.dirname(mbsdiff)])
+                log.info("Downloading %s to %s", mbsdiffUrl, mbsdiff)
+                urlretrieve(mbsdiffUrl, msys2windows(mbsdiff))
+                if not sys.platform.startswith('win'):
+                    run_cmd(['chmod', '755', mbsdiff])
+        else:
+            log.warning('stageServer not set. mar tools will *not* be downloaded.')
 
-    compareLocales(compareLocalesRepo, locale, l10nRepoDir, localeSrcDir,
-                   l10nIni, revision=revision, merge=merge)
-    run_cmd(make + ["installers-%s" % locale], cwd=localeSrcDir, env=env)
+        compareLocales(compareLocalesRepo, locale, l10nRepoDir, localeSrcDir,
+                       l10nIni, revision=revision, merge=merge)
+        run_cmd(make + ["installers-%s" % locale], cwd=localeSrcDir, env=env)
 
     # Our Windows-native rm from bug 727551 requires Windows-style paths
     run_cmd(['rm', '-rf', msys2windows(current)])
     run_cmd(['mkdir', current])
     run_cmd(['perl', unwrap_full_update, current_mar],
-            cwd=path.join(nativeDistDir, 'current'), env=env)
+            cwd=path.join(nativeDistDir, currentName), env=env)
+    if updateCache:
+        unwrapScript = path.normpath(
+            path.join(nativeDistDir, 'current', unwrap_full_update))
+    partials = []
     for oldVersion in partialUpdates:
         prevMar = partialUpdates[oldVersion]['mar']
         if prevMar:
@@ -192,45 +309,70 @@ def repackLocale(locale, l10nRepoDir, l10nBaseRepo, revision, localeSrcDir,
                                                          version)
             partial_mar = '%s/%s' % (updateAbsDir, partial_mar_name)
             UPLOAD_EXTRA_FILES.append('%s/%s' % (updateDir, partial_mar_name))
-            # Our Windows-native rm from bug 727551 requires Windows-style paths
-            run_cmd(['rm', '-rf', msys2windows(previous)])
-            run_cmd(['mkdir', previous])
-            run_cmd(
-                ['perl', unwrap_full_update, '%s/%s' % (prevMarDir, prevMar)],
-                cwd=path.join(nativeDistDir, 'previous'), env=env)
-            run_cmd(['bash', make_incremental_update, partial_mar, previous,
-                    current], cwd=nativeDistDir, env=env)
-            if os.environ.get('MOZ_SIGN_CMD'):
-                run_cmd(['bash', '-c',
-                        '%s -f mar -f gpg "%s"' %
-                        (os.environ['MOZ_SIGN_CMD'], partial_mar)],
-                        env=env)
-                UPLOAD_EXTRA_FILES.append(
-                    '%s/%s.asc' % (updateDir, partial_mar_name))
+            partials.append((oldVersion, prevMar, partial_mar))
         else:
             log.warning(
                 "Skipping partial MAR creation for %s %s" % (oldVersion,
                                                              locale))
 
+    def makePartial(oldVersion, prevMar, partial_mar):
+        if updateCache:
+            previousTree = updateCache.unwrap(prevMar, unwrapScript, env)
+        else:
+            # Each old version is unwrapped into a directory of its own, so
+            # that the partials can be made at the same time
+            previousName = 'previous-%s' % oldVersion
+            previousTree = '%s/%s' % (posixDistDir, previousName)
+            # Our Windows-native rm from bug 727551 requires Windows-style
+            # paths
+            run_cmd(['rm', '-rf', msys2windows(previousTree)])
+            run_cmd(['mkdir', previousTree])
+            run_cmd(
+                ['perl', unwrap_full_update, '%s/%s' % (prevMarDir, prevMar)],
+                cwd=path.join(nativeDistDir, previousName), env=env)
+        # make_incremental_update.sh keeps its scratch files next to the new
+        # tree, in "$newdir.work", so partials made at the same time each
+        # need a copy of the new tree of their own
+        newTree = current
+        if len(partials) > 1:
+            newTree = '%s-%s' % (current, oldVersion)
+            run_cmd(['rm', '-rf', msys2windows(newTree)])
+            run_cmd(['cp', '-rp', current, newTree])
+        run_cmd(['bash', make_incremental_update, partial_mar, previousTree,
+                newTree], cwd=nativeDistDir, env=env)
+        if newTree != current:
+            run_cmd(['rm', '-rf', msys2windows(newTree)])
+    runInThreads(makePartial, partials)
+
+    if partials and os.environ.get('MOZ_SIGN_CMD'):
+        # Sign all the partials in one go
+        run_cmd(['bash', '-c',
+                '%s -f mar -f gpg %s' %
+                (os.environ['MOZ_SIGN_CMD'],
+                 ' '.join('"%s"' % p[2] for p in partials))],
+                env=env)
+        UPLOAD_EXTRA_FILES.extend(['%s/%s.asc' % (updateDir,
+                                                  path.basename(p[2]))
+                                   for p in partials])
+    if updateCache:
+        run_cmd(['rm', '-rf', msys2windows(current)])
+
     env['UPLOAD_EXTRA_FILES'] = ' '.join(UPLOAD_EXTRA_FILES)
-    retry(run_cmd,
-          args=(make + ["upload", "AB_CD=%s" % locale], ),
-          kwargs={'cwd': localeSrcDir, 'env': env})
-
-    # return the location of the checksums file, because consumers may want
-    # some information about the files that were generated.
-    # Some versions of make that we use (at least pymake) imply --print-directory
-    # We need to turn it off to avoid getting extra output that mess up our
-    # parsing of the checksum file path.
-    curdir = os.getcwd()
-    try:
-        os.chdir(localeSrcDir)
+    with makeLock:
+        retry(run_cmd,
+              args=(make + ["upload", "AB_CD=%s" % locale], ),
+              kwargs={'cwd': localeSrcDir, 'env': env})
+
+        # return the location of the checksums file, because consumers may
+        # want some information about the files that were generated.
+        # Some versions of make that we use (at least pymake) imply
+        # --print-directory. We need to turn it off to avoid getting extra
+        # output that mess up our parsing of the checksum file path.
         relative_checksums = get_output(make +
                                         ["--no-print-directory", "echo-variable-CHECKSUM_FILE", "AB_CD=%s" % locale],
+                                        cwd=localeSrcDir,
                                         env=env).strip("\"'\n")
-        return path.normpath(path.join(localeSrcDir, relative_checksums))
-    finally:
-        os.chdir(curdir)
+    return path.normpath(path.join(localeSrcDir, relative_checksums))
 
 
 def getLocalesForChunk(possibleLocales, chunks, thisChunk):
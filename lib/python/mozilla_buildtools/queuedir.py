@@ -4,6 +4,10 @@ Implement an on-disk queue for stuff
 import os
 import tempfile
 import time
+import heapq
+import bisect
+import math
+import random
 import logging
 log = logging.getLogger(__name__)
 
@@ -11,18 +15,49 @@ try:
     import pyinotify
     assert pyinotify
 
-    class _MovedHandler(pyinotify.ProcessEvent):
+    class _IndexHandler(pyinotify.ProcessEvent):
+        """Keeps a QueueDir's index of new items up to date"""
+        def my_init(self, queue):
+            self.queue = queue
+
         def process_IN_MOVED_TO(self, event):
-            pass
+            self.queue._index_add(event.name, time.time())
+
+        def process_IN_MOVED_FROM(self, event):
+            # Somebody else took this item
+            self.queue._index_remove(event.name)
+
+        process_IN_DELETE = process_IN_MOVED_FROM
+
+        def process_IN_Q_OVERFLOW(self, event):
+            self.queue._index_load()
 except ImportError:
     pyinotify = None
 
 
 class QueueDir(object):
+    """
+    A queue of items stored in a directory, shared by any number of producer
+    and consumer processes.
+
+    Consumers keep an in-memory index of the items in new, ordered by when
+    they arrived. It is loaded from disk on the first pop, and kept up to
+    date with inotify if pyinotify is available. Otherwise the directory is
+    only listed again once the index runs dry.
+
+    Items that are requeued with a delay wait in the delayed directory, with
+    the time they're due to go back into new at the front of their name.
+
+    Cleanup is done a little at a time by pop() and add(), so that no single
+    call has to go over every file in the queue.
+    """
     # How long before things are considered to be "old"
     # Also how long between cleanup jobs
     cleanup_time = 300  # 5 minutes
 
+    # How many files to look at in each step of cleanup
+    cleanup_batch = 50
+
     # Should the producer do cleanup?
     producer_cleanup = True
 
@@ -37,14 +72,26 @@ class QueueDir(object):
         self.started = int(time.time())
         self.count = 0
         self.last_cleanup = 0
-        # List of time, item_id for items to move from cur back into new
+        # Cleanup pass in progress, see _cleanup_step
+        self._cleanup = None
+        # Sorted list of time, delayed item name for items to move from
+        # delayed into new
         self.to_requeue = []
 
+        # Index of items in new, for consumers. Mapping of item_id to arrival
+        # time, and a heap of (arrival time, item_id) which may have entries
+        # for items that are no longer in the index
+        self._index = None
+        self._heap = []
+        self._wm = None
+        self._notifier = None
+
         self.tmp_dir = os.path.join(self.queue_dir, 'tmp')
         self.new_dir = os.path.join(self.queue_dir, 'new')
         self.cur_dir = os.path.join(self.queue_dir, 'cur')
         self.log_dir = os.path.join(self.queue_dir, 'logs')
         self.dead_dir = os.path.join(self.queue_dir, 'dead')
+        self.delayed_dir = os.path.join(self.queue_dir, 'delayed')
 
         self.setup()
 
@@ -53,7 +100,8 @@ class QueueDir(object):
         return cls._objects[name]
 
     def setup(self):
-        for d in (self.tmp_dir, self.new_dir, self.cur_dir, self.log_dir, self.dead_dir):
+        for d in (self.tmp_dir, self.new_dir, self.cur_dir, self.log_dir,
+                  self.dead_dir, self.delayed_dir):
             # Create our directories a bit at a time so we can make sure the
             # modes are created properly
             parts = d.split("/")
@@ -71,16 +119,48 @@ class QueueDir(object):
         Removes old items from tmp
         Removes old logs from log_dir
         Moves old items from cur into new
+        Schedules delayed items to be moved into new
 
         'old' is defined by the cleanup_time property
         """
         now = time.time()
-        if now - self.last_cleanup < self.cleanup_time:
-            return
         self.last_cleanup = now
-        dirs = [self.tmp_dir, self.log_dir]
-        for d in dirs:
-            for f in os.listdir(d):
+        self._cleanup = None
+        for _ in self._cleanup_steps(now):
+            pass
+
+    def _cleanup_step(self):
+        """
+        Does the next bit of cleanup, starting a new pass if it's been
+        cleanup_time since the last one started.
+        """
+        if self._cleanup is None:
+            now = time.time()
+            if now - self.last_cleanup < self.cleanup_time:
+                return
+            self.last_cleanup = now
+            self._cleanup = self._cleanup_steps(now)
+        try:
+            self._cleanup.next()
+        except StopIteration:
+            self._cleanup = None
+
+    def _cleanup_steps(self, now):
+        """
+        Generator that does a cleanup pass, yielding after listing each
+        directory, and after every cleanup_batch files.
+        """
+        def listdir(d):
+            for i, f in enumerate(os.listdir(d)):
+                if i % self.cleanup_batch == 0:
+                    yield None
+                yield f
+
+        for d in self.tmp_dir, self.log_dir:
+            for f in listdir(d):
+                if f is None:
+                    yield
+                    continue
                 fn = os.path.join(d, f)
                 try:
                     if os.path.getmtime(fn) < now - self.cleanup_time:
@@ -88,7 +168,10 @@ class QueueDir(object):
                 except OSError:
                     pass
 
-        for f in os.listdir(self.cur_dir):
+        for f in listdir(self.cur_dir):
+            if f is None:
+                yield
+                continue
             fn = os.path.join(self.cur_dir, f)
             try:
                 if os.path.getmtime(fn) < now - self.cleanup_time:
@@ -96,6 +179,14 @@ class QueueDir(object):
             except OSError:
                 pass
 
+        # Pick up items delayed by other processes, or before a restart
+        for f in listdir(self.delayed_dir):
+            if f is None:
+                yield
+                continue
+            self._schedule(f)
+        self._check_to_requeue()
+
     ###
     # For producers
     ###
@@ -114,11 +205,88 @@ class QueueDir(object):
         self.count += 1
 
         if self.producer_cleanup:
-            self.cleanup()
+            self._cleanup_step()
 
     ###
     # For consumers
     ###
+    def _index_add(self, item_id, arrived):
+        if self._index is None or item_id in self._index:
+            return
+        self._index[item_id] = arrived
+        heapq.heappush(self._heap, (arrived, item_id))
+
+    def _index_remove(self, item_id):
+        if self._index is not None:
+            self._index.pop(item_id, None)
+            if len(self._heap) > 2 * len(self._index) + 100:
+                self._heap = [(t, i) for (i, t) in self._index.items()]
+                heapq.heapify(self._heap)
+
+    def _index_load(self):
+        """(Re)load the index of items in new from disk"""
+        self._index = {}
+        self._heap = []
+        for item_id in os.listdir(self.new_dir):
+            try:
+                arrived = os.path.getmtime(os.path.join(self.new_dir, item_id))
+            except OSError:
+                # Somebody else got to it first
+                continue
+            self._index[item_id] = arrived
+            self._heap.append((arrived, item_id))
+        heapq.heapify(self._heap)
+
+    def _index_update(self, timeout=0):
+        """
+        Brings the index of items in new up to date, waiting up to `timeout`
+        seconds (forever if None) for changes if there are no new items.
+        """
+        if self._index is None:
+            if pyinotify:
+                # Start watching before listing new so we don't miss anything
+                self._wm = pyinotify.WatchManager()
+                self._wm.add_watch(self.new_dir, pyinotify.IN_MOVED_TO |
+                                   pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+                self._notifier = pyinotify.Notifier(
+                    self._wm, _IndexHandler(queue=self))
+            self._index_load()
+
+        if self._notifier:
+            if self._index:
+                timeout = 0
+            elif timeout is not None:
+                timeout *= 1000
+            if self._notifier.check_events(timeout):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        elif not self._index:
+            self._index_load()
+
+    def _next_item(self, sorted=True):
+        """
+        Removes and returns an item_id from the index, or None if the index is
+        empty. If sorted is True, then the earliest item is returned,
+        otherwise one of the first few is picked at random so that concurrent
+        consumers don't all go after the same item.
+        """
+        if not self._index:
+            return None
+        if not sorted:
+            # Pick one of the items near the front of the queue
+            candidates = [i for (t, i) in self._heap[:16]
+                          if self._index.get(i) == t]
+            if candidates:
+                item_id = random.choice(candidates)
+                del self._index[item_id]
+                return item_id
+        while self._heap:
+            arrived, item_id = heapq.heappop(self._heap)
+            if self._index.get(item_id) == arrived:
+                del self._index[item_id]
+                return item_id
+        return None
+
     def pop(self, sorted=True):
         """
         Moves an item from new into cur
@@ -126,28 +294,51 @@ class QueueDir(object):
         Returns None if queue is empty
         If sorted is True, then the earliest item is returned
         """
+        items = self.pop_many(1, sorted)
+        if items:
+            return items[0]
+        return None
+
+    def pop_many(self, n, sorted=True):
+        """
+        Moves up to n items from new into cur
+        Returns a list of item_id, file handle
+        If sorted is True, then the earliest items are returned
+        """
         self._check_to_requeue()
-        self.cleanup()
-        items = os.listdir(self.new_dir)
-        if sorted:
-            items.sort(
-                key=lambda f: os.path.getmtime(os.path.join(self.new_dir, f)))
-        for item in items:
+        self._cleanup_step()
+        self._index_update()
+        retval = []
+        while len(retval) < n:
+            item = self._next_item(sorted)
+            if item is None:
+                break
             try:
                 dst_name = os.path.join(self.cur_dir, item)
                 os.rename(os.path.join(self.new_dir, item), dst_name)
                 os.utime(dst_name, None)
-                return item, open(dst_name, 'rb')
+                retval.append((item, open(dst_name, 'rb')))
             except OSError:
+                # Somebody else got to it first
                 pass
-        return None
+        return retval
 
     def peek(self):
         """
         Returns True if there are new items in the queue
         """
-        items = os.listdir(self.new_dir)
-        return len(items) > 0
+        self._index_update()
+        return bool(self._index)
+
+    def close(self):
+        """
+        Stops watching the queue for changes
+        """
+        if self._wm:
+            self._wm.close()
+        self._wm = self._notifier = None
+        self._index = None
+        self._heap = []
 
     def touch(self, item_id):
         """
@@ -190,16 +381,35 @@ class QueueDir(object):
         """
         os.unlink(os.path.join(self.cur_dir, item_id))
 
+    def _schedule(self, delayed_name):
+        """
+        Remember to move delayed_name from delayed into new once it's due
+        """
+        try:
+            due = int(delayed_name.split("@")[0])
+        except ValueError:
+            log.warn("Ignoring unexpected file %s in %s", delayed_name,
+                     self.delayed_dir)
+            return
+        if (due, delayed_name) not in self.to_requeue:
+            bisect.insort(self.to_requeue, (due, delayed_name))
+
     def _check_to_requeue(self):
         if not self.to_requeue:
             return
         now = time.time()
-        for t, item_id in self.to_requeue[:]:
-            if now > t:
-                self.requeue(item_id)
-                self.to_requeue.remove((t, item_id))
-            else:
-                self.touch(item_id)
+        while self.to_requeue and self.to_requeue[0][0] <= now:
+            t, delayed_name = self.to_requeue.pop(0)
+            item_id = delayed_name.split("@", 1)[1]
+            dst_name = os.path.join(self.new_dir, item_id)
+            try:
+                os.rename(os.path.join(self.delayed_dir, delayed_name),
+                          dst_name)
+                os.utime(dst_name, None)
+                self._index_add(item_id, time.time())
+            except OSError:
+                # Somebody else got to it first
+                pass
 
     def requeue(self, item_id, delay=None, max_retries=None):
         """
@@ -207,11 +417,9 @@ class QueueDir(object):
         end.
 
         If delay is set, it is a number of seconds to wait before moving the
-        item back into new. It will remain in cur until the appropriate time
-        has expired.
-        The state for this is kept in the QueueDir instance, so if the instance
-        goes away, the item won't be requeued on schedule. It will eventually
-        be moved out of cur when the cleanup time expires however.
+        item back into new. Until then it is kept in the delayed directory,
+        so the item will be requeued on schedule by any QueueDir instance for
+        this queue, even if this one goes away.
         You must be call pop() at some point in the future for requeued items
         to be processed.
         """
@@ -228,15 +436,24 @@ class QueueDir(object):
             self.murder(item_id)
             return
 
+        new_item_id = "%s.%i" % (core_item_id, count)
         if delay:
-            self.to_requeue.append((time.time() + delay, item_id))
-            self.to_requeue.sort()
+            due = int(math.ceil(time.time() + delay))
+            delayed_name = "%010i@%s" % (due, new_item_id)
+            try:
+                os.rename(os.path.join(self.cur_dir, item_id),
+                          os.path.join(self.delayed_dir, delayed_name))
+                self._schedule(delayed_name)
+            except OSError:
+                # Somebody else got to it first
+                pass
             return
 
-        dst_name = os.path.join(self.new_dir, "%s.%i" % (core_item_id, count))
+        dst_name = os.path.join(self.new_dir, new_item_id)
         try:
             os.rename(os.path.join(self.cur_dir, item_id), dst_name)
             os.utime(dst_name, None)
+            self._index_add(new_item_id, time.time())
         except OSError:
             # Somebody else got to it first
             pass
@@ -251,62 +468,33 @@ class QueueDir(object):
             dst_name = os.path.join(self.dead_dir, "%s.log" % item_id)
             os.rename(self.getlogname(item_id), dst_name)
 
-    if pyinotify:
-        def wait(self, timeout=None):
-            """
-            Waits for new items to arrive in new.
-            timeout is in seconds, and is the maximum amount of time to wait. we
-            might return before that.
-            """
-            # Check if we have any items to requeue
-            if self.to_requeue:
-                reque_time = self.to_requeue[0][0] - time.time()
-                # Need to do something right now!
-                if reque_time < 0:
-                    return
-                if timeout:
-                    timeout = min(reque_time, timeout)
-                else:
-                    timeout = reque_time
-
+    def wait(self, timeout=None):
+        """
+        Waits for new items to arrive in new.
+        timeout is in seconds, and is the maximum amount of time to wait. we
+        might return before that.
+        """
+        # Check if we have any items to requeue
+        if self.to_requeue:
+            reque_time = self.to_requeue[0][0] - time.time()
+            # Need to do something right now!
+            if reque_time < 0:
+                return
             if timeout:
-                timeout *= 1000
+                timeout = min(reque_time, timeout)
+            else:
+                timeout = reque_time
 
-            log.debug("Sleeping for %s", timeout)
+        log.debug("Sleeping for %s", timeout)
 
-            wm = pyinotify.WatchManager()
-            try:
-                wm.add_watch(self.new_dir, pyinotify.IN_MOVED_TO)
-
-                notifier = pyinotify.Notifier(wm, _MovedHandler())
-                notifier.check_events(timeout)
-                notifier.process_events()
-            finally:
-                wm.close()
-    else:
-        def wait(self, timeout=None):
-            """
-            Waits for new items to arrive in new.
-            timeout is in seconds, and is the maximum amount of time to wait. we
-            might return before that.
-            """
-            # Check if we have any items to requeue
-            if self.to_requeue:
-                reque_time = self.to_requeue[0][0] - time.time()
-                # Need to do something right now!
-                if reque_time < 0:
-                    return
-                if timeout:
-                    timeout = min(reque_time, timeout)
-                else:
-                    timeout = reque_time
-
-            log.debug("Sleeping for %s", timeout)
-
-            start = time.time()
-            while True:
-                if self.peek():
-                    return
-                time.sleep(1)
-                if timeout and time.time() - start > timeout:
-                    return
+        if pyinotify:
+            self._index_update(timeout)
+            return
+
+        start = time.time()
+        while True:
+            if self.peek():
+                return
+            time.sleep(1)
+            if timeout and time.time() - start > timeout:
+                return
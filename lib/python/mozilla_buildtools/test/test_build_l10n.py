@@ -0,0 +1,179 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from build.l10n import UpdateCache, repackLocale, runInThreads
+
+# Stands in for unwrap_full_update.pl: "unwraps" the MAR by copying it into
+# the current directory, and logs each run
+UNWRAP_SCRIPT = """
+use File::Copy;
+copy($ARGV[0], "contents") or die;
+open(LOG, ">>", "%s") or die;
+print LOG "$ARGV[0]\\n";
+"""
+
+
+class TestRunInThreads(unittest.TestCase):
+    def testAllRun(self):
+        results = []
+        runInThreads(lambda a, b: results.append(a + b),
+                     [(1, 2), (3, 4), (5, 6)])
+        self.assertEquals(sorted(results), [3, 7, 11])
+
+    def testError(self):
+        results = []
+
+        def func(n):
+            if n == 2:
+                raise ValueError(n)
+            results.append(n)
+        self.assertRaises(ValueError, runInThreads, func, [(1,), (2,), (3,)])
+        # The others still ran
+        self.assertEquals(sorted(results), [1, 3])
+
+
+class TestUpdateCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = UpdateCache(os.path.join(self.tmpdir, 'cache'))
+        self.log = os.path.join(self.tmpdir, 'unwrap.log')
+        self.script = os.path.join(self.tmpdir, 'unwrap.pl')
+        open(self.script, 'w').write(UNWRAP_SCRIPT % self.log)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _mar(self, name, contents):
+        mar = os.path.join(self.tmpdir, name)
+        open(mar, 'wb').write(contents)
+        return mar
+
+    def _unwraps(self):
+        if not os.path.exists(self.log):
+            return 0
+        return len(open(self.log).readlines())
+
+    def testUnwrapIdenticalMarsOnce(self):
+        tree1 = self.cache.unwrap(self._mar('de.mar', 'same'), self.script, {})
+        tree2 = self.cache.unwrap(self._mar('fr.mar', 'same'), self.script, {})
+        tree3 = self.cache.unwrap(self._mar('it.mar', 'other'), self.script,
+                                  {})
+        self.assertEquals(tree1, tree2)
+        self.assertNotEquals(tree1, tree3)
+        self.assertEquals(open(os.path.join(tree1, 'contents')).read(), 'same')
+        self.assertEquals(self._unwraps(), 2)
+
+    def testConcurrentUnwrap(self):
+        mar = self._mar('de.mar', 'data')
+        trees = []
+
+        def unwrap():
+            trees.append(self.cache.unwrap(mar, self.script, {}))
+        threads = [threading.Thread(target=unwrap) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(len(set(trees)), 1)
+        self.assertEquals(self._unwraps(), 1)
+
+    def testDownloadUpdate(self):
+        def fake_download(stageServer, productName, version, buildNumber,
+                          platform, locale, destDir):
+            if locale == 'new':
+                return None
+            mar = os.path.join(destDir, 'complete.mar')
+            open(mar, 'wb').write(locale)
+            return mar
+
+        with mock.patch('release.download.downloadUpdateIgnore404') as \
+                download:
+            download.side_effect = fake_download
+            args = ('stage', 'firefox', '20.0', 1, 'linux')
+            mar = self.cache.downloadUpdate(*(args + ('de',)))
+            self.assertEquals(open(mar).read(), 'de')
+            self.assertEquals(self.cache.downloadUpdate(*(args + ('de',))),
+                              mar)
+            self.assertEquals(self.cache.downloadUpdate(*(args + ('new',))),
+                              None)
+            self.assertEquals(self.cache.downloadUpdate(*(args + ('new',))),
+                              None)
+            self.assertEquals(download.call_count, 2)
+
+
+class TestRepackLocalePartials(unittest.TestCase):
+    def _repack(self, partialUpdates):
+        with mock.patch.multiple('build.l10n', mercurial=mock.DEFAULT,
+                                 update=mock.DEFAULT,
+                                 compareLocales=mock.DEFAULT,
+                                 run_cmd=mock.DEFAULT,
+                                 get_output=mock.DEFAULT) as mocks:
+            mocks['get_output'].return_value = 'checksums'
+            repackLocale('de', 'l10n', 'http://hg/l10n', 'default',
+                         'obj/browser/locales', 'l10n.ini', 'compare', {},
+                         '/src/obj', productName='firefox', platform='linux',
+                         version='20.0', partialUpdates=partialUpdates)
+        self.run_cmd = mocks['run_cmd']
+        return [c[0][0] for c in mocks['run_cmd'].call_args_list
+                if 'make_incremental_update.sh' in c[0][0][1]]
+
+    def _signCalls(self):
+        return [c[0][0] for c in self.run_cmd.call_args_list
+                if c[0][0][:2] == ['bash', '-c']]
+
+    def _uploadExtraFiles(self):
+        uploads = [c for c in self.run_cmd.call_args_list
+                   if 'upload' in c[0][0]]
+        self.assertEquals(len(uploads), 1)
+        return uploads[0][1]['env']['UPLOAD_EXTRA_FILES'].split()
+
+    def testPartialsHaveTheirOwnNewTree(self):
+        partialUpdates = dict((v, {'mar': 'firefox-%s.complete.mar' % v})
+                              for v in ('18.0', '19.0', '19.0.1'))
+        calls = self._repack(partialUpdates)
+        self.assertEquals(len(calls), 3)
+        newTrees = [c[4] for c in calls]
+        self.assertEquals(len(set(newTrees)), 3)
+        # Nor may their "$newdir.work" scratch directories
+        workDirs = [t + '.work' for t in newTrees]
+        self.assertEquals(len(set(newTrees + workDirs)), 6)
+
+    def testSinglePartialUsesCurrent(self):
+        calls = self._repack({'19.0': {'mar': 'firefox-19.0.complete.mar'}})
+        self.assertEquals(len(calls), 1)
+        self.assertTrue(calls[0][4].endswith('/dist/current'))
+
+    def testPartialsSignedTogether(self):
+        partialUpdates = dict((v, {'mar': 'firefox-%s.complete.mar' % v})
+                              for v in ('18.0', '19.0', '19.0.1'))
+        with mock.patch.dict(os.environ, {'MOZ_SIGN_CMD': 'signcmd'}):
+            calls = self._repack(partialUpdates)
+        partials = [c[2] for c in calls]
+        signs = self._signCalls()
+        self.assertEquals(len(signs), 1)
+        self.assertTrue(signs[0][2].startswith('signcmd -f mar -f gpg '))
+        for partial in partials:
+            self.assertTrue('"%s"' % partial in signs[0][2])
+        # Each partial is uploaded along with its signature
+        extra = self._uploadExtraFiles()
+        for partial in partials:
+            uploaded = [f for f in extra
+                        if f.endswith('/' + os.path.basename(partial))]
+            self.assertEquals(len(uploaded), 1)
+            self.assertTrue(uploaded[0] + '.asc' in extra)
+        self.assertEquals(len(extra), 6)
+
+    def testPartialsNotSigned(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('MOZ_SIGN_CMD', None)
+            self._repack({'19.0': {'mar': 'firefox-19.0.complete.mar'}})
+        self.assertEquals(self._signCalls(), [])
+        self.assertEquals([f for f in self._uploadExtraFiles()
+                           if f.endswith('.asc')], [])
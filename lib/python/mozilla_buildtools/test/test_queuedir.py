@@ -0,0 +1,164 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+import mozilla_buildtools.queuedir as queuedir
+from mozilla_buildtools.queuedir import QueueDir
+
+
+class TestQueueDir(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queues = []
+
+    def tearDown(self):
+        for q in self.queues:
+            q.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _queue(self, name="test"):
+        q = QueueDir(name, self.tmpdir)
+        self.queues.append(q)
+        return q
+
+    def _read(self, items):
+        retval = []
+        for item_id, fp in items:
+            retval.append(fp.read())
+            fp.close()
+        return retval
+
+    def testPopOrder(self):
+        q = self._queue()
+        now = time.time()
+        for i in range(3):
+            q.add(str(i))
+        # Make the items arrive in reverse order
+        for i, item_id in enumerate(sorted(os.listdir(q.new_dir))):
+            os.utime(os.path.join(q.new_dir, item_id), (now - i, now - i))
+        self.assertEquals(self._read([q.pop(), q.pop(), q.pop()]),
+                          ["2", "1", "0"])
+        self.assertEquals(q.pop(), None)
+
+    def testPopMany(self):
+        q = self._queue()
+        for i in range(5):
+            q.add(str(i))
+        items = q.pop_many(3)
+        self.assertEquals(len(items), 3)
+        self.assertEquals(len(os.listdir(q.cur_dir)), 3)
+        self._read(items)
+        self.assertEquals(len(q.pop_many(3)), 2)
+        self.assertEquals(q.pop_many(3), [])
+
+    def testNewItems(self):
+        q = self._queue()
+        self.assertEquals(q.pop(), None)
+        q.add("hello")
+        self.assertTrue(q.peek())
+        self.assertEquals(self._read([q.pop()]), ["hello"])
+
+    def testConsumers(self):
+        producer = self._queue("producer")
+        c1 = self._queue("c1")
+        c2 = self._queue("c2")
+        for i in range(10):
+            producer.add(str(i))
+        seen = []
+        for i in range(5):
+            seen.extend(self._read(c1.pop_many(1, sorted=False)))
+            seen.extend(self._read(c2.pop_many(1, sorted=False)))
+        self.assertEquals(sorted(seen), [str(i) for i in range(10)])
+        self.assertEquals(c1.pop(), None)
+        self.assertEquals(c2.pop(), None)
+
+    def testRequeue(self):
+        q = self._queue()
+        q.add("hello")
+        item_id, fp = q.pop()
+        fp.close()
+        q.requeue(item_id)
+        new_item_id, fp = q.pop()
+        self.assertEquals(new_item_id, item_id + ".1")
+        self.assertEquals(fp.read(), "hello")
+        fp.close()
+
+    def testWait(self):
+        if not queuedir.pyinotify:
+            return
+        q = self._queue()
+        q.pop()
+        start = time.time()
+        q.wait(0.2)
+        self.assertTrue(time.time() - start >= 0.1)
+        self._queue("producer").add("hello")
+        q.wait(5)
+        self.assertTrue(q.peek())
+
+    def testNoInotify(self):
+        with mock.patch.object(queuedir, "pyinotify", None):
+            q = self._queue()
+            q.add("a")
+            self.assertEquals(self._read([q.pop()]), ["a"])
+            q.add("b")
+            self.assertTrue(q.peek())
+            self.assertEquals(self._read(q.pop_many(5)), ["b"])
+
+    def testDelayedRequeue(self):
+        q = self._queue()
+        q.add("hello")
+        item_id, fp = q.pop()
+        fp.close()
+        q.requeue(item_id, delay=100)
+        self.assertEquals(os.listdir(q.cur_dir), [])
+        self.assertEquals(q.pop(), None)
+        self.assertEquals(len(q.to_requeue), 1)
+
+        # A new instance picks up the schedule from disk
+        q2 = self._queue("restarted")
+        self.assertEquals(q2.to_requeue, q.to_requeue)
+        due = q2.to_requeue[0][0]
+        with mock.patch("time.time") as t:
+            t.return_value = due - 1
+            self.assertEquals(q2.pop(), None)
+            t.return_value = due
+            new_item_id, fp = q2.pop()
+        self.assertEquals(new_item_id, item_id + ".1")
+        self.assertEquals(fp.read(), "hello")
+        fp.close()
+        self.assertEquals(os.listdir(q.delayed_dir), [])
+
+    def testIncrementalCleanup(self):
+        q = self._queue()
+        q.cleanup_batch = 2
+        old = time.time() - 2 * q.cleanup_time
+        for i in range(5):
+            fn = os.path.join(q.tmp_dir, "tmp%i" % i)
+            open(fn, "wb").write("x")
+            os.utime(fn, (old, old))
+        q.last_cleanup = 0
+        # Each step only looks at a few files
+        q._cleanup_step()
+        self.assertEquals(len(os.listdir(q.tmp_dir)), 5)
+        q._cleanup_step()
+        self.assertEquals(len(os.listdir(q.tmp_dir)), 3)
+        # Producers only do a step of cleanup at a time too
+        q.add("hello")
+        self.assertEquals(len(os.listdir(q.tmp_dir)), 1)
+        while q._cleanup:
+            q._cleanup_step()
+        self.assertEquals(os.listdir(q.tmp_dir), [])
+
+    def testCleanupRequeuesOldItems(self):
+        q = self._queue()
+        q.add("hello")
+        item_id, fp = q.pop()
+        fp.close()
+        old = time.time() - 2 * q.cleanup_time
+        os.utime(os.path.join(q.cur_dir, item_id), (old, old))
+        q.cleanup()
+        self.assertEquals(os.listdir(q.new_dir), [item_id + ".1"])
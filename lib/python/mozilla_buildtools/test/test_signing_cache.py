@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import mock
+
+from signing.cache import SigningCache, clonefile
+from util.file import sha1sum
+
+
+class TestSigningCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        self.cache = SigningCache(self.cachedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _signed(self, name, data):
+        fn = os.path.join(self.tmpdir, name)
+        open(fn, "wb").write(data)
+        return fn
+
+    def testMiss(self):
+        dest = os.path.join(self.tmpdir, "dest")
+        self.assertEquals(self.cache.get("gpg", "a" * 40, dest), None)
+        self.assertFalse(os.path.exists(dest))
+
+    def testPutGet(self):
+        signed = self._signed("signed", "signed data")
+        digest = sha1sum(signed)
+        self.cache.put("gpg", "a" * 40, signed, digest)
+        dest = os.path.join(self.tmpdir, "dest")
+        open(dest, "wb").write("old data")
+        # Hits don't need to hash the file again
+        with mock.patch("signing.cache.sha1sum") as s:
+            self.assertEquals(self.cache.get("gpg", "a" * 40, dest), digest)
+        self.assertEquals(s.call_count, 0)
+        self.assertEquals(open(dest, "rb").read(), "signed data")
+        self.assertFalse(os.path.exists(dest + ".tmp"))
+
+    def testModifiedEntry(self):
+        signed = self._signed("signed", "signed data")
+        self.cache.put("gpg", "a" * 40, signed)
+        cached_fn = os.path.join(self.cachedir, "gpg", "a" * 40)
+        # Change the entry behind the cache's back, e.g. through a hard link
+        open(cached_fn, "ab").write("more")
+        dest = os.path.join(self.tmpdir, "dest")
+        self.assertEquals(self.cache.get("gpg", "a" * 40, dest), None)
+        self.assertFalse(os.path.exists(cached_fn))
+
+    def testLegacyEntry(self):
+        # Entries without digests are treated as misses
+        os.makedirs(os.path.join(self.cachedir, "gpg"))
+        open(os.path.join(self.cachedir, "gpg", "a" * 40), "wb").write("x")
+        dest = os.path.join(self.tmpdir, "dest")
+        self.assertEquals(self.cache.get("gpg", "a" * 40, dest), None)
+
+    def testCleanup(self):
+        cache = SigningCache(self.cachedir, max_size=25)
+        now = time.time()
+        for i, h in enumerate(["a", "b", "c"]):
+            signed = self._signed(h, h * 10)
+            cache.put("gpg", h * 40, signed)
+            info = os.path.join(self.cachedir, "gpg", h * 40 + ".sha1")
+            os.utime(info, (now - 100 + i, now - 100 + i))
+        # Using "a" makes "b" the least recently used entry
+        cache.get("gpg", "a" * 40, os.path.join(self.tmpdir, "dest"))
+        cache.cleanup()
+        self.assertEquals(sorted(e[3] for e in cache.entries()),
+                          ["a" * 40, "c" * 40])
+
+    def testCleanupUnbounded(self):
+        signed = self._signed("signed", "signed data")
+        self.cache.put("gpg", "a" * 40, signed)
+        self.cache.cleanup()
+        self.assertEquals(len(self.cache.entries()), 1)
+
+
+class TestClonefile(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, "src")
+        open(self.src, "wb").write("data")
+        self.dst = os.path.join(self.tmpdir, "dst")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testClone(self):
+        clonefile(self.src, self.dst)
+        self.assertEquals(open(self.dst, "rb").read(), "data")
+
+    def testCopyFallback(self):
+        with mock.patch("os.link") as link:
+            link.side_effect = OSError(18, "Invalid cross-device link")
+            with mock.patch("fcntl.ioctl") as ioctl:
+                ioctl.side_effect = IOError(95, "Operation not supported")
+                clonefile(self.src, self.dst)
+        self.assertEquals(open(self.dst, "rb").read(), "data")
+        self.assertNotEquals(os.stat(self.src).st_ino,
+                             os.stat(self.dst).st_ino)
+
+    def testNoFcntlOrLink(self):
+        # As on Windows
+        with mock.patch("signing.cache.fcntl", None):
+            with mock.patch("signing.cache.os", spec=["path"]) as fake_os:
+                fake_os.path = os.path
+                clonefile(self.src, self.dst)
+        self.assertEquals(open(self.dst, "rb").read(), "data")
+        self.assertNotEquals(os.stat(self.src).st_ino,
+                             os.stat(self.dst).st_ino)
@@ -1 +1,106 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+from unittest import TestCase
+
+import mock
+
 import signing.client
+from signing.client import remote_signfiles, remote_signfiles_batch
+
+
+class TestRemoteSignfiles(TestCase):
+    def testSerial(self):
+        jobs = [("a", None), ("b", "out/b")]
+        with mock.patch("signing.client.remote_signfile") as rs:
+            rs.return_value = True
+            failed = remote_signfiles(None, ["u1"], jobs, "gpg", "token")
+        self.assertEquals(failed, [])
+        self.assertEquals(rs.call_args_list, [
+            ((None, ["u1"], "a", "gpg", "token", None), {}),
+            ((None, ["u1"], "b", "gpg", "token", "out/b"), {}),
+        ])
+
+    def testSerialStopsOnFailure(self):
+        jobs = [("a", None), ("b", None), ("c", None)]
+        with mock.patch("signing.client.remote_signfile") as rs:
+            rs.side_effect = lambda o, u, f, *args: f != "b"
+            failed = remote_signfiles(None, ["u1"], jobs, "gpg", "token")
+        self.assertEquals(failed, ["b"])
+        self.assertEquals(rs.call_count, 2)
+
+    def testConcurrent(self):
+        jobs = [(str(i), None) for i in range(8)]
+        lock = threading.Lock()
+        state = {'active': 0, 'max_active': 0, 'urls': set()}
+
+        def fake_signfile(options, urls, filename, fmt, token, dest):
+            lock.acquire()
+            state['active'] += 1
+            state['max_active'] = max(state['max_active'], state['active'])
+            state['urls'].add(urls[0])
+            lock.release()
+            time.sleep(0.1)
+            lock.acquire()
+            state['active'] -= 1
+            lock.release()
+            return True
+
+        with mock.patch("signing.client.remote_signfile", fake_signfile):
+            failed = remote_signfiles(None, ["u1", "u2"], jobs, "gpg",
+                                      "token", concurrency=4)
+        self.assertEquals(failed, [])
+        self.assertEquals(state['max_active'], 4)
+        # Workers should be spread over all the hosts
+        self.assertEquals(state['urls'], set(["u1", "u2"]))
+
+    def testConcurrentException(self):
+        jobs = [("a", None), ("b", None)]
+        with mock.patch("signing.client.remote_signfile") as rs:
+            rs.side_effect = IOError("boom")
+            failed = remote_signfiles(None, ["u1"], jobs, "gpg", "token",
+                                      concurrency=2)
+        # Other workers stop picking up files once one has failed
+        self.assertTrue(failed)
+        self.assertTrue(set(failed) <= set(["a", "b"]))
+
+    def testNonce(self):
+        self.assertEquals(signing.client.read_nonce("/nonexistent/nonce"), "")
+
+
+class Options(object):
+    cachedir = None
+    nsscmd = None
+    noncefile = None
+
+
+class TestRemoteSignfilesBatch(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.options = Options()
+        self.options.noncefile = os.path.join(self.tmpdir, "nonce")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testFallback(self):
+        # Servers without the batch API get files signed one at a time
+        a = os.path.join(self.tmpdir, "a")
+        open(a, "wb").write("a")
+        b = os.path.join(self.tmpdir, "b")
+        open(b, "wb").write("b")
+        jobs = [(a, None), (b, os.path.join(self.tmpdir, "out", "b"))]
+        error = urllib2.HTTPError("url", 400, "Bad Request", {}, None)
+        with mock.patch("signing.client.batch_request") as br:
+            br.side_effect = error
+            with mock.patch("signing.client.remote_signfiles") as rs:
+                rs.return_value = []
+                failed = remote_signfiles_batch(self.options, ["u1"], jobs,
+                                                "gpg", "token", 2)
+        self.assertEquals(failed, [])
+        args = rs.call_args[0]
+        self.assertEquals(sorted(args[2]), sorted(jobs))
+        self.assertEquals(args[5], 2)
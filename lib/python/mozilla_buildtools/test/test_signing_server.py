@@ -6,19 +6,198 @@ if sys.version_info < (2, 6, 0):
     raise SkipTest
 
 
+import os
 import time
 import hashlib
 import shutil
+import tarfile
 import tempfile
 from unittest import TestCase
 from StringIO import StringIO
 from ConfigParser import RawConfigParser
 import mock
+import simplejson as json
 import webob
+import gevent
+from gevent.event import Event
 
 import signing.server as ss
 
 
+class TestGetWait(TestCase):
+    def testGetWait(self):
+        self.assertEquals(ss.get_wait(None), None)
+        self.assertEquals(ss.get_wait(""), None)
+        self.assertEquals(ss.get_wait("30"), 30)
+        self.assertEquals(ss.get_wait("wait=30"), 30)
+        self.assertEquals(ss.get_wait("foo=1&wait=30"), 30)
+        self.assertEquals(ss.get_wait("foo=1"), None)
+        self.assertEquals(ss.get_wait("0"), None)
+        self.assertEquals(ss.get_wait("bogus"), None)
+
+
+class TestDigestIndex(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "file")
+        open(self.fn, "wb").write("hello")
+        self.digest = hashlib.new('sha1', "hello").hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testGet(self):
+        index = ss.DigestIndex()
+        with mock.patch.object(ss, 'sha1sum') as sha1sum:
+            sha1sum.return_value = self.digest
+            self.assertEquals(index.get(self.fn), self.digest)
+            self.assertEquals(index.get(self.fn), self.digest)
+            # A new index reads the digest back from disk
+            self.assertEquals(ss.DigestIndex().get(self.fn), self.digest)
+        self.assertEquals(sha1sum.call_count, 1)
+
+    def testChanged(self):
+        index = ss.DigestIndex()
+        index.get(self.fn)
+        open(self.fn, "wb").write("goodbye!")
+        self.assertEquals(index.get(self.fn),
+                          hashlib.new('sha1', "goodbye!").hexdigest())
+
+    def testTouch(self):
+        index = ss.DigestIndex()
+        index.set(self.fn, self.digest)
+        os.utime(self.fn, (0, 0))
+        index.set(self.fn, self.digest)
+        with mock.patch.object(ss, 'sha1sum') as sha1sum:
+            self.assertEquals(index.touch(self.fn), self.digest)
+            self.assertTrue(os.path.getmtime(self.fn) > 0)
+            self.assertEquals(index.get(self.fn), self.digest)
+            self.assertEquals(ss.DigestIndex().get(self.fn), self.digest)
+        self.assertEquals(sha1sum.call_count, 0)
+
+    def testMissing(self):
+        index = ss.DigestIndex()
+        self.assertRaises(OSError, index.get, self.fn + "-missing")
+
+    def testForget(self):
+        index = ss.DigestIndex()
+        index.get(self.fn)
+        index.forget(self.fn)
+        self.assertFalse(os.path.exists(self.fn + index.suffix))
+        self.assertEquals(index.digests, {})
+
+
+class TestSigner(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = mock.Mock()
+        self.signed = []
+        self.active = {}
+        self.max_active = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run_signscript(self, cmd, inputfile, outputfile, filename, format_,
+                        passphrase=None):
+        self.active[format_] = self.active.get(format_, 0) + 1
+        self.max_active[format_] = max(self.max_active.get(format_, 0),
+                                       self.active[format_])
+        gevent.sleep(0.01)
+        self.active[format_] -= 1
+        self.signed.append(filename)
+        open(outputfile, 'wb').write(filename)
+        return 0
+
+    def _run(self, signer, events):
+        with mock.patch.object(ss, 'run_signscript', self._run_signscript):
+            for e in events:
+                e.wait(5)
+        signer.stop()
+        gevent.joinall(signer.workers, timeout=5)
+
+    def testPriority(self):
+        signer = ss.Signer(self.app, "cmd", self.tmpdir, self.tmpdir, 1, {})
+        events = [
+            signer.signfile("a", "nightly1", "gpg"),
+            signer.signfile("b", "nightly2", "gpg"),
+            signer.signfile("c", "release", "gpg", priority=1),
+        ]
+        self._run(signer, events)
+        self.assertEquals(self.signed, ["release", "nightly1", "nightly2"])
+
+    def testFormatConcurrency(self):
+        signer = ss.Signer(self.app, "cmd", self.tmpdir, self.tmpdir, 4, {},
+                           {"mar": 1})
+        events = []
+        for i in range(4):
+            events.append(signer.signfile("m%i" % i, "m%i" % i, "mar"))
+            events.append(signer.signfile("g%i" % i, "g%i" % i, "gpg"))
+        self._run(signer, events)
+        self.assertEquals(len(self.signed), 8)
+        self.assertEquals(self.max_active["mar"], 1)
+        self.assertTrue(self.max_active["gpg"] > 1)
+
+    def testStats(self):
+        signer = ss.Signer(self.app, "cmd", self.tmpdir, self.tmpdir, 2, {})
+        events = [signer.signfile(h, h, "gpg") for h in ("a", "b", "c")]
+        self.assertEquals(signer.queue_depth(), 3)
+        self._run(signer, events)
+        self.assertEquals(signer.queue_depth(), 0)
+        stats = signer.get_stats()
+        self.assertEquals(stats.keys(), ["gpg"])
+        self.assertEquals(stats["gpg"][0], 3)
+        self.assertTrue(stats["gpg"][2] > 0)
+        # Stats are reset once read
+        self.assertEquals(signer.get_stats(), {})
+
+    def testStopDrainsQueue(self):
+        signer = ss.Signer(self.app, "cmd", self.tmpdir, self.tmpdir, 1, {})
+        events = [signer.signfile(h, h, "gpg") for h in ("a", "b")]
+        signer.stop()
+        self.assertRaises(AssertionError, signer.signfile, "c", "c", "gpg")
+        self._run(signer, events)
+        self.assertEquals(self.signed, ["a", "b"])
+        self.assertTrue(all(w.dead for w in signer.workers))
+
+
+class TestFileIndex(TestCase):
+    def testExpired(self):
+        index = ss.FileIndex()
+        index.update("a", 10, 100)
+        index.update("b", 20, 200)
+        index.update("c", 30, 300)
+        # Using a file moves it to the back
+        index.update("a", last_used=400)
+        self.assertEquals(index.total_size, 60)
+        self.assertEquals(index.expired(250), ["b"])
+        self.assertEquals(index.expired(250), [])
+        self.assertEquals(index.total_size, 40)
+        self.assertEquals(sorted(index.entries), ["a", "c"])
+
+    def testMaxSize(self):
+        index = ss.FileIndex()
+        index.update("a", 10, 100)
+        index.update("b", 20, 200)
+        index.update("c", 30, 300)
+        self.assertEquals(index.expired(0, max_size=35), ["a", "b"])
+        self.assertEquals(index.total_size, 30)
+
+    def testLimit(self):
+        index = ss.FileIndex()
+        for i in range(10):
+            index.update(str(i), 1, i)
+        self.assertEquals(index.expired(100, limit=3), ["0", "1", "2"])
+        self.assertEquals(len(index), 7)
+
+    def testCompact(self):
+        index = ss.FileIndex()
+        for i in range(3000):
+            index.update("a", 1, i)
+        self.assertTrue(len(index.heap) < 2000)
+        self.assertEquals(index.expired(3000), ["a"])
+
+
 class TestTokens(TestCase):
     def testTokenData(self):
         now = int(time.time())
@@ -208,3 +387,235 @@ class TestSigningServer(TestCase):
         # try futzing with the token data
         token = token.replace(slave, '127.0.0.99')
         sign(token, nonce3, 'evenmorestuff.txt', 'stuff!!\n' * 100, slave='127.0.0.99', expect_fail=True)
+
+    def _sign_request(self, data, wait=None, priority=None):
+        token = self.server.get_token('127.0.0.1', 300)
+        sha1 = hashlib.new('sha1', data).hexdigest()
+        params = {
+            'filedata': ('stuff.txt', data),
+            'token': token,
+            'nonce': '',
+            'filename': 'stuff.txt',
+            'sha1': sha1,
+        }
+        if wait:
+            params['wait'] = str(wait)
+        if priority is not None:
+            params['priority'] = str(priority)
+        req = webob.Request.blank("/sign/gpg", POST=params)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        req.method = 'POST'
+        return sha1, req
+
+    def _fake_signfile(self, signed_data, done=True):
+        def signfile(filehash, filename, format_, priority=None):
+            e = Event()
+            if done:
+                outdir = os.path.join(self.tmpdir, 'signed-files', format_)
+                os.makedirs(outdir)
+                open(os.path.join(outdir, filehash), 'wb').write(signed_data)
+                e.set()
+            return e
+        return signfile
+
+    def testUploadWait(self):
+        data = 'stuff\n' * 100
+        sha1, req = self._sign_request(data, wait=10)
+        with mock.patch.object(self.server.signer, 'signfile',
+                               self._fake_signfile('signed!')):
+            resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp.body, 'signed!')
+        self.assertEquals(resp.headers['X-SHA1-Digest'],
+                          hashlib.new('sha1', 'signed!').hexdigest())
+        self.assertEquals(resp.headers['X-Nonce'], 'UNUSED')
+
+    def testUploadWaitTimeout(self):
+        self.server.max_pending_wait = 0
+        data = 'stuff\n' * 100
+        sha1, req = self._sign_request(data, wait=10)
+        with mock.patch.object(self.server.signer, 'signfile',
+                               self._fake_signfile(None, done=False)):
+            resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 202)
+        self.assertEquals(resp.headers['X-Pending'], 'True')
+
+    def testUploadNoWait(self):
+        data = 'stuff\n' * 100
+        sha1, req = self._sign_request(data)
+        with mock.patch.object(self.server.signer, 'signfile',
+                               self._fake_signfile('signed!')):
+            resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 202)
+        self.assertEquals(resp.body, '')
+
+    def testUploadPriority(self):
+        data = 'stuff\n' * 100
+        sha1, req = self._sign_request(data, priority=1)
+        with mock.patch.object(self.server.signer, 'signfile') as signfile:
+            signfile.return_value = Event()
+            resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 202)
+        self.assertEquals(signfile.call_args[0][1:], ('stuff.txt', 'gpg', 1))
+
+    def testGetPendingWait(self):
+        self.server.max_pending_wait = 0
+        data = 'stuff\n' * 100
+        sha1, req = self._sign_request(data)
+        with mock.patch.object(self.server.signer, 'signfile',
+                               self._fake_signfile(None, done=False)):
+            req.get_response(self.server)
+        req = webob.Request.blank("/sign/gpg/%s?wait=30" % sha1)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 404)
+        self.assertEquals(resp.headers['X-Pending'], 'True')
+
+    def _batch_request(self, action, manifest, **params):
+        params['token'] = self.server.get_token('127.0.0.1', 300)
+        params['nonce'] = ''
+        params['manifest'] = json.dumps(manifest)
+        req = webob.Request.blank("/batch/%s" % action, POST=params)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        req.method = 'POST'
+        return req.get_response(self.server)
+
+    def testBatch(self):
+        data = 'stuff\n' * 100
+        sha1 = hashlib.new('sha1', data).hexdigest()
+        manifest = [{'sha1': sha1, 'filename': 'stuff.txt', 'format': 'gpg'}]
+
+        resp = self._batch_request('check', manifest)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(json.loads(resp.body), {
+            'signed': [], 'pending': [], 'missing': [[sha1, 'gpg']],
+            'errors': {}})
+
+        with mock.patch.object(self.server.signer, 'signfile',
+                               self._fake_signfile('signed!')):
+            resp = self._batch_request('upload', manifest,
+                                       **{sha1: ('stuff.txt', data)})
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(self.server.uploads, 1)
+
+        resp = self._batch_request('fetch', manifest, wait='10')
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(int(resp.headers['Content-Length']), len(resp.body))
+        t = tarfile.open(fileobj=StringIO(resp.body))
+        self.assertEquals(t.getnames(), ['manifest.json', 'gpg/%s' % sha1])
+        status = json.load(t.extractfile('manifest.json'))
+        self.assertEquals(status['pending'], [])
+        self.assertEquals(status['signed'], {
+            'gpg/%s' % sha1: hashlib.new('sha1', 'signed!').hexdigest()})
+        self.assertEquals(t.extractfile('gpg/%s' % sha1).read(), 'signed!')
+
+    def testBatchBadUpload(self):
+        sha1 = hashlib.new('sha1', 'stuff').hexdigest()
+        manifest = [{'sha1': sha1, 'filename': 'stuff.txt', 'format': 'gpg'}]
+        resp = self._batch_request('upload', manifest,
+                                   **{sha1: ('stuff.txt', 'stuff')})
+        self.assertEquals(resp.status_code, 200)
+        status = json.loads(resp.body)
+        self.assertEquals(status['errors'], {sha1: '400 File too small'})
+        self.assertEquals(status['missing'], [[sha1, 'gpg']])
+
+    def testBatchBadManifest(self):
+        for entry in [
+            {'sha1': '../../etc/passwd', 'filename': 'x', 'format': 'gpg'},
+            {'sha1': 'a' * 40, 'filename': 'x', 'format': 'bogus'},
+            {'sha1': 'a' * 40},
+        ]:
+            resp = self._batch_request('check', [entry])
+            self.assertEquals(resp.status_code, 400)
+
+    def testGetUsesDigestIndex(self):
+        outdir = os.path.join(self.tmpdir, 'signed-files', 'gpg')
+        os.makedirs(outdir)
+        sha1 = 'a' * 40
+        fn = os.path.join(outdir, sha1)
+        open(fn, 'wb').write('signed!')
+        digest = hashlib.new('sha1', 'signed!').hexdigest()
+        self.server.digests.set(fn, digest)
+        with mock.patch.object(ss, 'sha1sum') as sha1sum:
+            req = webob.Request.blank("/sign/gpg/%s" % sha1)
+            req.environ['REMOTE_ADDR'] = '127.0.0.1'
+            resp = req.get_response(self.server)
+        self.assertEquals(sha1sum.call_count, 0)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp.body, 'signed!')
+        self.assertEquals(resp.headers['X-SHA1-Digest'], digest)
+
+    def testCleanupDigests(self):
+        outdir = os.path.join(self.tmpdir, 'signed-files', 'gpg')
+        os.makedirs(outdir)
+        fn = os.path.join(outdir, 'a' * 40)
+        open(fn, 'wb').write('signed!')
+        self.server.digests.get(fn)
+        self.server.scan_store()
+        # No unsigned file, so the signed file and its digest go away
+        self.assertEquals(os.listdir(outdir), [])
+        self.assertEquals(self.server.digests.digests, {})
+
+    def _store_file(self, filehash, data, mtime):
+        unsigned = os.path.join(self.tmpdir, 'unsigned-files', filehash)
+        open(unsigned, 'wb').write(data)
+        self.server.save_filename(filehash, 'stuff.txt')
+        outdir = os.path.join(self.tmpdir, 'signed-files', 'gpg')
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        signed = os.path.join(outdir, filehash)
+        open(signed, 'wb').write(data)
+        for fn in unsigned, unsigned + '.fn', signed:
+            os.utime(fn, (mtime, mtime))
+        return unsigned, signed
+
+    def testScanStore(self):
+        now = time.time()
+        self._store_file('a' * 40, 'a' * 100, now - 10)
+        self._store_file('b' * 40, 'b' * 100, now - 1000)
+        tmpfile = os.path.join(self.tmpdir, 'unsigned-files', 'tmpXYZ')
+        open(tmpfile, 'wb').write('junk')
+        os.utime(tmpfile, (now - 1000, now - 1000))
+        self.server.store = ss.FileIndex()
+        self.server.scan_store()
+        self.assertEquals(len(self.server.store), 2)
+        self.assertEquals(self.server.store.total_size, 400 + 2 * 9)
+        self.assertAlmostEquals(
+            self.server.store.entries['b' * 40][0], now - 1000, 0)
+        self.assertFalse(os.path.exists(tmpfile))
+
+    def testCleanupExpired(self):
+        now = time.time()
+        a = self._store_file('a' * 40, 'a' * 100, now - 10)
+        b = self._store_file('b' * 40, 'b' * 100, now - 1000)
+        self.server.store = ss.FileIndex()
+        self.server.scan_store()
+        self.server.cleanup()
+        for fn in a:
+            self.assertTrue(os.path.exists(fn))
+        for fn in b:
+            self.assertFalse(os.path.exists(fn))
+        self.assertFalse(os.path.exists(b[0] + '.fn'))
+        self.assertEquals(self.server.store.entries.keys(), ['a' * 40])
+
+    def testCleanupMaxSize(self):
+        now = time.time()
+        a = self._store_file('a' * 40, 'a' * 100, now - 20)
+        b = self._store_file('b' * 40, 'b' * 100, now - 10)
+        self.server.store = ss.FileIndex()
+        self.server.scan_store()
+        self.server.max_store_size = 300
+        self.server.cleanup()
+        # The least recently used file goes first
+        self.assertFalse(os.path.exists(a[0]))
+        self.assertTrue(os.path.exists(b[0]))
+
+    def testCleanupPending(self):
+        now = time.time()
+        a = self._store_file('a' * 40, 'a' * 100, now - 1000)
+        self.server.store = ss.FileIndex()
+        self.server.scan_store()
+        self.server.pending[('a' * 40, 'gpg')] = Event()
+        self.server.cleanup()
+        self.assertTrue(os.path.exists(a[0]))
+        self.assertTrue('a' * 40 in self.server.store)
@@ -0,0 +1,644 @@
+import os
+import gzip
+import time
+import shutil
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+import mock
+import simplejson
+import sqlalchemy as sa
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.trial import unittest as trial
+from twisted.web import http
+from twisted.web.test.requesthelper import DummyRequest
+
+from slavealloc.data import model, queries
+from slavealloc.data.setup import setup as setup_db
+from slavealloc.daemon.service import AllocatorService
+from slavealloc.daemon.http import api
+from slavealloc.logic import allocate, loads, snapshot
+from slavealloc.logic.snapshot import Snapshot
+
+LOOKUP_TABLES = (model.distros, model.bitlengths, model.speeds,
+                 model.purposes, model.datacenters, model.trustlevels,
+                 model.environments, model.pools)
+
+
+# queries built at import time remember the first engine they run on, so
+# all of the tests share one sqlite database, emptied between tests
+tmpdir = None
+
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+    setup_db('sqlite:///%s' % os.path.join(tmpdir, 'slavealloc.db'),
+             dict(connect_args=dict(timeout=30)))
+
+
+def teardown_module():
+    model.metadata.bind.dispose()
+    model.metadata.bind = None
+    shutil.rmtree(tmpdir)
+
+
+class SlaveallocTestCase(TestCase):
+    """Runs each test against an empty sqlite database, but for three of
+    each kind of lookup row"""
+
+    def setUp(self):
+        model.metadata.drop_all()
+        model.metadata.create_all()
+        for tbl in LOOKUP_TABLES:
+            pk = list(tbl.primary_key.columns)[0].name
+            tbl.insert().execute([{pk: i, 'name': '%s%d' % (tbl.name, i)}
+                                  for i in (1, 2, 3)])
+        model.slave_passwords.insert().execute(
+            [dict(poolid=i, password='pw%d' % i) for i in (1, 2, 3)])
+        loads.master_loads.invalidate()
+
+    def tearDown(self):
+        loads.master_loads.invalidate()
+
+    def addMaster(self, masterid, poolid=1, enabled=True):
+        model.masters.insert().execute(
+            masterid=masterid, nickname='bm%02d' % masterid,
+            fqdn='bm%02d.example.com' % masterid, http_port=8000 + masterid,
+            pb_port=9000 + masterid, dcid=1, poolid=poolid, enabled=enabled)
+
+    def addSlave(self, slaveid, poolid=1, distroid=1, **kwargs):
+        row = dict(slaveid=slaveid, name='slave%d' % slaveid,
+                   distroid=distroid, bitsid=1, speedid=1, purposeid=1,
+                   dcid=1, trustid=1, envid=1, poolid=poolid,
+                   basedir='/builds', enabled=True)
+        row.update(kwargs)
+        model.slaves.insert().execute(row)
+
+    def updateSlave(self, slaveid, **values):
+        model.slaves.update(model.slaves.c.slaveid == slaveid,
+                            values=values).execute()
+
+
+class TestPreallocatedTacs(SlaveallocTestCase):
+    def setUp(self):
+        SlaveallocTestCase.setUp(self)
+        self.addMaster(1)
+        self.addMaster(2)
+        self.addSlave(1, current_masterid=1)
+        self.addSlave(2, current_masterid=1)
+
+        self.allocator = AllocatorService()
+        # run "threads" right away
+        self.allocator.deferToThread = defer.maybeDeferred
+        now = time.time()
+        self.allocator.tacs = {'slave1': (now, 'tac1', 1),
+                               'slave2': (now, 'tac2', 1)}
+
+    def _put(self, resource, sets):
+        request = mock.Mock()
+        request.content = StringIO(simplejson.dumps(sets))
+        request.site.allocator = self.allocator
+        resource.render_PUT(request)
+
+    def _getTac(self, slave_name):
+        tacs = []
+        self.allocator.getBuildbotTac(slave_name).addBoth(tacs.append)
+        if isinstance(tacs[0], failure.Failure):
+            tacs[0].raiseException()
+        return tacs[0]
+
+    def testDisableSlave(self):
+        self._put(api.SlaveResource(id=1), {'enabled': False})
+        self.assertEquals(self.allocator.tacs.keys(), ['slave2'])
+        self.assertEquals(self._getTac('slave2'), 'tac2')
+
+    def testLockSlave(self):
+        self._put(api.SlaveResource(id=2), {'locked_masterid': 1})
+        self.assertEquals(self.allocator.tacs.keys(), ['slave1'])
+
+    def testDisableMaster(self):
+        self._put(api.MasterResource(id=1), {'enabled': False})
+        self.assertEquals(self.allocator.tacs, {})
+
+    def testNoAllocator(self):
+        request = mock.Mock()
+        request.content = StringIO(simplejson.dumps({'enabled': False}))
+        request.site.allocator = None
+        api.SlaveResource(id=1).render_PUT(request)
+        self.assertEquals(sorted(self.allocator.tacs), ['slave1', 'slave2'])
+
+    def testCachedTac(self):
+        self.assertEquals(self._getTac('slave1'), 'tac1')
+        # only handed out once
+        self.assertNotEquals(self._getTac('slave1'), 'tac1')
+
+    def testExpired(self):
+        self.allocator.tacs['slave1'] = (time.time() - 7200, 'tac1', 1)
+        self.assertNotEquals(self._getTac('slave1'), 'tac1')
+
+    def _assertStale(self, slave_name):
+        tac = self._getTac(slave_name)
+        self.assertFalse(tac.startswith('tac'))
+        return tac
+
+    # changes made behind the allocator's back, by another process
+
+    def testSlaveDisabledElsewhere(self):
+        self.updateSlave(1, enabled=False)
+        self.assertTrue('SLAVE DISABLED' in self._assertStale('slave1'))
+
+    def testSlaveLockedElsewhere(self):
+        self.updateSlave(1, locked_masterid=2)
+        self.assertTrue('bm02.example.com' in self._assertStale('slave1'))
+
+    def testSlaveMovedElsewhere(self):
+        self.addMaster(3, poolid=2)
+        self.updateSlave(1, current_masterid=2)
+        self._assertStale('slave1')
+        self.updateSlave(2, poolid=2)
+        self.assertTrue('bm03.example.com' in self._assertStale('slave2'))
+
+    def testMasterDisabledElsewhere(self):
+        model.masters.update(model.masters.c.masterid == 1,
+                             values=dict(enabled=False)).execute()
+        self.assertTrue('bm02.example.com' in self._assertStale('slave1'))
+
+
+class TestConcurrentAllocation(SlaveallocTestCase, trial.TestCase):
+    def setUp(self):
+        SlaveallocTestCase.setUp(self)
+        for masterid in (1, 2, 3):
+            self.addMaster(masterid)
+        # slaves 1-6 are in one silo, 11-16 in another
+        for slaveid in range(1, 7) + range(11, 17):
+            self.addSlave(slaveid, distroid=slaveid / 10 + 1)
+
+        self.allocator = AllocatorService(max_threads=4)
+        self.allocator.startService()
+        self.addCleanup(self.allocator.stopService)
+        # silo -> list of (start, end, counts seen)
+        self.runs = {}
+        real_allocate = self.allocator._allocate
+
+        def _allocate(slave_name, silo):
+            start = time.time()
+            seen = self._counts(silo)
+            # a slow database
+            time.sleep(0.05)
+            result = real_allocate(slave_name, silo)
+            self.runs.setdefault(silo, []).append(
+                (start, time.time(), seen))
+            return result
+        self.allocator._allocate = _allocate
+
+    def _counts(self, silo):
+        q = sa.select([model.slaves.c.current_masterid],
+                      model.slaves.c.distroid == silo[1])
+        counts = dict((masterid, 0) for masterid in (1, 2, 3))
+        for row in q.execute():
+            if row.current_masterid:
+                counts[row.current_masterid] += 1
+        return counts
+
+    @defer.inlineCallbacks
+    def testSilos(self):
+        yield defer.DeferredList(
+            [self.allocator.getBuildbotTac('slave%d' % i)
+             for i in range(1, 7) + range(11, 17)], fireOnOneErrback=True)
+
+        self.assertEquals(len(self.runs), 2)
+        for silo, runs in self.runs.items():
+            runs.sort()
+            for i, (start, end, seen) in enumerate(runs):
+                # one at a time, each seeing all of the previous ones
+                if i:
+                    self.assertTrue(start >= runs[i - 1][1])
+                self.assertEquals(sum(seen.values()), i)
+                self.assertTrue(max(seen.values()) - min(seen.values()) <= 1)
+            self.assertEquals(self._counts(silo), {1: 2, 2: 2, 3: 2})
+
+        # but the silos overlap
+        runs1, runs2 = self.runs.values()
+        self.assertTrue(runs1[0][0] < runs2[-1][1] and
+                        runs2[0][0] < runs1[-1][1])
+
+    @defer.inlineCallbacks
+    def testSiloChanged(self):
+        self.updateSlave(1, current_masterid=1)
+        old_silo = allocate.get_silo('slave2')
+        # slave 2 moves to slave 11's silo between get_silo and its
+        # allocation
+        self.updateSlave(2, distroid=2)
+        with mock.patch.object(allocate, 'get_silo', lambda name: old_silo):
+            yield self.allocator.getBuildbotTac('slave2')
+        new_silo = allocate.get_silo('slave2')
+        self.assertEquals([len(self.runs[s]) for s in (old_silo, new_silo)],
+                          [1, 1])
+        self.assertEquals(self._counts(old_silo), {1: 1, 2: 0, 3: 0})
+        self.assertEquals(self._counts(new_silo), {1: 1, 2: 0, 3: 0})
+
+
+class TestAllocateMany(SlaveallocTestCase):
+    def setUp(self):
+        SlaveallocTestCase.setUp(self)
+        for masterid in (1, 2, 3):
+            self.addMaster(masterid)
+        # slaves 1-9 are in one silo, 10-13 in another
+        for slaveid in range(1, 10):
+            self.addSlave(slaveid)
+        for slaveid in range(10, 14):
+            self.addSlave(slaveid, distroid=2)
+
+    def _masters(self):
+        q = sa.select([model.slaves.c.slaveid,
+                       model.slaves.c.current_masterid])
+        return dict((row.slaveid, row.current_masterid)
+                    for row in q.execute())
+
+    def _counts(self, slaveids):
+        masters = self._masters()
+        counts = dict((masterid, 0) for masterid in (1, 2, 3))
+        for slaveid in slaveids:
+            counts[masters[slaveid]] += 1
+        return counts
+
+    def testBalanced(self):
+        allocations = allocate.allocate_many(
+            ['slave%d' % i for i in range(1, 14)])
+        self.assertEquals(len(allocations), 13)
+        self.assertEquals(self._counts(range(1, 10)), {1: 3, 2: 3, 3: 3})
+        self.assertEquals(sorted(self._counts(range(10, 14)).values()),
+                          [1, 1, 2])
+        for allocation in allocations:
+            self.assertEquals(allocation.slave_password, 'pw1')
+
+    def testExistingAllocations(self):
+        # slaves 1-3 are already on master 1, and aren't being reallocated
+        for slaveid in (1, 2, 3):
+            self.updateSlave(slaveid, current_masterid=1)
+        allocate.allocate_many(['slave%d' % i for i in range(4, 10)])
+        self.assertEquals(self._counts(range(1, 10)), {1: 3, 2: 3, 3: 3})
+
+    def testLocked(self):
+        self.updateSlave(1, locked_masterid=3)
+        self.updateSlave(2, locked_masterid=3)
+        allocations = allocate.allocate_many(
+            ['slave%d' % i for i in range(1, 10)])
+        masters = self._masters()
+        self.assertEquals((masters[1], masters[2]), (3, 3))
+        # the locked slaves count towards master 3's load
+        self.assertEquals(self._counts(range(1, 10)), {1: 3, 2: 3, 3: 3})
+        self.assertEquals(allocations[0].master_nickname, 'bm03')
+
+    def testSkipped(self):
+        self.updateSlave(1, enabled=False, current_masterid=2)
+        self.updateSlave(2, poolid=2)
+        allocations = allocate.allocate_many(['slave1', 'slave2', 'slave3',
+                                               'nosuchslave'])
+        # slave2's pool has no masters
+        self.assertEquals([(a.slavename, a.masterid) for a in allocations],
+                          [('slave1', None), ('slave3', 1)])
+        masters = self._masters()
+        self.assertEquals((masters[1], masters[2]), (None, None))
+
+    def testOneStatement(self):
+        updates = []
+
+        def before_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+            if statement.startswith('UPDATE'):
+                updates.append((parameters, executemany))
+        sa.event.listen(model.metadata.bind, 'before_cursor_execute',
+                        before_execute)
+        allocate.allocate_many(['slave%d' % i for i in range(1, 10)])
+        self.assertEquals(len(updates), 1)
+        parameters, executemany = updates[0]
+        self.assertTrue(executemany)
+        self.assertEquals(len(parameters), 9)
+
+    def testRollback(self):
+        real_Allocation = allocate.Allocation
+
+        def Allocation(slavename, prefetched=None):
+            if slavename == 'slave5':
+                raise RuntimeError("oops")
+            return real_Allocation(slavename, prefetched)
+        with mock.patch.object(allocate, 'Allocation', Allocation):
+            self.assertRaises(RuntimeError, allocate.allocate_many,
+                              ['slave%d' % i for i in range(1, 10)])
+        self.assertEquals(set(self._masters().values()), set([None]))
+        # counts for allocations that were rolled back are forgotten
+        self.assertEquals(loads.master_loads.loaded, None)
+
+
+class TestMasterLoads(SlaveallocTestCase):
+    def setUp(self):
+        SlaveallocTestCase.setUp(self)
+        for masterid in (1, 2, 3):
+            self.addMaster(masterid)
+        self.addMaster(4, enabled=False)
+        self.addMaster(5, poolid=2)
+        self.loads = loads.MasterLoads()
+
+    def _silo(self, slaveid):
+        return allocate.get_silo('slave%d' % slaveid)
+
+    def _best(self, slaveid):
+        master = self.loads.best_master(slaveid, self._silo(slaveid))
+        return master and master.masterid
+
+    def _commit(self, slaveid, masterid):
+        self.updateSlave(slaveid, current_masterid=masterid)
+        self.loads.commit(slaveid, self._silo(slaveid), masterid)
+
+    def testMatchesQuery(self):
+        # three silos in pool 1, and one in pool 2
+        for slaveid in range(1, 31):
+            self.addSlave(slaveid, distroid=slaveid % 3 + 1,
+                          poolid=slaveid % 5 == 0 and 2 or 1)
+        # allocate every slave, then reallocate some, and move some to other
+        # silos and masters, checking every pick against the query
+        sequence = range(1, 31) + range(1, 31, 4)
+        for i, slaveid in enumerate(sequence):
+            if i % 7 == 6:
+                self.updateSlave(slaveid, distroid=(slaveid + i) % 3 + 1)
+                self._commit(slaveid, i % 3 + 1)
+            expected = queries.best_master.execute(slaveid=slaveid).fetchone()
+            best = self._best(slaveid)
+            self.assertEquals(best, expected.masterid,
+                              "slave%d: %s != %s" % (slaveid, best,
+                                                     expected.masterid))
+            self._commit(slaveid, best)
+
+        # and the counts agree with a fresh load
+        fresh = loads.MasterLoads()
+        fresh._load()
+        self.assertEquals(self.loads.counts, fresh.counts)
+
+    def testTies(self):
+        self.addSlave(1)
+        self.assertEquals(self._best(1), 1)
+        self._commit(1, 1)
+        self.addSlave(2)
+        self.assertEquals(self._best(2), 2)
+
+    def testNotCountingSelf(self):
+        self.addSlave(1, current_masterid=2)
+        self.addSlave(2, current_masterid=1)
+        self.addSlave(3, current_masterid=3)
+        # slave 1 stays where it is, rather than moving to master 1
+        self.assertEquals(self._best(1), 2)
+
+    def testNoMasters(self):
+        self.addSlave(1, poolid=3)
+        self.assertEquals(self._best(1), None)
+
+    def testMoveSilo(self):
+        self.addSlave(1, current_masterid=1)
+        self.addSlave(2, distroid=2)
+        self.assertEquals(self._best(2), 1)
+        # slave 1 moves to slave 2's silo, taking master 1 with it
+        self.updateSlave(1, distroid=2)
+        self._commit(1, 1)
+        self.assertEquals(self._best(2), 2)
+        self.addSlave(3)
+        self.assertEquals(self._best(3), 1)
+
+    def testCommitBeforeLoad(self):
+        self.addSlave(1)
+        self.addSlave(2)
+        # not in the database yet, as in allocate_many
+        self.loads.commit(1, self._silo(1), 1)
+        self.assertEquals(self._best(2), 2)
+
+    def testReload(self):
+        self.addSlave(1)
+        self.addSlave(2)
+        self.assertEquals(self._best(2), 1)
+        # another process allocates slave 1
+        self.updateSlave(1, current_masterid=1)
+        self.assertEquals(self._best(2), 1)
+        self.loads.loaded -= self.loads.max_age + 1
+        self.assertEquals(self._best(2), 2)
+        self.updateSlave(1, current_masterid=2)
+        self.loads.invalidate()
+        self.assertEquals(self._best(2), 1)
+
+
+class TestSnapshot(SlaveallocTestCase):
+    def setUp(self):
+        SlaveallocTestCase.setUp(self)
+        for masterid in (1, 2):
+            self.addMaster(masterid)
+        for slaveid in (1, 2, 3):
+            self.addSlave(slaveid)
+        self.snapshot = Snapshot(queries.denormalized_slaves(),
+                                 model.slaves.c.slaveid,
+                                 poll_columns=[model.slaves.c.current_masterid])
+
+    def _ids(self, rows):
+        return [row['slaveid'] for row in rows]
+
+    def testLoad(self):
+        version = self.snapshot.refresh()
+        rows, deleted = self.snapshot.get_rows()
+        self.assertEquals(self._ids(rows), [1, 2, 3])
+        self.assertEquals(rows[0]['pool'], 'pools1')
+        self.assertEquals(deleted, [])
+        # nothing changed
+        self.assertEquals(self.snapshot.refresh(), version)
+        self.assertEquals(self.snapshot.get_rows(version), ([], []))
+
+    def testInvalidate(self):
+        v1 = self.snapshot.refresh()
+        self.updateSlave(2, notes='changed')
+        # not seen until invalidated
+        self.assertEquals(self.snapshot.refresh(), v1)
+        self.snapshot.invalidate([2, 3])
+        v2 = self.snapshot.refresh()
+        self.assertTrue(v2 > v1)
+        rows, deleted = self.snapshot.get_rows(v1)
+        # slave 3 was reloaded, but hasn't changed
+        self.assertEquals(self._ids(rows), [2])
+        self.assertEquals(rows[0]['notes'], 'changed')
+        self.assertEquals(self._ids(self.snapshot.get_rows()[0]), [1, 2, 3])
+
+    def testDelete(self):
+        v1 = self.snapshot.refresh()
+        model.slaves.delete(model.slaves.c.slaveid == 2).execute()
+        self.snapshot.invalidate([2])
+        v2 = self.snapshot.refresh()
+        self.assertEquals(self.snapshot.get_rows(v1), ([], [2]))
+        self.assertEquals(self.snapshot.get_rows(v2), ([], []))
+
+        # a full reload notices deletions too
+        model.slaves.delete(model.slaves.c.slaveid == 3).execute()
+        self.snapshot.invalidate()
+        self.snapshot.refresh()
+        self.assertEquals(self.snapshot.get_rows(v1), ([], [2, 3]))
+        self.assertEquals(self._ids(self.snapshot.get_rows()[0]), [1])
+
+        # and a row that comes back isn't deleted any more
+        self.addSlave(2)
+        self.snapshot.invalidate([2])
+        self.snapshot.refresh()
+        rows, deleted = self.snapshot.get_rows(v1)
+        self.assertEquals((self._ids(rows), deleted), ([2], [3]))
+
+    def testPoll(self):
+        v1 = self.snapshot.refresh()
+        # changes made by another process
+        self.updateSlave(1, current_masterid=2)
+        self.addSlave(4)
+        model.slaves.delete(model.slaves.c.slaveid == 3).execute()
+        self.assertEquals(self.snapshot.refresh(), v1)
+
+        self.snapshot.last_poll = 0
+        self.snapshot.refresh()
+        rows, deleted = self.snapshot.get_rows(v1)
+        self.assertEquals((self._ids(rows), deleted), ([1, 4], [3]))
+        self.assertEquals(rows[0]['current_master'], 'bm02')
+
+    def testPollMasters(self):
+        masters = Snapshot(queries.denormalized_masters,
+                           model.masters.c.masterid,
+                           snapshot.masters.poll_columns)
+        v1 = masters.refresh()
+        model.masters.update(model.masters.c.masterid == 2,
+                             values=dict(enabled=False)).execute()
+        self.addMaster(3)
+        masters.last_poll = 0
+        masters.refresh()
+        rows, deleted = masters.get_rows(v1)
+        self.assertEquals([(r['masterid'], r['enabled']) for r in rows],
+                          [(2, False), (3, True)])
+
+
+class FakeRequest(DummyRequest):
+    method = 'GET'
+    setETag = http.Request.setETag.im_func
+
+    def __init__(self, args={}, headers={}):
+        DummyRequest.__init__(self, [])
+        self.args = dict((k, [v]) for k, v in args.items())
+        for name, value in headers.items():
+            self.requestHeaders.setRawHeaders(name, [value])
+
+
+class TestSnapshotCollection(SlaveallocTestCase):
+    def setUp(self):
+        SlaveallocTestCase.setUp(self)
+        self.addMaster(1)
+        self.addSlave(1, poolid=1)
+        self.addSlave(2, poolid=2)
+        self.addSlave(3, poolid=1)
+        self.snapshot = Snapshot(queries.denormalized_slaves(),
+                                 model.slaves.c.slaveid)
+        self.patcher = mock.patch.object(api.SlavesResource, 'snapshot',
+                                         self.snapshot)
+        self.patcher.start()
+        self.resource = api.SlavesResource()
+
+    def tearDown(self):
+        self.patcher.stop()
+        SlaveallocTestCase.tearDown(self)
+
+    def _get(self, args={}, headers={}):
+        request = FakeRequest(args, headers)
+        body = self.resource.render_GET(request)
+        return request, body
+
+    def _json(self, args={}, headers={}):
+        request, body = self._get(args, headers)
+        self.assertEquals(request.responseCode, None)
+        return simplejson.loads(body)
+
+    def _update(self, slaveid, **values):
+        self.updateSlave(slaveid, **values)
+        self.snapshot.invalidate([slaveid])
+
+    def testFull(self):
+        rows = self._json()
+        self.assertEquals([r['name'] for r in rows],
+                          ['slave1', 'slave2', 'slave3'])
+        rows = self._json({'pool': 'pools2'})
+        self.assertEquals([r['name'] for r in rows], ['slave2'])
+
+    def testSince(self):
+        request, body = self._get()
+        version = self.snapshot.version
+        self.assertEquals(request.etag, '"%d"' % version)
+
+        self._update(3, notes='changed')
+        result = self._json({'since': str(version)})
+        self.assertEquals(result['version'], self.snapshot.version)
+        self.assertFalse(result['full'])
+        self.assertEquals([r['slaveid'] for r in result['rows']], [3])
+        self.assertEquals(result['deleted'], [])
+
+        model.slaves.delete(model.slaves.c.slaveid == 1).execute()
+        self.snapshot.invalidate([1])
+        result = self._json({'since': str(version)})
+        self.assertEquals([r['slaveid'] for r in result['rows']], [3])
+        self.assertEquals(result['deleted'], [1])
+
+    def testSinceFiltered(self):
+        self._get()
+        version = self.snapshot.version
+        # slave 3 moves out of the pool; to a client that only asked for
+        # pools1, it's gone
+        self._update(3, poolid=2)
+        result = self._json({'since': str(version), 'pool': 'pools1'})
+        self.assertEquals((result['rows'], result['deleted']), ([], [3]))
+
+    def testSinceTooOld(self):
+        self._get()
+        for since in (self.snapshot.base_version - 1,
+                      self.snapshot.version + 1):
+            result = self._json({'since': str(since)})
+            self.assertTrue(result['full'])
+            self.assertEquals(len(result['rows']), 3)
+
+    def testBadSince(self):
+        request, body = self._get({'since': 'yesterday'})
+        self.assertEquals(request.responseCode, 400)
+
+    def testNotModified(self):
+        request, body = self._get()
+        request, body = self._get(headers={'if-none-match': request.etag})
+        self.assertEquals(request.responseCode, http.NOT_MODIFIED)
+        self.assertEquals(body, '')
+
+        self._update(1, notes='changed')
+        self._json(headers={'if-none-match': request.etag})
+
+    def testGzip(self):
+        request, body = self._get(headers={'accept-encoding': 'gzip'})
+        self.assertEquals(request.responseHeaders.getRawHeaders(
+            'content-encoding'), ['gzip'])
+        self.assertTrue(request.etag.endswith('-gz"'))
+        rows = simplejson.loads(gzip.GzipFile(fileobj=StringIO(body)).read())
+        self.assertEquals(len(rows), 3)
+
+    def testResponseCache(self):
+        serialized = []
+        orig_serialize = self.resource.serialize
+
+        def serialize(request, version, since):
+            serialized.append(since)
+            return orig_serialize(request, version, since)
+        self.resource.serialize = serialize
+
+        self._get()
+        version = self.snapshot.version
+        body = self._get({'since': str(version)})[1]
+        self.assertEquals(self._get({'since': str(version)})[1], body)
+        self.assertEquals(serialized, [None, version])
+
+        # a change clears the cache
+        self._update(1, notes='changed')
+        self._get({'since': str(version)})
+        self.assertEquals(serialized, [None, version, version])
@@ -0,0 +1,106 @@
+import socket
+import threading
+import time
+import unittest
+import BaseHTTPServer
+
+from util.post_file import MultipartPoster, split_host
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, body))
+        time.sleep(self.server.delay)
+        response = "RETURN\t%d" % len(self.server.requests)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response)))
+        if self.server.close_connections:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(response)
+        if self.server.drop_connections:
+            # close the connection without saying so, as when a keep-alive
+            # connection times out on the server
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMultipartPoster(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.close_connections = False
+        self.server.drop_connections = False
+        self.server.delay = 0
+        self.server.handle_error = lambda request, client_address: None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.host = 'http://127.0.0.1:%d/graphs' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def _postAll(self, count):
+        poster = MultipartPoster(self.host)
+        try:
+            return [poster.post('/collect', [("key", "value")],
+                                [("filename", "data", "result %d" % i)])
+                    for i in range(count)]
+        finally:
+            poster.close()
+
+    def testSplitHost(self):
+        self.assertEquals(split_host('http://example.com/graphs', '/collect'),
+                          ('example.com', '/graphs/collect'))
+        self.assertEquals(split_host('example.com', '/collect'),
+                          ('example.com', '/collect'))
+
+    def testOneConnection(self):
+        responses = self._postAll(3)
+        self.assertEquals(responses, ["RETURN\t1", "RETURN\t2", "RETURN\t3"])
+        self.assertEquals(self.server.connections, 1)
+        self.assertEquals([path for path, body in self.server.requests],
+                          ['/graphs/collect'] * 3)
+        self.assertTrue('result 2' in self.server.requests[2][1])
+
+    def testServerClosesConnection(self):
+        self.server.close_connections = True
+        responses = self._postAll(3)
+        self.assertEquals(responses, ["RETURN\t1", "RETURN\t2", "RETURN\t3"])
+        self.assertEquals(self.server.connections, 3)
+
+    def testServerDropsConnection(self):
+        self.server.drop_connections = True
+        responses = self._postAll(3)
+        self.assertEquals(responses, ["RETURN\t1", "RETURN\t2", "RETURN\t3"])
+        self.assertEquals(self.server.connections, 3)
+        self.assertEquals(len(self.server.requests), 3)
+
+    def testNoRetryOnTimeout(self):
+        poster = MultipartPoster(self.host)
+        old_timeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(0.5)
+        try:
+            poster.post('/collect', [], [("filename", "data", "result 0")])
+            self.server.delay = 1
+            self.assertRaises(socket.timeout, poster.post, '/collect', [],
+                              [("filename", "data", "result 1")])
+        finally:
+            socket.setdefaulttimeout(old_timeout)
+            poster.close()
+        # wait for the server to finish with the request
+        self.server.delay = 0
+        self.server.shutdown()
+        self.assertEquals(len(self.server.requests), 2)
@@ -62,12 +62,14 @@ def downloadReleaseBuilds(stageServer, productName, brandName, version,
 
 
 def downloadUpdate(stageServer, productName, version, buildNumber,
-                   platform, locale, candidatesDir=None):
+                   platform, locale, candidatesDir=None, destDir=None):
     if candidatesDir is None:
         candidatesDir = makeCandidatesDir(productName, version, buildNumber,
                                           protocol='http', server=stageServer)
     fileName = '%s-%s.complete.mar' % (productName, version)
     destFileName = '%s-%s.%s.complete.mar' % (productName, version, locale)
+    if destDir:
+        destFileName = path.join(destDir, destFileName)
     platformDir = buildbot2ftp(platform)
     url = '/'.join([p.strip('/') for p in [
         candidatesDir, 'update', platformDir, locale, fileName]])
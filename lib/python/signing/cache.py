@@ -0,0 +1,197 @@
+"""Local cache of signed files, shared by all the signtool processes on a
+machine.
+
+Signed files are stored as <cachedir>/<format>/<hash of the unsigned file>,
+next to a <hash>.sha1 file recording the digest, size and mtime of the signed
+file. Entries are written to temporary files and renamed into place, so
+concurrent readers only ever see complete entries.
+
+Cache hits are cloned into place (a reflink where the filesystem supports
+it, otherwise a hard link), falling back to a copy. An entry whose size or
+mtime no longer match what was recorded has been modified through one of its
+links, and is discarded.
+"""
+import os
+import errno
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+from util.file import copyfile, safe_unlink, sha1sum
+
+import logging
+log = logging.getLogger(__name__)
+
+# ioctl to make dst share src's data blocks, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def clonefile(src, dst):
+    """Make `dst` a copy of `src`, as cheaply as the filesystem allows.
+    `dst` must not exist."""
+    if fcntl:
+        try:
+            srcfp = open(src, 'rb')
+            dstfp = open(dst, 'wb')
+            try:
+                fcntl.ioctl(dstfp.fileno(), FICLONE, srcfp.fileno())
+                return
+            finally:
+                srcfp.close()
+                dstfp.close()
+        except (IOError, OSError):
+            safe_unlink(dst)
+
+    if hasattr(os, 'link'):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    copyfile(src, dst)
+
+
+class SigningCache(object):
+    """Cache of signed files in `cachedir`, holding up to `max_size` bytes.
+    If `max_size` is None the cache is unbounded."""
+    suffix = ".sha1"
+
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+
+    def _path(self, fmt, filehash):
+        return os.path.join(self.cachedir, fmt, filehash)
+
+    def _read_info(self, cached_fn):
+        try:
+            digest, size, mtime = open(cached_fn + self.suffix, 'rb').read().split()
+            return digest, int(size), float(mtime)
+        except (IOError, ValueError):
+            return None
+
+    def get(self, fmt, filehash, dest):
+        """Put the signed copy of the file with hash `filehash` at `dest`.
+
+        Returns the digest of the signed file, or None if it isn't in the
+        cache."""
+        cached_fn = self._path(fmt, filehash)
+        info = self._read_info(cached_fn)
+        if not info:
+            return None
+        digest, size, mtime = info
+        try:
+            st = os.stat(cached_fn)
+        except OSError:
+            return None
+        if (st.st_size, st.st_mtime) != (size, mtime):
+            log.info("%s: cached copy has been modified; discarding it",
+                     filehash)
+            self.remove(fmt, filehash)
+            return None
+
+        tmpfile = dest + '.tmp'
+        safe_unlink(tmpfile)
+        try:
+            clonefile(cached_fn, tmpfile)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Evicted by somebody else while we were looking at it
+            safe_unlink(tmpfile)
+            return None
+        if os.path.exists(dest):
+            os.unlink(dest)
+        os.rename(tmpfile, dest)
+        # The info file's mtime is when the entry was last used
+        try:
+            os.utime(cached_fn + self.suffix, None)
+        except OSError:
+            pass
+        return digest
+
+    def put(self, fmt, filehash, signed_fn, digest=None):
+        """Store `signed_fn` as the signed copy of the file with hash
+        `filehash`. `digest` is the hash of `signed_fn`, if it's known."""
+        if digest is None:
+            digest = sha1sum(signed_fn)
+        cached_fn = self._path(fmt, filehash)
+        cached_dir = os.path.dirname(cached_fn)
+        if not os.path.exists(cached_dir):
+            log.debug("Creating %s", cached_dir)
+            try:
+                os.makedirs(cached_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        log.info("Copying %s to cache %s", signed_fn, cached_fn)
+        fd, tmpname = tempfile.mkstemp(dir=cached_dir)
+        os.close(fd)
+        os.unlink(tmpname)
+        try:
+            clonefile(signed_fn, tmpname)
+            st = os.stat(tmpname)
+            os.rename(tmpname, cached_fn)
+        except:
+            safe_unlink(tmpname)
+            raise
+
+        fd, tmpname = tempfile.mkstemp(dir=cached_dir)
+        fp = os.fdopen(fd, 'wb')
+        fp.write("%s %i %r\n" % (digest, st.st_size, st.st_mtime))
+        fp.close()
+        os.rename(tmpname, cached_fn + self.suffix)
+
+    def remove(self, fmt, filehash):
+        cached_fn = self._path(fmt, filehash)
+        # Remove the info first, so nobody trusts a half deleted entry
+        safe_unlink(cached_fn + self.suffix)
+        safe_unlink(cached_fn)
+
+    def entries(self):
+        """Returns a list of (last used, size, format, filehash) for the
+        entries in the cache"""
+        retval = []
+        if not os.path.isdir(self.cachedir):
+            return retval
+        for fmt in os.listdir(self.cachedir):
+            fmt_dir = os.path.join(self.cachedir, fmt)
+            if not os.path.isdir(fmt_dir):
+                continue
+            for f in os.listdir(fmt_dir):
+                if f.endswith(self.suffix) or f.startswith('tmp'):
+                    continue
+                cached_fn = os.path.join(fmt_dir, f)
+                try:
+                    size = os.path.getsize(cached_fn)
+                    try:
+                        last_used = os.path.getmtime(cached_fn + self.suffix)
+                    except OSError:
+                        # Entries from older versions of signtool
+                        last_used = os.path.getmtime(cached_fn)
+                except OSError:
+                    continue
+                retval.append((last_used, size, fmt, f))
+        return retval
+
+    def cleanup(self):
+        """Evict the least recently used entries until the cache is no
+        bigger than max_size"""
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for last_used, size, fmt, filehash in entries:
+            if total <= self.max_size:
+                break
+            log.debug("Evicting %s/%s from the cache", fmt, filehash)
+            self.remove(fmt, filehash)
+            total -= size
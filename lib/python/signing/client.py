@@ -6,6 +6,13 @@ import time
 import socket
 import httplib
 import urllib
+import threading
+import Queue
+import tarfile
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 # TODO: Use util.command
 from subprocess import check_call
@@ -13,13 +20,45 @@ from subprocess import check_call
 from poster.encode import multipart_encode
 
 from util.file import sha1sum, copyfile
+from signing.cache import SigningCache
 
 import logging
 log = logging.getLogger(__name__)
 
+# Serializes access to the nonce file when signing files concurrently
+_nonce_lock = threading.Lock()
 
-def getfile(baseurl, filehash, format_):
+
+def read_nonce(noncefile):
+    _nonce_lock.acquire()
+    try:
+        try:
+            return open(noncefile, 'rb').read()
+        except IOError:
+            return ""
+    finally:
+        _nonce_lock.release()
+
+
+def write_nonce(noncefile, nonce):
+    _nonce_lock.acquire()
+    try:
+        open(noncefile, 'wb').write(nonce)
+    finally:
+        _nonce_lock.release()
+
+
+# How long we ask the server to hold on to our requests while our file is
+# being signed
+PENDING_WAIT = 60
+
+
+def getfile(baseurl, filehash, format_, wait=None):
+    """GET the signed copy of filehash. If `wait` is set, the server holds on
+    to the request for up to `wait` seconds while the file is being signed"""
     url = "%s/sign/%s/%s" % (baseurl, format_, filehash)
+    if wait:
+        url += "?wait=%i" % wait
     log.debug("%s: GET %s", filehash, url)
     r = urllib2.Request(url)
     return urllib2.urlopen(r)
@@ -40,8 +79,37 @@ def get_token(baseurl, username, password, slave_ip, duration):
     return urllib2.urlopen(r).read()
 
 
-def remote_signfile(options, urls, filename, fmt, token, dest=None):
-    filehash = sha1sum(filename)
+def save_signed(req, filehash, dest, responsehash=None):
+    """Write the signed data read from `req` to `dest`.
+
+    Returns the hash of the signed data, or None if it doesn't match
+    `responsehash` (by default the X-SHA1-Digest header sent by the
+    server)."""
+    if responsehash is None:
+        responsehash = req.info()['X-SHA1-Digest']
+    tmpfile = dest + '.tmp'
+    fp = open(tmpfile, 'wb')
+    hsh = hashlib.new('sha1')
+    while True:
+        data = req.read(1024 ** 2)
+        if not data:
+            break
+        hsh.update(data)
+        fp.write(data)
+    fp.close()
+    if hsh.hexdigest() != responsehash:
+        log.warn("%s: hash mismatch; trying to download again", filehash)
+        os.unlink(tmpfile)
+        return None
+    if os.path.exists(dest):
+        os.unlink(dest)
+    os.rename(tmpfile, dest)
+    return responsehash
+
+
+def get_dest(filename, fmt, dest=None):
+    """Returns where the signed copy of `filename` should be written,
+    creating its parent directory if required"""
     if dest is None:
         dest = filename
 
@@ -51,42 +119,66 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
     parent_dir = os.path.dirname(os.path.abspath(dest))
     if not os.path.exists(parent_dir):
         os.makedirs(parent_dir)
+    return dest
+
+
+def get_cache(options):
+    """Returns the SigningCache configured by `options`, or None if we
+    aren't using one"""
+    if not options.cachedir:
+        return None
+    return SigningCache(options.cachedir, getattr(options, 'cache_size', None))
+
+
+def check_cache(options, filename, filehash, fmt, dest):
+    """Copy the signed copy of `filename` from our cache to `dest`, if it's
+    there. Returns True if the file was found in the cache."""
+    cache = get_cache(options)
+    if not cache:
+        return False
+    log.debug("%s: checking cache", filehash)
+    newhash = cache.get(fmt, filehash, dest)
+    if not newhash:
+        return False
+    log.info("%s: exists in the cache; copied to %s", filehash, dest)
+    # See if we should re-sign NSS
+    if options.nsscmd and filehash != newhash and os.path.exists(os.path.splitext(filename)[0] + ".chk"):
+        cmd = '%s "%s"' % (options.nsscmd, dest)
+        log.info("Regenerating .chk file")
+        log.debug("Running %s", cmd)
+        check_call(cmd, shell=True)
+    return True
+
+
+def finish_signfile(options, filename, filehash, responsehash, fmt, dest):
+    """Post-process the signed copy of `filename` that's been written to
+    `dest`: regenerate NSS .chk files and store it in our cache."""
+    log.info("%s: OK", filehash)
+    # See if we should re-sign NSS
+    if options.nsscmd and filehash != responsehash and os.path.exists(os.path.splitext(filename)[0] + ".chk"):
+        cmd = '%s "%s"' % (options.nsscmd, dest)
+        log.info("Regenerating .chk file")
+        log.debug("Running %s", cmd)
+        check_call(cmd, shell=True)
+
+    # Possibly write to our cache
+    cache = get_cache(options)
+    if cache:
+        cache.put(fmt, filehash, dest, responsehash)
 
-    # Check the cache
-    cached_fn = None
-    if options.cachedir:
-        log.debug("%s: checking cache", filehash)
-        cached_fn = os.path.join(options.cachedir, fmt, filehash)
-        if os.path.exists(cached_fn):
-            log.info("%s: exists in the cache; copying to %s", filehash, dest)
-            cached_fp = open(cached_fn, 'rb')
-            tmpfile = dest + '.tmp'
-            fp = open(tmpfile, 'wb')
-            hsh = hashlib.new('sha1')
-            while True:
-                data = cached_fp.read(1024 ** 2)
-                if not data:
-                    break
-                hsh.update(data)
-                fp.write(data)
-            fp.close()
-            newhash = hsh.hexdigest()
-            if os.path.exists(dest):
-                os.unlink(dest)
-            os.rename(tmpfile, dest)
-            log.info("%s: OK", filehash)
-            # See if we should re-sign NSS
-            if options.nsscmd and filehash != newhash and os.path.exists(os.path.splitext(filename)[0] + ".chk"):
-                cmd = '%s "%s"' % (options.nsscmd, dest)
-                log.info("Regenerating .chk file")
-                log.debug("Running %s", cmd)
-                check_call(cmd, shell=True)
-            return True
+
+def remote_signfile(options, urls, filename, fmt, token, dest=None):
+    filehash = sha1sum(filename)
+    dest = get_dest(filename, fmt, dest)
+
+    if check_cache(options, filename, filehash, fmt, dest):
+        return True
 
     errors = 0
     pendings = 0
     max_errors = 20
     max_pending_tries = 300
+    responsehash = None
     while True:
         if pendings >= max_pending_tries:
             log.error("%s: giving up after %i tries", filehash, pendings)
@@ -98,49 +190,22 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
         try:
             url = urls[0]
             log.info("%s: processing %s on %s", filehash, filename, url)
-            req = getfile(url, filehash, fmt)
-            headers = req.info()
-            responsehash = headers['X-SHA1-Digest']
-            tmpfile = dest + '.tmp'
-            fp = open(tmpfile, 'wb')
-            while True:
-                data = req.read(1024 ** 2)
-                if not data:
-                    break
-                fp.write(data)
-            fp.close()
-            newhash = sha1sum(tmpfile)
-            if newhash != responsehash:
-                log.warn(
-                    "%s: hash mismatch; trying to download again", filehash)
-                os.unlink(tmpfile)
+            start = time.time()
+            req = getfile(url, filehash, fmt, wait=PENDING_WAIT)
+            responsehash = save_signed(req, filehash, dest)
+            if not responsehash:
                 errors += 1
                 continue
-            if os.path.exists(dest):
-                os.unlink(dest)
-            os.rename(tmpfile, dest)
-            log.info("%s: OK", filehash)
-            # See if we should re-sign NSS
-            if options.nsscmd and filehash != responsehash and os.path.exists(os.path.splitext(filename)[0] + ".chk"):
-                cmd = '%s "%s"' % (options.nsscmd, dest)
-                log.info("Regenerating .chk file")
-                log.debug("Running %s", cmd)
-                check_call(cmd, shell=True)
-
-            # Possibly write to our cache
-            if cached_fn:
-                cached_dir = os.path.dirname(cached_fn)
-                if not os.path.exists(cached_dir):
-                    log.debug("Creating %s", cached_dir)
-                    os.makedirs(cached_dir)
-                log.info("Copying %s to cache %s", dest, cached_fn)
-                copyfile(dest, cached_fn)
             break
         except urllib2.HTTPError, e:
             try:
                 if 'X-Pending' in e.headers:
-                    log.debug("%s: pending; try again in a bit", filehash)
-                    time.sleep(1)
+                    # The server has already waited on the signing job for
+                    # us, so we can ask again right away. Older servers may
+                    # answer straight away, so don't hammer them.
+                    log.debug("%s: pending; trying again", filehash)
+                    if time.time() - start < 1:
+                        time.sleep(1)
                     pendings += 1
                     continue
             except:
@@ -152,24 +217,34 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
             log.info("%s: uploading for signing", filehash)
             req = None
             try:
-                try:
-                    nonce = open(options.noncefile, 'rb').read()
-                except IOError:
-                    nonce = ""
-                req = uploadfile(url, filename, fmt, token, nonce=nonce)
+                nonce = read_nonce(options.noncefile)
+                req = uploadfile(url, filename, fmt, token, nonce=nonce,
+                                 wait=PENDING_WAIT,
+                                 priority=getattr(options, 'priority', None))
                 nonce = req.info()['X-Nonce']
-                open(options.noncefile, 'wb').write(nonce)
+                write_nonce(options.noncefile, nonce)
+                if req.code == 200 and 'X-SHA1-Digest' in req.info():
+                    # The server signed the file while we waited, and sent
+                    # the results back
+                    log.debug("%s: signed file returned with upload", filehash)
+                    responsehash = save_signed(req, filehash, dest)
+                    if responsehash:
+                        break
+                # Otherwise we'll pick up the signed file with our next GET
+                continue
             except urllib2.HTTPError, e:
                 # python2.5 doesn't think 202 is ok...but really it is!
                 if 'X-Nonce' in e.headers:
                     log.debug("updating nonce")
                     nonce = e.headers['X-Nonce']
-                    open(options.noncefile, 'wb').write(nonce)
+                    write_nonce(options.noncefile, nonce)
                 if e.code != 202:
                     log.info("%s: error uploading file for signing: %s %s",
                              filehash, e.code, e.msg)
                     urls.pop(0)
                     urls.append(url)
+                elif 'X-Pending' in e.headers:
+                    continue
             except (urllib2.URLError, socket.error, httplib.BadStatusLine):
                 # Try again in a little while
                 log.info("%s: connection error; trying again soon", filehash)
@@ -187,9 +262,186 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
             time.sleep(1)
             errors += 1
             continue
+
+    finish_signfile(options, filename, filehash, responsehash, fmt, dest)
     return True
 
 
+def remote_signfiles(options, urls, jobs, fmt, token, concurrency=1):
+    """Sign many files, using up to `concurrency` threads.
+
+    `jobs` is a list of (filename, dest) tuples which are passed on to
+    remote_signfile. Each worker starts on a different entry of `urls` so that
+    the load is spread over all the hosts capable of signing `fmt`.
+
+    Once a file fails to sign no new files are started. Returns a list of the
+    filenames that failed to sign.
+    """
+    concurrency = max(1, min(concurrency, len(jobs)))
+    work = Queue.Queue()
+    for job in jobs:
+        work.put(job)
+    failed = []
+
+    def worker(n):
+        # Each worker keeps its own list of urls, since remote_signfile
+        # re-orders it when a host misbehaves
+        my_urls = urls[n % len(urls):] + urls[:n % len(urls)]
+        while not failed:
+            try:
+                filename, dest = work.get(block=False)
+            except Queue.Empty:
+                break
+            try:
+                ok = remote_signfile(options, my_urls, filename, fmt, token,
+                                     dest)
+            except:
+                log.exception("%s: error signing", filename)
+                ok = False
+            if not ok:
+                failed.append(filename)
+
+    if concurrency == 1:
+        worker(0)
+        return failed
+
+    log.debug("signing %i files with %i workers", len(jobs), concurrency)
+    threads = []
+    for n in range(concurrency):
+        t = threading.Thread(target=worker, args=(n,))
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return failed
+
+
+def batch_request(baseurl, action, params):
+    """POST `params` to the `action` endpoint of the batch signing API on
+    the server at `baseurl`"""
+    datagen, headers = multipart_encode(params)
+    url = "%s/batch/%s" % (baseurl, action)
+    log.debug("POST %s", url)
+    r = urllib2.Request(url, datagen, headers)
+    return urllib2.urlopen(r)
+
+
+def batch_signfiles(options, baseurl, todo, fmt, token, max_fetches=5):
+    """Sign the files in `todo` with the batch API of the server at
+    `baseurl`.
+
+    `todo` is a dict of filehash -> list of (filename, dest, real_dest)
+    tuples. Entries are removed from `todo` once they've been signed."""
+    def make_manifest():
+        return json.dumps([
+            {'sha1': h, 'filename': os.path.basename(files[0][0]),
+             'format': fmt}
+            for h, files in todo.items()])
+
+    # Files we have to (re-)sign are queued with this priority
+    extra = []
+    priority = getattr(options, 'priority', None)
+    if priority is not None:
+        extra.append(('priority', str(priority)))
+
+    nonce = read_nonce(options.noncefile)
+    log.info("checking %i files on %s", len(todo), baseurl)
+    req = batch_request(baseurl, 'check', [
+        ('token', token), ('nonce', nonce), ('manifest', make_manifest())] +
+        extra)
+    nonce = req.info().get('X-Nonce', nonce)
+    missing = [h for h, f in json.load(req)['missing']]
+
+    if missing:
+        log.info("uploading %i files for signing", len(missing))
+        params = [('token', token), ('nonce', nonce),
+                  ('manifest', make_manifest())] + extra
+        fps = []
+        try:
+            for h in missing:
+                fp = open(todo[h][0][0], 'rb')
+                fps.append(fp)
+                params.append((h, fp))
+            req = batch_request(baseurl, 'upload', params)
+        finally:
+            for fp in fps:
+                fp.close()
+        nonce = req.info().get('X-Nonce', nonce)
+        for h, error in json.load(req)['errors'].items():
+            log.info("%s: error uploading file for signing: %s", h, error)
+
+    fetches = 0
+    while todo and fetches < max_fetches:
+        fetches += 1
+        req = batch_request(baseurl, 'fetch', [
+            ('token', token), ('nonce', nonce), ('manifest', make_manifest()),
+            ('wait', str(PENDING_WAIT))] + extra)
+        nonce = req.info().get('X-Nonce', nonce)
+        results = tarfile.open(fileobj=req, mode='r|')
+        status = None
+        for member in results:
+            if member.name == 'manifest.json':
+                status = json.load(results.extractfile(member))
+                continue
+            filehash = os.path.basename(member.name)
+            if status is None or filehash not in todo:
+                log.debug("ignoring unexpected file %s", member.name)
+                continue
+            files = todo[filehash]
+            filename, dest, real_dest = files[0]
+            responsehash = save_signed(results.extractfile(member), filehash,
+                                       real_dest, status['signed'][member.name])
+            if not responsehash:
+                continue
+            finish_signfile(options, filename, filehash, responsehash, fmt,
+                            real_dest)
+            # Other files with the same contents get copies of the results
+            for filename, dest, other_dest in files[1:]:
+                copyfile(real_dest, other_dest)
+                finish_signfile(options, filename, filehash, responsehash,
+                                fmt, other_dest)
+            del todo[filehash]
+        if not status or not status['pending']:
+            break
+    write_nonce(options.noncefile, nonce)
+
+
+def remote_signfiles_batch(options, urls, jobs, fmt, token, concurrency=1):
+    """Sign many files using the batch API of the signing server.
+
+    The server is asked which files it already has signed, the rest are
+    uploaded together in a single request, and the signed files are fetched
+    as one tar archive. Files that can't be signed this way (e.g. because the
+    server doesn't support batches) are passed on to remote_signfiles.
+
+    Returns a list of the filenames that failed to sign.
+    """
+    todo = {}
+    for filename, dest in jobs:
+        filehash = sha1sum(filename)
+        real_dest = get_dest(filename, fmt, dest)
+        if check_cache(options, filename, filehash, fmt, real_dest):
+            continue
+        todo.setdefault(filehash, []).append((filename, dest, real_dest))
+
+    if todo:
+        url = urls[0]
+        try:
+            batch_signfiles(options, url, todo, fmt, token)
+        except (urllib2.URLError, socket.error, httplib.BadStatusLine,
+                tarfile.TarError, ValueError, KeyError):
+            log.info("batch signing on %s failed; signing files one at a time",
+                     url, exc_info=True)
+
+    leftovers = []
+    for files in todo.values():
+        leftovers.extend((filename, dest) for filename, dest, _ in files)
+    if leftovers:
+        log.info("%i files left to sign", len(leftovers))
+    return remote_signfiles(options, urls, leftovers, fmt, token, concurrency)
+
+
 def buildValidatingOpener(ca_certs):
     """Build and register an HTTPS connection handler that validates that we're
     talking to a host matching ca_certs (a file containing a list of
@@ -244,11 +496,18 @@ def buildValidatingOpener(ca_certs):
     urllib2.install_opener(opener)
 
 
-def uploadfile(baseurl, filename, format_, token, nonce):
+def uploadfile(baseurl, filename, format_, token, nonce, wait=None,
+               priority=None):
     """Uploads file (given by `filename`) to server at `baseurl`.
 
     `sesson_key` and `nonce` are string values that get passed as POST
     parameters.
+
+    If `wait` is set, the server waits up to `wait` seconds for the file to be
+    signed, and returns the signed file in the response if it's ready.
+
+    `priority` is where the file goes in the server's signing queue; lower
+    numbers are signed first.
     """
     from poster.encode import multipart_encode
     filehash = sha1sum(filename)
@@ -263,6 +522,10 @@ def uploadfile(baseurl, filename, format_, token, nonce):
             'token': token,
             'nonce': nonce,
         }
+        if wait:
+            params['wait'] = str(wait)
+        if priority is not None:
+            params['priority'] = str(priority)
 
         datagen, headers = multipart_encode(params)
         r = urllib2.Request(
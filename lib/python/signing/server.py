@@ -6,8 +6,16 @@ import time
 import signal
 import re
 import tempfile
+import tarfile
+import heapq
+import urlparse
+try:
+    import simplejson as json
+except ImportError:
+    import json
 # TODO: use util.command
 from subprocess import Popen, PIPE, STDOUT
+from collections import defaultdict
 
 import gevent
 from gevent import queue
@@ -138,6 +146,202 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
         gevent.sleep(5)
 
 
+SHA1_RE = re.compile("^[0-9a-f]{40}$")
+
+
+def get_priority(value):
+    """Parse the priority a client asked for its signing jobs. Returns None
+    if no (valid) priority was requested."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def tar_header(name, size):
+    """Returns the tar header block for a regular file called `name` that's
+    `size` bytes long"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = time.time()
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.GNU_FORMAT)
+
+
+def tar_padding(size):
+    """Returns the padding that goes after `size` bytes of file data in a
+    tar file"""
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+        return '\0' * (tarfile.BLOCKSIZE - remainder)
+    return ''
+
+
+def tar_size(size):
+    """Returns how many bytes a file of `size` bytes takes up in a tar file,
+    including its header"""
+    return tarfile.BLOCKSIZE + size + len(tar_padding(size))
+
+
+def get_wait(value):
+    """Parse how long a client wants us to wait for a pending signing job.
+
+    `value` is either a query string such as "wait=60", or the value of a
+    "wait" POST parameter. Returns None if no (valid) wait was requested."""
+    if not value:
+        return None
+    if "=" in value:
+        value = urlparse.parse_qs(value).get('wait', [None])[0]
+    try:
+        wait = int(value)
+    except (TypeError, ValueError):
+        return None
+    if wait <= 0:
+        return None
+    return wait
+
+
+def iter_file(fp, blocksize=1024 ** 2):
+    """Generator that yields the contents of fp, and closes it when done"""
+    try:
+        while True:
+            data = fp.read(blocksize)
+            if not data:
+                break
+            yield data
+    finally:
+        fp.close()
+
+
+class DigestIndex(object):
+    """Remembers the sha1 digests of files, so we don't have to re-read
+    large files to find out their hash.
+
+    Digests are kept in memory, and in a sidecar file next to each file so
+    that they survive restarts. A digest is only trusted while the file's
+    size and mtime are unchanged."""
+    suffix = ".sha1"
+
+    def __init__(self):
+        self.digests = {}
+
+    def _load(self, fn):
+        try:
+            digest, size, mtime = open(fn + self.suffix, 'rb').read().split()
+            return int(size), float(mtime), digest
+        except (IOError, ValueError):
+            return None
+
+    def get(self, fn):
+        """Returns the sha1 digest of `fn`. Raises OSError if `fn` doesn't
+        exist."""
+        st = os.stat(fn)
+        entry = self.digests.get(fn) or self._load(fn)
+        if entry and entry[:2] == (st.st_size, st.st_mtime):
+            self.digests[fn] = entry
+            return entry[2]
+        log.debug("Calculating digest of %s", fn)
+        digest = sha1sum(fn)
+        self.set(fn, digest)
+        return digest
+
+    def set(self, fn, digest):
+        """Record that the current contents of `fn` have hash `digest`"""
+        st = os.stat(fn)
+        entry = (st.st_size, st.st_mtime, digest)
+        self.digests[fn] = entry
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fn))
+        fp = os.fdopen(fd, 'wb')
+        fp.write("%s %i %r\n" % (digest, entry[0], entry[1]))
+        fp.close()
+        os.rename(tmpname, fn + self.suffix)
+
+    def touch(self, fn):
+        """Update the mtime of `fn`, and return its digest"""
+        digest = self.get(fn)
+        os.utime(fn, None)
+        self.set(fn, digest)
+        return digest
+
+    def forget(self, fn):
+        """Delete our record of `fn`"""
+        self.digests.pop(fn, None)
+        safe_unlink(fn + self.suffix)
+
+
+class FileIndex(object):
+    """Index of the files in the signing server's store, ordered by when they
+    were last used, so that cleanup can find old files without scanning the
+    store.
+
+    Entries are keyed by the hash of the unsigned file, and track the total
+    size of all the files we keep for that hash."""
+
+    def __init__(self):
+        # Mapping of filehash -> (last used, size)
+        self.entries = {}
+        # Heap of (last used, filehash). Entries that have been used since
+        # are left in place, and skipped when they come up.
+        self.heap = []
+        self.total_size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, filehash):
+        return filehash in self.entries
+
+    def update(self, filehash, size=None, last_used=None):
+        """Record that filehash was used at `last_used` (defaulting to now),
+        and that its files take up `size` bytes. If `size` is None, the
+        previous size is kept."""
+        if last_used is None:
+            last_used = time.time()
+        old = self.entries.get(filehash)
+        if old:
+            last_used = max(last_used, old[0])
+            if size is None:
+                size = old[1]
+            self.total_size -= old[1]
+        size = size or 0
+        self.entries[filehash] = (last_used, size)
+        self.total_size += size
+        if not old or old[0] != last_used:
+            heapq.heappush(self.heap, (last_used, filehash))
+            if len(self.heap) > 2 * len(self.entries) + 1000:
+                self._compact()
+
+    def remove(self, filehash):
+        old = self.entries.pop(filehash, None)
+        if old:
+            self.total_size -= old[1]
+
+    def expired(self, cutoff, max_size=None, limit=None):
+        """Remove and return up to `limit` of the least recently used hashes
+        that were last used before `cutoff`, or that have to go to bring our
+        total size down to `max_size`."""
+        retval = []
+        while self.heap and (limit is None or len(retval) < limit):
+            last_used, filehash = self.heap[0]
+            entry = self.entries.get(filehash)
+            if not entry or entry[0] != last_used:
+                # Stale heap entry
+                heapq.heappop(self.heap)
+                continue
+            if last_used >= cutoff and not (max_size and
+                                            self.total_size > max_size):
+                break
+            heapq.heappop(self.heap)
+            self.remove(filehash)
+            retval.append(filehash)
+        return retval
+
+    def _compact(self):
+        self.heap = [(last_used, filehash) for filehash, (last_used, size)
+                     in self.entries.iteritems()]
+        heapq.heapify(self.heap)
+
+
 class Signer(object):
     """
     Main signing object
@@ -146,128 +350,191 @@ class Signer(object):
     `inputdir` and `outputdir` are where uploaded files and signed files will be stored
     `passphrases` is a dict of format => passphrase
     `concurrency` is how many workers to run
+    `format_concurrency` is a dict of format => how many files of that
+    format can be signed at once. Formats not listed are only limited by
+    `concurrency`.
+
+    Jobs are signed in order of priority (lower numbers first), and then in
+    the order they were submitted.
     """
     stopped = False
+    default_priority = 10
 
-    def __init__(self, app, signcmd, inputdir, outputdir, concurrency, passphrases):
+    def __init__(self, app, signcmd, inputdir, outputdir, concurrency, passphrases,
+                 format_concurrency=None):
         self.app = app
         self.signcmd = signcmd
         self.concurrency = concurrency
+        self.format_concurrency = format_concurrency or {}
         self.inputdir = inputdir
         self.outputdir = outputdir
 
         self.passphrases = passphrases
 
+        # Heap of (priority, sequence, submit time, item)
+        self.jobs = []
+        self._seq = 0
+        # How many jobs of each format are being signed right now
+        self.active = defaultdict(int)
+        # Set whenever there may be work for an idle worker
+        self.wakeup = Event()
+
+        # Per format stats since the last call to get_stats
+        self.stats = {}
+
         self.workers = []
-        self.queue = queue.Queue()
+        for i in range(self.concurrency):
+            self.workers.append(gevent.spawn(self._worker))
 
-    def signfile(self, filehash, filename, format_):
+    def signfile(self, filehash, filename, format_, priority=None):
         assert not self.stopped
+        if priority is None:
+            priority = self.default_priority
         e = Event()
         item = (filehash, filename, format_, e)
-        log.debug("Putting %s on the queue", item)
-        self.queue.put(item)
-        self._start_worker()
-        log.debug("%i workers active", len(self.workers))
+        log.debug("Putting %s on the queue with priority %i", item, priority)
+        self._seq += 1
+        heapq.heappush(self.jobs, (priority, self._seq, time.time(), item))
+        self.wakeup.set()
         return e
 
-    def _start_worker(self):
-        if len(self.workers) < self.concurrency:
-            t = gevent.spawn(self._worker)
-            t.link(self._worker_done)
-            self.workers.append(t)
-
-    def _worker_done(self, t):
-        log.debug("Done worker")
-        self.workers.remove(t)
-        # If there's still work to do, start another worker
-        if self.queue.qsize() and not self.stopped:
-            self._start_worker()
-        log.debug("%i workers left", len(self.workers))
+    def stop(self):
+        """Stop accepting new jobs. Workers exit once the queue is empty."""
+        self.stopped = True
+        self.wakeup.set()
+
+    def kill(self):
+        """Stop all workers right away"""
+        self.stop()
+        gevent.killall(self.workers)
+
+    def queue_depth(self):
+        return len(self.jobs)
+
+    def get_stats(self):
+        """Returns a dict of format => (jobs, average wait time, average
+        signing time, maximum signing time) for the jobs finished since the
+        last call, and resets the counters."""
+        stats = {}
+        for format_, (count, wait, signing, max_signing) in self.stats.items():
+            stats[format_] = (count, wait / count, signing / count, max_signing)
+        self.stats = {}
+        return stats
+
+    def _record(self, format_, wait, signing):
+        count, total_wait, total_signing, max_signing = self.stats.get(
+            format_, (0, 0.0, 0.0, 0.0))
+        self.stats[format_] = (count + 1, total_wait + wait,
+                               total_signing + signing,
+                               max(max_signing, signing))
+
+    def _next_job(self):
+        """Pop the highest priority job whose format isn't at its concurrency
+        limit. Returns None if there's nothing we can do right now."""
+        skipped = []
+        job = None
+        while self.jobs:
+            entry = heapq.heappop(self.jobs)
+            format_ = entry[3][2]
+            limit = self.format_concurrency.get(format_)
+            if limit and self.active[format_] >= limit:
+                skipped.append(entry)
+                continue
+            job = entry
+            break
+        for entry in skipped:
+            heapq.heappush(self.jobs, entry)
+        return job
 
     def _worker(self):
         # Main worker process
         # We pop items off the queue and process them
-
-        # How many jobs to process before exiting
-        max_jobs = 10
-        jobs = 0
         while True:
-            # Event to signal when we're done
-            e = None
-            try:
-                jobs += 1
-                # Fall on our sword if we're too old
-                if jobs >= max_jobs:
-                    break
-
-                try:
-                    item = self.queue.get(block=False)
-                    if not item:
-                        break
-                except queue.Empty:
-                    log.debug("no items, exiting")
+            job = self._next_job()
+            if job is None:
+                if self.stopped and not self.jobs:
                     break
+                self.wakeup.clear()
+                self.wakeup.wait()
+                continue
 
-                filehash, filename, format_, e = item
-                log.info("Signing %s (%s - %s)", filename, format_, filehash)
+            priority, seq, submitted, item = job
+            format_ = item[2]
+            self.active[format_] += 1
+            start = time.time()
+            try:
+                self._sign(item)
+            finally:
+                self.active[format_] -= 1
+                self._record(format_, start - submitted, time.time() - start)
+                # A slot for this format is free again
+                self.wakeup.set()
+        log.debug("Worker exiting")
 
-                inputfile = os.path.join(self.inputdir, filehash)
-                outputfile = os.path.join(self.outputdir, format_, filehash)
-                logfile = outputfile + ".out"
+    def _sign(self, item):
+        # Event to signal when we're done
+        filehash, filename, format_, e = item
+        inputfile = os.path.join(self.inputdir, filehash)
+        outputfile = os.path.join(self.outputdir, format_, filehash)
+        logfile = outputfile + ".out"
+        try:
+            log.info("Signing %s (%s - %s)", filename, format_, filehash)
 
-                if not os.path.exists(os.path.join(self.outputdir, format_)):
-                    os.makedirs(os.path.join(self.outputdir, format_))
+            if not os.path.exists(os.path.join(self.outputdir, format_)):
+                os.makedirs(os.path.join(self.outputdir, format_))
 
-                retval = run_signscript(self.signcmd, inputfile, outputfile,
-                                        filename, format_, self.passphrases.get(format_))
+            retval = run_signscript(self.signcmd, inputfile, outputfile,
+                                    filename, format_, self.passphrases.get(format_))
 
-                if retval != 0:
-                    if os.path.exists(logfile):
-                        logoutput = open(logfile).read()
-                    else:
-                        logoutput = None
-                    log.warning("Signing failed %s (%s - %s)",
-                                filename, format_, filehash)
-                    log.warning("Signing log: %s", logoutput)
-                    safe_unlink(outputfile)
-                    self.app.messages.put(
-                        ('errors', item, 'signing script returned non-zero'))
-                    continue
-
-                # Copy our signed result into unsigned and signed so if
-                # somebody wants to get this file signed again, they get the
-                # same results.
-                outputhash = sha1sum(outputfile)
-                log.debug("Copying result to %s", outputhash)
-                copied_input = os.path.join(self.inputdir, outputhash)
-                if not os.path.exists(copied_input):
-                    safe_copyfile(outputfile, copied_input)
-                copied_output = os.path.join(
-                    self.outputdir, format_, outputhash)
-                if not os.path.exists(copied_output):
-                    safe_copyfile(outputfile, copied_output)
-                self.app.messages.put(('done', item, outputhash))
-            except:
-                # Inconceivable! Something went wrong!
-                # Remove our output, it might be corrupted
-                safe_unlink(outputfile)
+            if retval != 0:
                 if os.path.exists(logfile):
                     logoutput = open(logfile).read()
                 else:
                     logoutput = None
-                log.exception(
-                    "Exception signing file %s; output: %s ", item, logoutput)
-                self.app.messages.put((
-                    'errors', item, 'worker hit an exception while signing'))
-            finally:
-                if e:
-                    e.set()
-        log.debug("Worker exiting")
+                log.warning("Signing failed %s (%s - %s)",
+                            filename, format_, filehash)
+                log.warning("Signing log: %s", logoutput)
+                safe_unlink(outputfile)
+                self.app.messages.put(
+                    ('errors', item, 'signing script returned non-zero'))
+                return
+
+            # Copy our signed result into unsigned and signed so if
+            # somebody wants to get this file signed again, they get the
+            # same results.
+            outputhash = sha1sum(outputfile)
+            self.app.digests.set(outputfile, outputhash)
+            log.debug("Copying result to %s", outputhash)
+            copied_input = os.path.join(self.inputdir, outputhash)
+            if not os.path.exists(copied_input):
+                safe_copyfile(outputfile, copied_input)
+                self.app.digests.set(copied_input, outputhash)
+            copied_output = os.path.join(
+                self.outputdir, format_, outputhash)
+            if not os.path.exists(copied_output):
+                safe_copyfile(outputfile, copied_output)
+                self.app.digests.set(copied_output, outputhash)
+            self.app.messages.put(('done', item, outputhash))
+        except:
+            # Inconceivable! Something went wrong!
+            # Remove our output, it might be corrupted
+            safe_unlink(outputfile)
+            if os.path.exists(logfile):
+                logoutput = open(logfile).read()
+            else:
+                logoutput = None
+            log.exception(
+                "Exception signing file %s; output: %s ", item, logoutput)
+            self.app.messages.put((
+                'errors', item, 'worker hit an exception while signing'))
+        finally:
+            e.set()
 
 
 class SigningServer:
     signer = None
+    # How many files to look at in cleanup before letting other greenlets run
+    cleanup_batch_size = 1000
 
     def __init__(self, config, passphrases):
         self.passphrases = passphrases
@@ -284,6 +551,12 @@ class SigningServer:
         # Mapping of file hashes to gevent Events
         self.pending = {}
 
+        # Digests of the files in unsigned_dir and signed_dir
+        self.digests = DigestIndex()
+
+        # When the files in unsigned_dir and signed_dir were last used
+        self.store = FileIndex()
+
         self.load_config(config)
 
         self.messages = queue.Queue()
@@ -291,12 +564,15 @@ class SigningServer:
         # Start our message handling loop
         self._message_loop_thread = gevent.spawn(self.process_messages)
 
-        # Start our cleanup loop
+        # Index the files we already have, then start our cleanup loop
+        self._scan_thread = gevent.spawn(self.scan_store)
         self._cleanup_loop_thead = gevent.spawn(self.cleanup_loop)
 
     def stop(self):
         self._message_loop_thread.kill()
+        self._scan_thread.kill()
         self._cleanup_loop_thead.kill()
+        self.signer.kill()
 
     def load_config(self, config):
         from ConfigParser import NoOptionError
@@ -329,23 +605,43 @@ class SigningServer:
                 self.max_filesize[f] = None
         self.max_token_age = config.getint('security', 'max_token_age')
         self.max_file_age = config.getint('server', 'max_file_age')
+        try:
+            self.max_store_size = config.getint('server', 'max_store_size')
+        except NoOptionError:
+            self.max_store_size = None
         self.token_auths = []
         for option, value in config.items('security'):
             if option.startswith('new_token_auth'):
                 self.token_auths.append(value)
         self.cleanup_interval = config.getint('server', 'cleanup_interval')
+        try:
+            self.max_pending_wait = config.getint('server', 'max_pending_wait')
+        except NoOptionError:
+            self.max_pending_wait = 60
 
         for d in self.signed_dir, self.unsigned_dir:
             if not os.path.exists(d):
                 log.info("Creating %s directory", d)
                 os.makedirs(d)
 
+        format_concurrency = {}
+        for f in self.formats:
+            try:
+                format_concurrency[f] = config.getint(
+                    'signing', 'concurrency_%s' % f)
+            except NoOptionError:
+                pass
+
+        if self.signer:
+            # Let the old workers finish off what's already queued
+            self.signer.stop()
         self.signer = Signer(self,
                              config.get('signing', 'signscript'),
                              config.get('paths', 'unsigned_dir'),
                              config.get('paths', 'signed_dir'),
                              config.getint('signing', 'concurrency'),
-                             self.passphrases)
+                             self.passphrases,
+                             format_concurrency)
 
     def verify_token(self, token, slave_ip):
         token_data, token_sig = token.split('!', 1)
@@ -396,33 +692,121 @@ class SigningServer:
             )
 
     def cleanup(self):
-        log.info("Stats: %i hits; %i misses; %i uploads",
-                 self.hits, self.misses, self.uploads)
+        log.info("Stats: %i hits; %i misses; %i uploads; %i queued",
+                 self.hits, self.misses, self.uploads,
+                 self.signer.queue_depth())
+        for format_, (count, wait, signing, max_signing) in \
+                sorted(self.signer.get_stats().items()):
+            log.info("Stats for %s: %i signed; %.1fs average wait; "
+                     "%.1fs average signing time; %.1fs max signing time",
+                     format_, count, wait, signing, max_signing)
         log.debug("Pending: %s", self.pending)
-        # Find files in unsigned that have bad hashes and delete them
+        log.info("Store: %i files; %i bytes", len(self.store),
+                 self.store.total_size)
+        # Delete files that haven't been used in a while, oldest first, and
+        # then as many more as we need to get under max_store_size
         log.debug("Cleaning up...")
-        now = time.time()
-        for f in os.listdir(self.unsigned_dir):
-            unsigned = os.path.join(self.unsigned_dir, f)
-            # Clean up old files
-            if os.path.getmtime(unsigned) < now - self.max_file_age:
-                log.info("Deleting %s (too old)", unsigned)
-                safe_unlink(unsigned)
+        cutoff = time.time() - self.max_file_age
+        busy = []
+        while True:
+            expired = self.store.expired(cutoff, self.max_store_size,
+                                         self.cleanup_batch_size)
+            if not expired:
+                break
+            for filehash in expired:
+                if any((filehash, f) in self.pending for f in self.formats):
+                    # Still being signed; look at it again next time
+                    busy.append(filehash)
+                    continue
+                log.info("Deleting %s", filehash)
+                self.delete_files(filehash)
+            gevent.sleep(0)
+        for filehash in busy:
+            self.touch_files(filehash)
+
+    def store_files(self, filehash):
+        """Returns the paths of all the files we may keep for filehash"""
+        unsigned = os.path.join(self.unsigned_dir, filehash)
+        files = [unsigned, unsigned + ".fn", unsigned + DigestIndex.suffix]
+        for format_ in self.formats:
+            signed = os.path.join(self.signed_dir, format_, filehash)
+            files.extend([signed, signed + ".out",
+                          signed + DigestIndex.suffix])
+        return files
+
+    def touch_files(self, filehash, last_used=None):
+        """Record that the files for filehash were used at `last_used`
+        (defaulting to now), and how much space they use"""
+        size = 0
+        for fn in self.store_files(filehash):
+            try:
+                size += os.path.getsize(fn)
+            except OSError:
+                pass
+        self.store.update(filehash, size, last_used)
+
+    def delete_files(self, filehash):
+        """Delete all the files we have for filehash"""
+        self.store.remove(filehash)
+        for fn in self.store_files(filehash):
+            if not fn.endswith(DigestIndex.suffix):
+                self.digests.forget(fn)
+            safe_unlink(fn)
+
+    def scan_store(self):
+        """Add the files already in unsigned_dir and signed_dir to our index.
+
+        This runs once on startup. Signed files without an unsigned copy and
+        old temporary files are deleted along the way."""
+        log.info("Scanning files in %s and %s", self.unsigned_dir,
+                 self.signed_dir)
+        old = time.time() - self.max_file_age
+        hashes = set()
+        dirs = [self.unsigned_dir]
+        for format_ in os.listdir(self.signed_dir):
+            dirs.append(os.path.join(self.signed_dir, format_))
+        for d in dirs:
+            for i, f in enumerate(os.listdir(d)):
+                if i % self.cleanup_batch_size == 0:
+                    gevent.sleep(0)
+                fn = os.path.join(d, f)
+                filehash = f.split(".")[0]
+                if not SHA1_RE.match(filehash):
+                    try:
+                        if os.path.getmtime(fn) < old:
+                            log.info("Deleting %s", fn)
+                            safe_unlink(fn)
+                    except OSError:
+                        pass
+                elif d == self.unsigned_dir:
+                    hashes.add(filehash)
+                elif filehash not in hashes:
+                    unsigned = os.path.join(self.unsigned_dir, filehash)
+                    if not os.path.exists(unsigned):
+                        log.info("Deleting %s with no unsigned file", fn)
+                        self.digests.forget(fn)
+                        safe_unlink(fn)
+
+        for i, filehash in enumerate(hashes):
+            if i % self.cleanup_batch_size == 0:
+                gevent.sleep(0)
+            if filehash in self.store:
+                # Already seen since we started
                 continue
+            last_used = None
+            for fn in self.store_files(filehash):
+                try:
+                    last_used = max(last_used, os.path.getmtime(fn))
+                except OSError:
+                    pass
+            if last_used is not None:
+                self.touch_files(filehash, last_used)
+        log.info("Found %i files using %i bytes", len(self.store),
+                 self.store.total_size)
 
-        # Find files in signed that don't have corresponding files in unsigned
-        # and delete them
-        for format_ in os.listdir(self.signed_dir):
-            for f in os.listdir(os.path.join(self.signed_dir, format_)):
-                signed = os.path.join(self.signed_dir, format_, f)
-                unsigned = os.path.join(self.unsigned_dir, f)
-                if not os.path.exists(unsigned):
-                    log.info("Deleting %s with no unsigned file", signed)
-                    safe_unlink(signed)
-
-    def submit_file(self, filehash, filename, format_):
+    def submit_file(self, filehash, filename, format_, priority=None):
         assert (filehash, format_) not in self.pending
-        e = self.signer.signfile(filehash, filename, format_)
+        e = self.signer.signfile(filehash, filename, format_, priority)
         self.pending[(filehash, format_)] = e
 
     def process_messages(self):
@@ -440,11 +824,48 @@ class SigningServer:
                     del self.pending[filehash, format_]
                     # Remember the filename for the output file too
                     self.save_filename(outputhash, filename)
+                    self.touch_files(filehash)
+                    self.touch_files(outputhash)
                 else:
                     log.error("Unknown message type: %s", msg)
             except:
                 log.exception("Error handling message: %s", msg)
 
+    def wait_for_pending(self, filehash, format_, wait=None):
+        """Wait for a pending signing job for filehash to finish.
+
+        We wait up to `wait` seconds, capped by max_pending_wait. Returns True
+        if there's no longer a pending job."""
+        pending = self.pending.get((filehash, format_))
+        if not pending:
+            return True
+        if wait is None:
+            wait = self.max_pending_wait
+        wait = min(wait, self.max_pending_wait)
+        log.debug("Waiting up to %is for pending job", wait)
+        pending.wait(timeout=wait)
+        return pending.is_set()
+
+    def send_signed(self, environ, fn, start_response, headers=None):
+        """Send the signed file `fn` back to the client.
+
+        Returns the response body; if the WSGI server provides
+        wsgi.file_wrapper we let it send the file for us. Raises IOError or
+        OSError if the file doesn't exist."""
+        checksum = self.digests.touch(fn)
+        self.store.update(os.path.basename(fn))
+        fp = open(fn, 'rb')
+        headers = (headers or []) + [
+            ('X-SHA1-Digest', checksum),
+            ('Content-Length', str(os.fstat(fp.fileno()).st_size)),
+        ]
+        log.debug("%s is OK", fn)
+        start_response("200 OK", headers)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(fp, 1024 ** 2)
+        return iter_file(fp)
+
     def get_path(self, filename, format_):
         # Return path of filename under signed-files
         return os.path.join(self.signed_dir, format_, os.path.basename(filename))
@@ -464,6 +885,7 @@ class SigningServer:
         fp.write(filename)
         fp.close()
         os.rename(tmpname, filename_fn)
+        self.store.update(filehash)
 
     def __call__(self, environ, start_response):
         """WSGI entry point."""
@@ -494,16 +916,13 @@ class SigningServer:
         except:
             log.debug("bad request: %s", environ['PATH_INFO'])
             start_response("400 Bad Request", [])
-            yield ""
-            return
+            return ""
 
         filehash = os.path.basename(environ['PATH_INFO'])
+        wait = get_wait(environ.get('QUERY_STRING'))
         try:
-            pending = self.pending.get((filehash, format_))
-            if pending:
-                log.debug("Waiting for pending job")
-                # Wait up to a minute for this to finish
-                pending.wait(timeout=60)
+            if (filehash, format_) in self.pending:
+                self.wait_for_pending(filehash, format_, wait)
                 log.debug("Pending job finished!")
             fn = self.get_path(filehash, format_)
             filename = self.get_filename(filehash)
@@ -511,22 +930,10 @@ class SigningServer:
                 log.debug("Looking for %s (%s)", fn, filename)
             else:
                 log.debug("Looking for %s", fn)
-            checksum = sha1sum(fn)
-            headers = [
-                ('X-SHA1-Digest', checksum),
-                ('Content-Length', os.path.getsize(fn)),
-            ]
-            fp = open(fn, 'rb')
-            os.utime(fn, None)
-            log.debug("%s is OK", fn)
-            start_response("200 OK", headers)
-            while True:
-                data = fp.read(1024 ** 2)
-                if not data:
-                    break
-                yield data
+            body = self.send_signed(environ, fn, start_response)
             self.hits += 1
-        except IOError:
+            return body
+        except (IOError, OSError):
             log.debug("%s is missing", fn)
             headers = []
             fn = os.path.join(self.unsigned_dir, filehash)
@@ -541,11 +948,12 @@ class SigningServer:
             elif os.path.exists(fn):
                 log.debug("GET for file we already have, but not for the right format")
                 # Validate the file
-                myhash = sha1sum(fn)
+                myhash = self.digests.get(fn)
                 if myhash != filehash:
                     log.warning("%s is corrupt; deleting (%s != %s)",
                                 fn, filehash, myhash)
                     safe_unlink(fn)
+                    self.digests.forget(fn)
                 else:
                     filename = self.get_filename(filehash)
                     if filename:
@@ -558,25 +966,28 @@ class SigningServer:
                 self.misses += 1
 
             start_response("404 Not Found", headers)
-            yield ""
+            return ""
 
     def handle_upload(self, environ, start_response, values, rest, next_nonce):
         format_ = rest[0]
         assert format_ in self.formats
         filehash = values['sha1']
         filename = values['filename']
+        wait = get_wait(values.get('wait'))
+        priority = get_priority(values.get('priority'))
         log.info("Request to %s sign %s (%s) from %s", format_,
                  filename, filehash, environ['REMOTE_ADDR'])
         fn = os.path.join(self.unsigned_dir, filehash)
         headers = [('X-Nonce', next_nonce)]
         if os.path.exists(fn):
             # Validate the file
-            mydigest = sha1sum(fn)
+            mydigest = self.digests.get(fn)
 
             if mydigest != filehash:
                 log.warning("%s is corrupt; deleting (%s != %s)",
                             fn, mydigest, filehash)
                 safe_unlink(fn)
+                self.digests.forget(fn)
 
             elif os.path.exists(os.path.join(self.signed_dir, filehash)):
                 # Everything looks ok
@@ -586,6 +997,9 @@ class SigningServer:
 
             elif (filehash, format_) in self.pending:
                 log.info("File is pending")
+                if wait:
+                    return self.send_when_signed(environ, filehash, format_,
+                                                 wait, start_response, headers)
                 start_response("202 File is pending", headers)
                 return ""
 
@@ -598,14 +1012,34 @@ class SigningServer:
             start_response("403 Unacceptable filename", headers)
             return ""
 
+        error = self.receive_file(values['filedata'].file, filehash,
+                                  filename, format_)
+        if error:
+            start_response(error, headers)
+            return ""
+
+        self.submit_file(filehash, filename, format_, priority)
+        self.uploads += 1
+        if wait:
+            return self.send_when_signed(environ, filehash, format_, wait,
+                                         start_response, headers)
+        start_response("202 Accepted", headers)
+        return ""
+
+    def receive_file(self, fileobj, filehash, filename, format_):
+        """Store the data read from `fileobj` as the unsigned copy of
+        filehash, after checking its size and hash.
+
+        Returns None on success, or an error status otherwise."""
+        fn = os.path.join(self.unsigned_dir, filehash)
+        fd, tmpname = tempfile.mkstemp(dir=self.unsigned_dir)
+        s = 0
         try:
-            fd, tmpname = tempfile.mkstemp(dir=self.unsigned_dir)
             fp = os.fdopen(fd, 'wb')
 
             h = hashlib.new('sha1')
-            s = 0
             while True:
-                data = values['filedata'].file.read(1024 ** 2)
+                data = fileobj.read(1024 ** 2)
                 if not data:
                     break
                 s += len(data)
@@ -614,34 +1048,196 @@ class SigningServer:
             fp.close()
         except:
             log.exception("Error downloading data")
-            if os.path.exists(tmpname):
-                os.unlink(tmpname)
+            safe_unlink(tmpname)
+            return "400 Error reading file"
 
         if s < self.min_filesize:
-            if os.path.exists(tmpname):
-                os.unlink(tmpname)
-            start_response("400 File too small", headers)
-            return ""
+            safe_unlink(tmpname)
+            return "400 File too small"
         if self.max_filesize[format_] and s > self.max_filesize[format_]:
-            if os.path.exists(tmpname):
-                os.unlink(tmpname)
-            start_response("400 File too large", headers)
-            return ""
+            safe_unlink(tmpname)
+            return "400 File too large"
 
         if h.hexdigest() != filehash:
-            if os.path.exists(tmpname):
-                os.unlink(tmpname)
+            safe_unlink(tmpname)
             log.warn("Hash mismatch. Bad upload?")
-            start_response("400 Hash mismatch", headers)
-            return ""
+            return "400 Hash mismatch"
 
         # Good to go!  Rename the temporary filename to the real filename
         self.save_filename(filehash, filename)
         os.rename(tmpname, fn)
-        self.submit_file(filehash, filename, format_)
-        start_response("202 Accepted", headers)
-        self.uploads += 1
-        return ""
+        self.digests.set(fn, filehash)
+        self.touch_files(filehash)
+        return None
+
+    def send_when_signed(self, environ, filehash, format_, wait,
+                         start_response, headers):
+        """Wait for filehash to be signed, and send the signed file back.
+
+        If signing takes longer than we're willing to wait, tell the client
+        it's still pending, so it can pick it up with a GET."""
+        if not self.wait_for_pending(filehash, format_, wait):
+            log.info("File is pending, come back soon!")
+            start_response("202 Accepted", headers + [('X-Pending', 'True')])
+            return ""
+        fn = self.get_path(filehash, format_)
+        if not os.path.exists(fn):
+            # Signing failed; the client will find out with its next GET
+            start_response("202 Accepted", headers)
+            return ""
+        return self.send_signed(environ, fn, start_response, headers)
+
+    def parse_manifest(self, data):
+        """Parse and validate a batch manifest.
+
+        Returns a list of (filehash, filename, format_) tuples, or raises
+        ValueError if the manifest is invalid."""
+        manifest = []
+        for entry in json.loads(data):
+            filehash = str(entry['sha1'])
+            filename = entry['filename']
+            format_ = str(entry['format'])
+            if not SHA1_RE.match(filehash):
+                raise ValueError("Invalid hash: %s" % filehash)
+            if format_ not in self.formats:
+                raise ValueError("Invalid format: %s" % format_)
+            if not any(exp.match(filename) for exp in self.allowed_filenames):
+                raise ValueError("Unacceptable filename: %s" % filename)
+            manifest.append((filehash, filename, format_))
+        return manifest
+
+    def batch_status(self, manifest, priority=None):
+        """Returns a dict of 'signed', 'pending' and 'missing' lists of
+        [filehash, format] for the files in `manifest`.
+
+        Files we have but that haven't been signed with the right format yet
+        are queued up for signing with `priority`."""
+        status = {'signed': [], 'pending': [], 'missing': []}
+        for filehash, filename, format_ in manifest:
+            if os.path.exists(self.get_path(filehash, format_)):
+                status['signed'].append([filehash, format_])
+            elif (filehash, format_) in self.pending:
+                status['pending'].append([filehash, format_])
+            else:
+                fn = os.path.join(self.unsigned_dir, filehash)
+                if os.path.exists(fn):
+                    myhash = self.digests.get(fn)
+                    if myhash == filehash:
+                        self.save_filename(filehash, filename)
+                        self.submit_file(filehash, filename, format_,
+                                         priority)
+                        status['pending'].append([filehash, format_])
+                        continue
+                    log.warning("%s is corrupt; deleting (%s != %s)",
+                                fn, filehash, myhash)
+                    safe_unlink(fn)
+                    self.digests.forget(fn)
+                status['missing'].append([filehash, format_])
+        return status
+
+    def handle_batch(self, environ, start_response, values, rest, headers):
+        """
+        POST /batch/check - report which files in the manifest are signed,
+                            pending or missing
+        POST /batch/upload - upload the missing files in the manifest
+        POST /batch/fetch - get the signed files in the manifest as a tar file
+        """
+        action = rest[0]
+        if action not in ('check', 'upload', 'fetch'):
+            start_response("400 Bad Request", headers)
+            return ""
+        try:
+            manifest = self.parse_manifest(values['manifest'])
+        except (KeyError, TypeError, ValueError):
+            log.info("%s sent an invalid manifest", environ['REMOTE_ADDR'],
+                     exc_info=True)
+            start_response("400 Invalid manifest", headers)
+            return ""
+        log.info("Batch %s of %i files from %s", action, len(manifest),
+                 environ['REMOTE_ADDR'])
+
+        if action == 'fetch':
+            return self.send_batch(manifest, get_wait(values.get('wait')),
+                                   start_response, headers)
+
+        priority = get_priority(values.get('priority'))
+        errors = {}
+        if action == 'upload':
+            for filehash, filename, format_ in manifest:
+                if filehash not in values or not hasattr(values[filehash], 'file'):
+                    continue
+                if os.path.exists(self.get_path(filehash, format_)) or \
+                        (filehash, format_) in self.pending:
+                    continue
+                if os.path.exists(os.path.join(self.unsigned_dir, filehash)):
+                    # batch_status validates and queues this one below
+                    continue
+                error = self.receive_file(values[filehash].file, filehash,
+                                          filename, format_)
+                if error:
+                    errors[filehash] = error
+                    continue
+                self.uploads += 1
+                self.submit_file(filehash, filename, format_, priority)
+
+        status = self.batch_status(manifest, priority)
+        status['errors'] = errors
+        start_response("200 OK", headers + [
+            ('Content-Type', 'application/json')])
+        return json.dumps(status)
+
+    def send_batch(self, manifest, wait, start_response, headers):
+        """Generator that waits up to `wait` seconds for the files in
+        `manifest` to be signed, and sends back a tar file of the signed
+        ones.
+
+        The first member of the tar file is manifest.json, which has the
+        hashes of the signed files, and lists the ones still pending."""
+        if wait is None:
+            wait = 0
+        deadline = time.time() + min(wait, self.max_pending_wait)
+        for filehash, filename, format_ in manifest:
+            self.wait_for_pending(filehash, format_,
+                                  max(0, deadline - time.time()))
+
+        status = {'signed': {}, 'pending': []}
+        members = []
+        for filehash, filename, format_ in manifest:
+            name = "%s/%s" % (format_, filehash)
+            fn = self.get_path(filehash, format_)
+            if os.path.exists(fn):
+                if name not in status['signed']:
+                    status['signed'][name] = self.digests.touch(fn)
+                    members.append((name, fn))
+            elif (filehash, format_) in self.pending:
+                status['pending'].append(name)
+        self.hits += len(members)
+
+        manifest_data = json.dumps(status)
+        # The archive ends with two empty blocks
+        size = tar_size(len(manifest_data)) + tarfile.BLOCKSIZE * 2
+        for name, fn in members:
+            size += tar_size(os.path.getsize(fn))
+        start_response("200 OK", headers + [
+            ('Content-Type', 'application/x-tar'),
+            ('Content-Length', str(size)),
+        ])
+
+        yield tar_header('manifest.json', len(manifest_data))
+        yield manifest_data
+        yield tar_padding(len(manifest_data))
+        for name, fn in members:
+            s = os.path.getsize(fn)
+            yield tar_header(name, s)
+            fp = open(fn, 'rb')
+            while True:
+                data = fp.read(1024 ** 2)
+                if not data:
+                    break
+                yield data
+            fp.close()
+            yield tar_padding(s)
+        yield '\0' * (tarfile.BLOCKSIZE * 2)
 
     def handle_token(self, environ, start_response, values):
         token = self.get_token(
@@ -660,7 +1256,7 @@ class SigningServer:
             path_bits = environ['PATH_INFO'].split('/')
             magic = path_bits[1]
             rest = path_bits[2:]
-            if not magic in ('sign', 'token'):
+            if not magic in ('sign', 'token', 'batch'):
                 log.exception("bad request: %s", environ['PATH_INFO'])
                 start_response("400 Bad Request", [])
                 return ""
@@ -682,7 +1278,7 @@ class SigningServer:
                     return ""
 
                 return self.handle_token(environ, start_response, values)
-            elif magic == 'sign':
+            elif magic in ('sign', 'batch'):
                 # Validate token
                 if 'token' not in values:
                     start_response("400 Missing token", [])
@@ -698,6 +1294,8 @@ class SigningServer:
                 next_nonce = 'UNUSED'
                 headers.append(('X-Nonce', 'UNUSED'))
 
+                if magic == 'batch':
+                    return self.handle_batch(environ, start_response, values, rest, headers)
                 return self.handle_upload(environ, start_response, values, rest, next_nonce)
         except:
             log.exception("ISE")
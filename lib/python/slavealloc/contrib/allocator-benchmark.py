@@ -0,0 +1,187 @@
+"""
+Load benchmark for the slave allocator.
+
+This fills a scratch sqlite database with slaves and masters, then has
+hundreds of slaves ask for their buildbot.tac at once, as happens when a
+whole pool reboots.  Each query can be slowed down with --latency to simulate
+a remote database.  The allocator is run once with a single thread (the old
+behavior of allocating in the main thread), and once with --threads threads.
+
+After each run, the slaves in each silo must be spread evenly over the
+silo's masters; anything else means two allocations saw stale counts.
+
+With --best-master, this instead compares how long it takes to pick a master
+with the queries.best_master self-join and with the in-memory MasterLoads
+table, e.g. with --slaves 5000.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import random
+import optparse
+import traceback
+from collections import defaultdict
+
+import sqlalchemy as sa
+from twisted.internet import defer, reactor
+
+from slavealloc.data import model, queries, setup
+from slavealloc.daemon import service
+from slavealloc.logic import allocate, loads
+
+
+def populate(slaves, masters, silos, pools=1):
+    "Fill the database with slaves spread over `silos` silos"
+    for tbl in (model.distros, model.bitlengths, model.speeds,
+                model.purposes, model.datacenters, model.trustlevels,
+                model.environments):
+        pk = list(tbl.primary_key.columns)[0].name
+        count = silos if tbl is model.distros else 1
+        tbl.insert().execute([{pk: i, 'name': '%s%d' % (tbl.name, i)}
+                              for i in range(count)])
+    model.pools.insert().execute([dict(poolid=i, name='pool%d' % i)
+                                  for i in range(pools)])
+    model.slave_passwords.insert().execute([dict(poolid=i, password='pw')
+                                            for i in range(pools)])
+    model.masters.insert().execute([
+        dict(masterid=i, nickname='bm%d' % i, fqdn='bm%d.example.com' % i,
+             http_port=8000 + i, pb_port=9000 + i, dcid=0,
+             poolid=i % pools, enabled=True)
+        for i in range(masters)])
+    model.slaves.insert().execute([
+        dict(slaveid=i, name='slave%d' % i, distroid=i % silos, bitsid=0,
+             speedid=0, purposeid=0, dcid=0, trustid=0, envid=0,
+             poolid=i % pools, basedir='/builds/slave', enabled=True)
+        for i in range(slaves)])
+
+
+def check_balance():
+    "Return the worst imbalance between two masters of a silo"
+    counts = defaultdict(lambda: defaultdict(int))
+    for row in sa.select([model.slaves.c.distroid, model.slaves.c.poolid,
+                          model.slaves.c.current_masterid]).execute():
+        counts[row.distroid, row.poolid][row.current_masterid] += 1
+    worst = 0
+    for (distroid, poolid), by_master in counts.items():
+        pool_masters = sa.select([model.masters.c.masterid],
+                                 model.masters.c.poolid == poolid).execute()
+        slavecounts = [by_master.get(m.masterid, 0) for m in pool_masters]
+        worst = max(worst, max(slavecounts) - min(slavecounts))
+    return worst
+
+
+@defer.inlineCallbacks
+def run(threads, slaves):
+    model.slaves.update(values=dict(current_masterid=None)).execute()
+    allocator = service.AllocatorService(max_threads=threads)
+    allocator.startService()
+
+    times = []
+
+    def gettac(name):
+        start = time.time()
+        d = allocator.getBuildbotTac(name)
+        d.addCallback(lambda _: times.append(time.time() - start))
+        return d
+
+    start = time.time()
+    yield defer.DeferredList([gettac('slave%d' % i) for i in range(slaves)],
+                             fireOnOneErrback=True)
+    elapsed = time.time() - start
+    allocator.stopService()
+
+    times.sort()
+    print "%2d threads: %6.2fs total; latency p50 %.3fs p95 %.3fs; " \
+          "worst imbalance %d" % (threads, elapsed,
+                                  times[len(times) / 2],
+                                  times[int(len(times) * 0.95)],
+                                  check_balance())
+
+
+def compare_best_master(masters, samples):
+    "Time picking a master for `samples` random slaves both ways"
+    # attach every slave to some master, so there's something to count
+    model.slaves.update(
+        values=dict(current_masterid=model.slaves.c.slaveid % masters)
+    ).execute()
+    slaveids = [r.slaveid for r in
+                sa.select([model.slaves.c.slaveid]).execute()]
+    slaveids = random.sample(slaveids, min(samples, len(slaveids)))
+    silos = dict((slaveid, allocate.get_silo('slave%d' % slaveid))
+                 for slaveid in slaveids)
+
+    start = time.time()
+    from_query = [queries.best_master.execute(slaveid=slaveid).fetchone()
+                  for slaveid in slaveids]
+    query_time = time.time() - start
+
+    master_loads = loads.MasterLoads()
+    start = time.time()
+    master_loads.best_master(slaveids[0], silos[slaveids[0]])
+    load_time = time.time() - start
+    start = time.time()
+    from_table = [master_loads.best_master(slaveid, silos[slaveid])
+                  for slaveid in slaveids]
+    table_time = time.time() - start
+
+    print "best_master query: %8.3fms per slave" % (
+        query_time * 1000 / len(slaveids))
+    print "MasterLoads:       %8.3fms per slave (plus %.3fs to load)" % (
+        table_time * 1000 / len(slaveids), load_time)
+    mismatches = [s for s, q, t in zip(slaveids, from_query, from_table)
+                  if q.masterid != t.masterid]
+    print "%d of %d picks differ" % (len(mismatches), len(slaveids))
+
+
+def main():
+    parser = optparse.OptionParser(__doc__.strip())
+    parser.add_option("--slaves", type="int", default=500)
+    parser.add_option("--masters", type="int", default=10)
+    parser.add_option("--silos", type="int", default=8,
+                      help="number of silos the slaves are spread over")
+    parser.add_option("--threads", type="int", default=10)
+    parser.add_option("--latency", type="float", default=0.005,
+                      help="seconds added to every database query")
+    parser.add_option("--best-master", dest="best_master",
+                      action="store_true",
+                      help="compare ways of picking the best master")
+    parser.add_option("--samples", type="int", default=200,
+                      help="number of slaves to pick masters for with "
+                      "--best-master")
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        setup.setup('sqlite:///%s' % os.path.join(tmpdir, 'slavealloc.db'),
+                    dict(connect_args=dict(timeout=60)))
+        model.metadata.create_all()
+        populate(options.slaves, options.masters, options.silos)
+
+        if options.best_master:
+            compare_best_master(options.masters, options.samples)
+            return
+
+        if options.latency:
+            def slow_query(*args):
+                time.sleep(options.latency)
+            sa.event.listen(model.metadata.bind, 'before_cursor_execute',
+                            slow_query)
+
+        @defer.inlineCallbacks
+        def runall():
+            try:
+                for threads in sorted(set([1, options.threads])):
+                    yield run(threads, options.slaves)
+            except:
+                traceback.print_exc()
+            finally:
+                reactor.stop()
+        reactor.callWhenRunning(runall)
+        reactor.run()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
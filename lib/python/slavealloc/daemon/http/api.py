@@ -1,10 +1,12 @@
+import zlib
 import sqlalchemy as sa
 import simplejson
 from twisted.python import log
-from twisted.web import resource
+from twisted.internet import defer
+from twisted.web import resource, http, server
 from slavealloc import exceptions
-from slavealloc.data import queries, model
-from slavealloc.logic import allocate, buildbottac
+from slavealloc.data import model
+from slavealloc.logic import allocate, buildbottac, snapshot, loads
 
 # point your browser to /api/ to see the full set of docs
 docs_tpl = """
@@ -18,6 +20,13 @@ of the table.  As a convenience, the slaves and masters tables have all of
 their normalized fields denormalized, so in addition to a <tt>poolid</tt> you
 will get a <tt>pool</tt> string.</p>
 
+<p>The slaves and masters collections are served from an in-memory snapshot,
+and carry an <tt>ETag</tt> with the snapshot's version, so polling clients can
+use <tt>If-None-Match</tt>.  Add <tt>?since=version</tt> to get only the
+changes since that version, as <tt>{version: .., full: false, rows: [..],
+deleted: [ids]}</tt>.  If the given version is too old, <tt>full</tt> is true
+and <tt>rows</tt> has every row.</p>
+
 <p>A particular row can be fetched by appending the primary key in the next URL
 component, e.g., <a href="/api/pools/3">/api/pools/3</a>.  To fetch the row by
 name instead, use the name in the URL and add <tt>?byname=1</tt>, e.g., <a
@@ -40,6 +49,13 @@ meaning that the selected master is not recorded in the
 <tt>current_masterid</tt> table for the requested slave.  The result is JSON --
 either {success=False} or {success=True, tac='content of buildbot.tac'}.</p>
 
+<p>A POST of <tt>{slaves: [names]}</tt> to <tt>/api/allocate</tt> allocates all
+of the named slaves at once, e.g., before reimaging a pool, and does commit the
+allocations.  When the allocator runs in the same process, the slaves' TACs
+are kept, so each slave's next request to <tt>/gettac</tt> is answered without
+allocating again.  The result is {success=True, allocated={name: {master,
+fqdn, pb_port}}, failed=[names]}.</p>
+
 """
 
 # base classes
@@ -105,9 +121,20 @@ class Instance(resource.Resource):
         wc, args = self.whereClause(require_id=True)
         args.update(sets)
         self.table.update(wc).execute(args)
+        self.invalidate(sets)
+        if request.site.allocator:
+            self.invalidateTacs(request.site.allocator, sets)
 
         return self.okResponse
 
+    def invalidate(self, sets):
+        "Invalidate any snapshots affected by updating this row with sets"
+        snapshot.invalidate_all()
+
+    def invalidateTacs(self, allocator, sets):
+        "Drop any pre-allocated TACs made stale by updating this row with sets"
+        allocator.forgetTacs()
+
 
 class Collection(resource.Resource):
     addSlash = True
@@ -138,6 +165,72 @@ class Collection(resource.Resource):
         return simplejson.dumps([dict(r.items()) for r in res.fetchall()])
 
 
+class SnapshotCollection(Collection):
+    "A collection served from a snapshot, with support for ETags and gzip"
+
+    # the slavealloc.logic.snapshot.Snapshot to serve
+    snapshot = None
+
+    def filterRow(self, request, row):
+        "Return true if row should be included in the response to request"
+        return True
+
+    def render_GET(self, request):
+        since = request.args.get('since', [None])[0]
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                request.setResponseCode(400)
+                return simplejson.dumps(dict(success=False))
+
+        version = self.snapshot.refresh()
+        use_gzip = 'gzip' in (request.getHeader('accept-encoding') or '')
+
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('Cache-control', 'no-cache')
+        request.setHeader('Vary', 'Accept-Encoding')
+        etag = '"%d%s"' % (version, use_gzip and '-gz' or '')
+        if request.setETag(etag) == http.CACHED:
+            return ''
+
+        key = (tuple(sorted((k, tuple(v)) for k, v in request.args.items())),
+               use_gzip)
+        body = self.snapshot.cache.get(key)
+        if body is None:
+            body = self.serialize(request, version, since)
+            if use_gzip:
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                body = compressor.compress(body) + compressor.flush()
+            self.snapshot.cache[key] = body
+        if use_gzip:
+            request.setHeader('content-encoding', 'gzip')
+        return body
+
+    def serialize(self, request, version, since):
+        if since is None:
+            rows, deleted = self.snapshot.get_rows()
+            return simplejson.dumps(
+                [r for r in rows if self.filterRow(request, r)])
+
+        full = not (self.snapshot.base_version <= since <= version)
+        if full:
+            rows, deleted = self.snapshot.get_rows()
+        else:
+            rows, deleted = self.snapshot.get_rows(since)
+        id_name = self.snapshot.id_column.name
+        matching = []
+        for r in rows:
+            if self.filterRow(request, r):
+                matching.append(r)
+            elif not full:
+                # the row may have matched before it changed
+                deleted.append(r[id_name])
+        return simplejson.dumps(dict(version=version, full=full,
+                                     rows=matching, deleted=deleted))
+
+
 # concrete classes
 
 # slaves
@@ -149,19 +242,33 @@ class SlaveResource(Instance):
                    'envid', 'poolid', 'basedir', 'locked_masterid', 'notes',
                    'enabled', 'custom_tplid')
 
+    def invalidate(self, sets):
+        snapshot.slaves.invalidate([int(self.id)])
+        # the slave may have moved to a different silo
+        loads.master_loads.invalidate()
 
-class SlavesResource(Collection):
-    instance_class = SlaveResource
-    # set in render_GET
-    query = None
+    def invalidateTacs(self, allocator, sets):
+        # the slave may have been disabled, locked, or moved to another pool
+        wc, args = self.whereClause(require_id=True)
+        name = sa.select([self.name_column], wc).execute(args).scalar()
+        allocator.forgetTac(name)
 
-    def render_GET(self, request):
-        environments = request.args.get('environment')
-        purposes = request.args.get('purpose')
-        pools = request.args.get('pool')
+
+class SlavesResource(SnapshotCollection):
+    instance_class = SlaveResource
+    snapshot = snapshot.slaves
+
+    def filterRow(self, request, row):
+        for arg, column in (('environment', 'environment'),
+                            ('purpose', 'purpose'), ('pool', 'pool')):
+            wanted = request.args.get(arg)
+            if wanted and row[column] not in wanted:
+                return False
         enabled = request.args.get('enabled', [None])[0]
-        self.query = queries.denormalized_slaves(environments, purposes, pools, enabled)
-        return Collection.render_GET(self, request)
+        if enabled:
+            if bool(row['enabled']) != (enabled.lower() not in ('0', 'false')):
+                return False
+        return True
 
 # masters
 
@@ -173,10 +280,17 @@ class MasterResource(Instance):
     update_keys = ('nickname', 'fqdn', 'pb_port', 'http_port', 'poolid',
                    'dcid', 'notes', 'enabled')
 
+    def invalidate(self, sets):
+        snapshot.masters.invalidate([int(self.id)])
+        loads.master_loads.invalidate()
+        if 'nickname' in sets:
+            # slaves include their masters' nicknames
+            snapshot.slaves.invalidate()
+
 
-class MastersResource(Collection):
+class MastersResource(SnapshotCollection):
     instance_class = MasterResource
-    query = queries.denormalized_masters
+    snapshot = snapshot.masters
 
 # TAC templates
 
@@ -250,6 +364,46 @@ class BuildbotTacRootResource(resource.Resource):
     def getChild(self, path_component, request):
         return BuildbotTacResource(path_component)
 
+
+class AllocateResource(resource.Resource):
+    "Allocate many slaves at once, priming the allocator's TACs if it's here"
+    isLeaf = True
+
+    def render_POST(self, request):
+        json = simplejson.load(request.content)
+        slave_names = [name.lower() for name in json.get('slaves', [])]
+
+        allocator = request.site.allocator
+        if allocator:
+            d = allocator.allocateMany(slave_names)
+        else:
+            d = defer.maybeDeferred(allocate.allocate_many, slave_names)
+
+        def allocated(allocations):
+            result = dict(success=True, allocated={}, failed=[])
+            for alloc in allocations:
+                result['allocated'][alloc.slavename] = dict(
+                    master=alloc.master_nickname,
+                    fqdn=alloc.master_fqdn,
+                    pb_port=alloc.master_pb_port)
+            result['failed'] = [name for name in slave_names
+                                if name not in result['allocated']]
+            return result
+
+        def failed(f):
+            log.err(f, "while allocating %d slaves" % len(slave_names))
+            request.setResponseCode(500)
+            return dict(success=False)
+        d.addCallbacks(allocated, failed)
+
+        def write(result):
+            request.setHeader('content-type', 'application/json')
+            request.setHeader('Cache-control', 'no-cache')
+            request.write(simplejson.dumps(result))
+            request.finish()
+        d.addCallback(write)
+        return server.NOT_DONE_YET
+
 # root URI
 
 
@@ -273,6 +427,7 @@ class ApiRoot(resource.Resource):
         self.addTable('pools', PoolsResource)
         self.addTable('tac_templates', TACTemplatesResource)
         self.addTable('gettac', BuildbotTacRootResource)
+        self.addTable('allocate', AllocateResource)
 
     def addTable(self, name, coll_class):
         self.tables.append(name)
@@ -1,5 +1,6 @@
-from twisted.python import log
-from twisted.internet import defer
+import time
+from twisted.python import log, threadpool
+from twisted.internet import defer, reactor, threads
 from twisted.application import service
 from slavealloc.logic import allocate, buildbottac
 from slavealloc import exceptions
@@ -7,32 +8,99 @@ from slavealloc import exceptions
 
 class AllocatorService(service.Service):
 
+    # how long a TAC made by allocateMany is kept for its slave
+    tac_cache_time = 3600
+
+    def __init__(self, max_threads=10):
+        # allocations are run in this threadpool, so that slow database
+        # queries don't hold up other requests
+        self.threadpool = threadpool.ThreadPool(
+            minthreads=1, maxthreads=max_threads, name='allocator')
+        # DeferredLocks for each silo, keyed by allocate.get_silo
+        self.silo_locks = {}
+        # TACs made by allocateMany: slave name -> (time, tac, masterid)
+        self.tacs = {}
+
     def startService(self):
         log.msg("starting AllocatorService")
         service.Service.startService(self)
-        # doesn't do anything for now..
+        self.threadpool.start()
 
     def stopService(self):
         log.msg("stopping AllocatorService")
+        self.threadpool.stop()
         return service.Service.stopService(self)
 
+    def deferToThread(self, f, *args, **kwargs):
+        return threads.deferToThreadPool(reactor, self.threadpool,
+                                         f, *args, **kwargs)
+
+    def forgetTac(self, slave_name):
+        """
+        Drop any TAC made for this slave by L{allocateMany}, e.g., because the
+        slave has been changed since, so that its next request is allocated
+        afresh.
+        """
+        self.tacs.pop(slave_name, None)
+
+    def forgetTacs(self):
+        """
+        Drop all TACs made by L{allocateMany}.
+        """
+        self.tacs.clear()
+
     def getBuildbotTac(self, slave_name):
-        # slave allocation is *synchronous* and happens in the main thread.
-        # For now, this is a good thing - it allows us to ensure that multiple
-        # slaves are not simultaneously reassigned.  This should be revisited
-        # later.
-        d = defer.succeed(None)
-
-        def gettac(_):
-            try:
-                allocation = allocate.Allocation(slave_name)
-            except exceptions.NoAllocationError:
-                log.msg("rejecting slave '%s'" % slave_name)
-                raise
-
-            tac = buildbottac.make_buildbot_tac(allocation)
-
-            allocation.commit()
+        # a TAC made by allocateMany is handed out once, to the slave's
+        # first boot after the bulk allocation, if the database still agrees
+        # with it; another process may have disabled, locked or moved the
+        # slave since
+        cached = self.tacs.pop(slave_name, None)
+        if cached and time.time() - cached[0] < self.tac_cache_time:
+            made, tac, masterid = cached
+            d = self.deferToThread(allocate.still_allocated, slave_name,
+                                   masterid)
+
+            def check(still_allocated):
+                if still_allocated:
+                    log.msg("using pre-allocated TAC for '%s'" % slave_name)
+                    return tac
+                log.msg("pre-allocated TAC for '%s' is stale" % slave_name)
+                return self._getBuildbotTac(slave_name)
+            d.addCallback(check)
+            return d
+        return self._getBuildbotTac(slave_name)
+
+    def _getBuildbotTac(self, slave_name):
+        # Slave allocation happens in a thread, but only one slave per silo is
+        # allocated at a time.  Each allocation in a silo sees the results of
+        # the previous one, so the silo's slaves are still spread evenly over
+        # its masters, and a slave is never reassigned by two requests at
+        # once.  Slaves in different silos are allocated in parallel.
+        d = self.deferToThread(allocate.get_silo, slave_name)
+
+        def lock_silo(silo):
+            lock = self.silo_locks.setdefault(silo, defer.DeferredLock())
+            d = lock.run(self.deferToThread, self._allocate, slave_name,
+                         silo)
+
+            def check_silo((allocation, tac)):
+                # the slave may have moved to another silo since get_silo;
+                # if so, nothing was committed, and it's allocated again
+                # under the lock for its new silo
+                if allocation.silo != silo:
+                    return lock_silo(allocation.silo)
+                return allocation, tac
+            d.addCallback(check_silo)
+            return d
+        d.addCallback(lock_silo)
+
+        def rejected(f):
+            f.trap(exceptions.NoAllocationError)
+            log.msg("rejecting slave '%s'" % slave_name)
+            return f
+        d.addErrback(rejected)
+
+        def allocated((allocation, tac)):
             if allocation.enabled:
                 log.msg("allocated '%s' to '%s' (%s:%s)" % (slave_name,
                                                             allocation.master_nickname,
@@ -41,7 +109,56 @@ class AllocatorService(service.Service):
             else:
                 log.msg(
                     "slave '%s' is disabled; no allocation made" % slave_name)
-
             return tac
-        d.addCallback(gettac)
+        d.addCallback(allocated)
         return d
+
+    @defer.inlineCallbacks
+    def allocateMany(self, slave_names):
+        """
+        Allocate the given slaves in a single transaction, and keep their TACs
+        for their next call to L{getBuildbotTac}.  Returns a Deferred that
+        fires with a list of the successful L{allocate.Allocation}s.
+        """
+        silos = yield self.deferToThread(allocate.get_silos, slave_names)
+
+        # hold the locks for every silo involved, taken in a consistent order
+        # so that two bulk allocations cannot deadlock
+        locks = [self.silo_locks.setdefault(silo, defer.DeferredLock())
+                 for silo in sorted(set(silos.values()))]
+        for lock in locks:
+            yield lock.acquire()
+        try:
+            results = yield self.deferToThread(self._allocateMany,
+                                               [n for n in slave_names
+                                                if n in silos])
+        finally:
+            for lock in locks:
+                lock.release()
+
+        now = time.time()
+        for allocation, tac in results:
+            self.tacs[allocation.slavename] = (now, tac, allocation.masterid)
+        # don't let TACs for slaves that never booted pile up
+        for slave_name, (made, tac, masterid) in self.tacs.items():
+            if now - made >= self.tac_cache_time:
+                del self.tacs[slave_name]
+
+        log.msg("allocated %d of %d slaves in bulk" % (len(results),
+                                                         len(slave_names)))
+        defer.returnValue([allocation for allocation, tac in results])
+
+    def _allocateMany(self, slave_names):
+        # runs in a thread
+        return [(allocation, buildbottac.make_buildbot_tac(allocation))
+                for allocation in allocate.allocate_many(slave_names)]
+
+    def _allocate(self, slave_name, silo):
+        # runs in a thread, holding the lock for silo; the allocation is only
+        # made if the slave is still in that silo
+        allocation = allocate.Allocation(slave_name)
+        if allocation.silo != silo:
+            return allocation, None
+        tac = buildbottac.make_buildbot_tac(allocation)
+        allocation.commit()
+        return allocation, tac
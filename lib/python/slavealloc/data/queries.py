@@ -56,6 +56,22 @@ denormalized_masters = sa.select([
     (model.pools.c.poolid == model.masters.c.poolid)
 ))
 
+# the columns that put slaves in the same silo; best_master balances slaves
+# within a silo
+silo_columns = [
+    model.slaves.c.poolid,
+    model.slaves.c.distroid,
+    model.slaves.c.bitsid,
+    model.slaves.c.purposeid,
+    model.slaves.c.dcid,
+    model.slaves.c.trustid,
+    model.slaves.c.envid,
+]
+
+# Use bind parameter 'slavename' to specify the slave
+slave_silo = sa.select(silo_columns,
+                       whereclause=(model.slaves.c.name == sa.bindparam('slavename')))
+
 # this is one query, but it's easier to build it in pieces.  Use bind parameter
 # 'slaveid' to specify the new slave.  There will be exactly one result row,
 # unless there are no masters for this slave.  That result row is from the
@@ -1,6 +1,39 @@
 import sqlalchemy
 from slavealloc import exceptions
 from slavealloc.data import queries, model
+from slavealloc.logic import snapshot, loads
+
+
+def get_silo(slavename):
+    """
+    Return a tuple identifying the silo of the given slave.  Allocations for
+    slaves in the same silo affect one another, while those in different silos
+    do not.
+    """
+    row = queries.slave_silo.execute(slavename=slavename).fetchone()
+    if not row:
+        raise exceptions.NoAllocationError
+    return tuple(row)
+
+
+def get_silos(slavenames):
+    """
+    Return a dictionary mapping each of the given slaves to its silo, as in
+    L{get_silo}; slaves that do not exist are left out.
+    """
+    q = sqlalchemy.select([model.slaves.c.name] + queries.silo_columns,
+                          whereclause=model.slaves.c.name.in_(slavenames))
+    return dict((row.name, tuple(row)[1:]) for row in q.execute())
+
+
+# slave info, including template
+slave_query = sqlalchemy.select(
+    [model.slaves, model.tac_templates.c.template],
+    from_obj = [
+        model.slaves.outerjoin(
+            model.tac_templates,
+            onclause=(
+                model.slaves.c.custom_tplid == model.tac_templates.c.tplid))])
 
 
 class Allocation(object):
@@ -17,48 +50,56 @@ class Allocation(object):
     @ivar slave_basedir: the slave's basedir
     @ivar slave_password: the slave's password
     @ivar masterid: the assigned masterid
+    @ivar silo: the slave's silo (see L{get_silo})
     """
 
     slavename = slaveid = enabled = master_nickname = master_fqdn = None
     master_pb_port = slave_basedir = slave_password = masterid = None
+    silo = None
 
-    def __init__(self, slavename):
+    def __init__(self, slavename, prefetched=None):
+        """
+        Allocate the named slave.  C{prefetched} is used by L{allocate_many}
+        to supply the slave's row from L{slave_query}, its password, and the
+        row for its locked master, if any, instead of querying for them.
+        """
         self.slavename = slavename
 
-        # slave info, including template
-        q = sqlalchemy.select(
-            [model.slaves, model.tac_templates.c.template],
-            whereclause=(model.slaves.c.name == slavename),
-            from_obj = [
-                model.slaves.outerjoin(
-                    model.tac_templates,
-                    onclause=(
-                        model.slaves.c.custom_tplid == model.tac_templates.c.tplid))])
-
-        slave_row = q.execute().fetchone()
+        if prefetched:
+            slave_row, slave_password, locked_master_row = prefetched
+        else:
+            q = slave_query.where(model.slaves.c.name == slavename)
+            slave_row = q.execute().fetchone()
         if not slave_row:
             raise exceptions.NoAllocationError
         self.slaveid = slave_row.slaveid
         self.enabled = slave_row.enabled
         self.slave_basedir = slave_row.basedir
+        self.silo = tuple(slave_row[c.name] for c in queries.silo_columns)
 
         # bail out early if this slave is not enabled
         if not self.enabled:
             return
 
         # slave password
-        q = queries.slave_password
-        self.slave_password = q.execute(slaveid=self.slaveid).scalar()
+        if prefetched:
+            self.slave_password = slave_password
+        else:
+            q = queries.slave_password
+            self.slave_password = q.execute(slaveid=self.slaveid).scalar()
 
         # if this slave has a locked_masterid, just get that row; otherwise, run
         # the self algorithm
         if slave_row.locked_masterid:
-            q = model.masters.select(whereclause=(
-                model.masters.c.masterid == slave_row.locked_masterid))
-            master_row = q.execute().fetchone()
+            if prefetched:
+                master_row = locked_master_row
+            else:
+                q = model.masters.select(whereclause=(
+                    model.masters.c.masterid == slave_row.locked_masterid))
+                master_row = q.execute().fetchone()
         else:
-            q = queries.best_master
-            master_row = q.execute(slaveid=self.slaveid).fetchone()
+            master_row = loads.master_loads.best_master(self.slaveid,
+                                                        self.silo)
 
         if not master_row:
             raise exceptions.NoAllocationError
@@ -79,3 +120,104 @@ class Allocation(object):
             whereclause=(model.slaves.c.slaveid == self.slaveid),
             values=dict(current_masterid=self.masterid))
         q.execute()
+        loads.master_loads.commit(self.slaveid, self.silo, self.masterid)
+        snapshot.slaves.invalidate([self.slaveid])
+
+
+def still_allocated(slavename, masterid):
+    """
+    Return true if the named slave is still enabled and attached to masterid,
+    and nothing has changed since that would give it another master: the
+    master is still enabled and in the slave's pool, and the slave is not
+    locked to some other master.  Used to check allocations made earlier,
+    e.g., by L{allocate_many}, which other processes may have overtaken.
+    """
+    q = sqlalchemy.select([model.slaves.c.enabled,
+                           model.slaves.c.locked_masterid,
+                           model.slaves.c.current_masterid,
+                           model.slaves.c.poolid,
+                           model.masters.c.enabled.label('master_enabled'),
+                           model.masters.c.poolid.label('master_poolid')],
+                          whereclause=(
+                              (model.slaves.c.name == slavename) &
+                              (model.masters.c.masterid == masterid)))
+    row = q.execute().fetchone()
+    if not row or not row.enabled or not row.master_enabled:
+        return False
+    if row.current_masterid != masterid:
+        return False
+    if row.locked_masterid:
+        return row.locked_masterid == masterid
+    return row.poolid == row.master_poolid
+
+
+def allocate_many(slavenames):
+    """
+    Allocate all of the named slaves and commit the allocations in a single
+    transaction, returning a list of L{Allocation}s.  Slaves that do not exist
+    or cannot be allocated are left out of the list.
+
+    The slaves are spread over their silos' masters in one pass, each
+    allocation seeing the ones before it, so the result is as balanced as
+    allocating the slaves one at a time.
+    """
+    conn = model.metadata.bind.connect()
+    trans = conn.begin()
+    try:
+        q = slave_query.where(model.slaves.c.name.in_(slavenames))
+        slave_rows = dict((row.name, row) for row in conn.execute(q))
+
+        # the password table is tiny, so match passwords up here; the first
+        # matching row wins, as in queries.slave_password
+        password_rows = conn.execute(model.slave_passwords.select()).fetchall()
+
+        def password(slave_row):
+            for row in password_rows:
+                if row.poolid == slave_row.poolid and \
+                   row.distroid in (None, slave_row.distroid):
+                    return row.password
+
+        locked_masterids = set(row.locked_masterid
+                               for row in slave_rows.itervalues()
+                               if row.locked_masterid)
+        locked_masters = {}
+        if locked_masterids:
+            q = model.masters.select(whereclause=(
+                model.masters.c.masterid.in_(list(locked_masterids))))
+            locked_masters = dict((row.masterid, row)
+                                  for row in conn.execute(q))
+
+        allocations = []
+        for slavename in slavenames:
+            slave_row = slave_rows.get(slavename)
+            if not slave_row:
+                continue
+            prefetched = (slave_row, password(slave_row),
+                          locked_masters.get(slave_row.locked_masterid))
+            try:
+                allocation = Allocation(slavename, prefetched=prefetched)
+            except exceptions.NoAllocationError:
+                continue
+            # count this allocation before making the next one
+            loads.master_loads.commit(allocation.slaveid, allocation.silo,
+                                      allocation.masterid)
+            allocations.append(allocation)
+
+        if allocations:
+            q = model.slaves.update(
+                whereclause=(model.slaves.c.slaveid ==
+                             sqlalchemy.bindparam('b_slaveid')),
+                values=dict(current_masterid=sqlalchemy.bindparam('b_masterid')))
+            conn.execute(q, [dict(b_slaveid=a.slaveid, b_masterid=a.masterid)
+                             for a in allocations])
+        trans.commit()
+    except:
+        trans.rollback()
+        # the load table has allocations that never made it to the database
+        loads.master_loads.invalidate()
+        raise
+    finally:
+        conn.close()
+
+    snapshot.slaves.invalidate([a.slaveid for a in allocations])
+    return allocations
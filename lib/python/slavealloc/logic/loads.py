@@ -0,0 +1,114 @@
+import time
+import threading
+import sqlalchemy as sa
+from slavealloc.data import queries, model
+
+
+class MasterLoads(object):
+    """
+
+    An in-memory table of how many slaves of each silo are attached to each
+    master, so that picking the best master for a slave is a lookup rather
+    than the self-join in L{queries.best_master}.
+
+    The table is loaded from the database on first use, and reloaded every
+    C{max_age} seconds to pick up changes made by other processes.
+    L{commit} keeps it up to date with allocations made by this process.
+    All methods are thread-safe.
+
+    Silos are tuples of the values of L{queries.silo_columns}.
+    """
+
+    max_age = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = None
+
+    def invalidate(self):
+        "Reload everything the next time it's needed"
+        self.lock.acquire()
+        try:
+            self.loaded = None
+        finally:
+            self.lock.release()
+
+    def _load(self):
+        # slaveid -> (silo, masterid)
+        slaves = {}
+        # silo -> masterid -> slavecount
+        counts = {}
+        q = sa.select([model.slaves.c.slaveid,
+                       model.slaves.c.current_masterid] + queries.silo_columns)
+        for row in q.execute():
+            silo = tuple(row[c.name] for c in queries.silo_columns)
+            slaves[row.slaveid] = (silo, row.current_masterid)
+            if row.current_masterid is not None:
+                silo_counts = counts.setdefault(silo, {})
+                silo_counts[row.current_masterid] = \
+                    silo_counts.get(row.current_masterid, 0) + 1
+
+        # poolid -> list of enabled masters, sorted by masterid
+        pool_masters = {}
+        q = model.masters.select(whereclause=model.masters.c.enabled,
+                                 order_by=[model.masters.c.masterid])
+        for row in q.execute():
+            pool_masters.setdefault(row.poolid, []).append(row)
+
+        self.slaves = slaves
+        self.counts = counts
+        self.pool_masters = pool_masters
+        self.loaded = time.time()
+
+    def _maybe_load(self):
+        if self.loaded is None or time.time() - self.loaded > self.max_age:
+            self._load()
+
+    def best_master(self, slaveid, silo):
+        """
+        Return the row from the masters table for the enabled master in the
+        slave's pool with the fewest slaves from its silo, not counting the
+        slave itself; or None if there are no such masters.  Ties go to the
+        lowest masterid, as in L{queries.best_master}.
+        """
+        self.lock.acquire()
+        try:
+            self._maybe_load()
+            silo_counts = self.counts.get(silo, {})
+            current = self.slaves.get(slaveid)
+            best = best_count = None
+            # silo[0] is the poolid
+            for master in self.pool_masters.get(silo[0], []):
+                count = silo_counts.get(master.masterid, 0)
+                if current == (silo, master.masterid):
+                    count -= 1
+                if best is None or count < best_count:
+                    best, best_count = master, count
+            return best
+        finally:
+            self.lock.release()
+
+    def commit(self, slaveid, silo, masterid):
+        """
+        Record that the slave in the given silo is now attached to masterid.
+        This may be called before the allocation is written to the database,
+        as L{allocate.allocate_many} does, so if nothing is loaded yet, the
+        table is loaded first rather than relying on the load to see it.
+        """
+        self.lock.acquire()
+        try:
+            self._maybe_load()
+            old = self.slaves.get(slaveid)
+            if old and old[1] is not None:
+                old_counts = self.counts[old[0]]
+                old_counts[old[1]] -= 1
+                if not old_counts[old[1]]:
+                    del old_counts[old[1]]
+            self.slaves[slaveid] = (silo, masterid)
+            if masterid is not None:
+                silo_counts = self.counts.setdefault(silo, {})
+                silo_counts[masterid] = silo_counts.get(masterid, 0) + 1
+        finally:
+            self.lock.release()
+
+master_loads = MasterLoads()
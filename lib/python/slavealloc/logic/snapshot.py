@@ -0,0 +1,170 @@
+import time
+import threading
+import sqlalchemy as sa
+from slavealloc.data import queries, model
+
+
+class Snapshot(object):
+    """
+
+    An in-memory, versioned copy of the rows returned by a query, so that the
+    API does not have to run an expensive join for every request.
+
+    Every change to the snapshot gets a new version number, and each row
+    remembers the version at which it last changed, so clients can ask for
+    just the rows that changed since a version they have already seen.
+    Version numbers start at the current time in milliseconds, so they keep
+    increasing across restarts.
+
+    Rows are reloaded lazily: L{invalidate} only marks rows as stale, and the
+    next call to L{refresh} reloads them.  It is safe to call L{invalidate}
+    from any thread.
+
+    @ivar query: the (denormalized) query to snapshot
+    @ivar id_column: the column of C{query} that uniquely identifies a row
+    @ivar poll_columns: columns of the underlying table that other processes
+    may change behind our back; these are checked every C{poll_interval}
+    seconds with a cheap single-table query, which also finds rows that other
+    processes have added or deleted
+    @ivar version: the current version
+    """
+
+    poll_interval = 10
+
+    def __init__(self, query, id_column, poll_columns=()):
+        self.query = query
+        self.id_column = id_column
+        self.poll_columns = poll_columns
+
+        self.version = int(time.time() * 1000)
+        # the oldest version that a delta can be computed from
+        self.base_version = self.version
+        # id -> (version, row dict)
+        self.rows = None
+        # id -> version at which the row was deleted
+        self.deleted = {}
+        self.last_poll = 0
+
+        self.lock = threading.Lock()
+        self.stale_ids = set()
+        self.stale_all = True
+
+        # serialized responses, keyed by the caller; cleared on every change
+        self.cache = {}
+
+    def invalidate(self, ids=None):
+        """Mark the rows with the given ids, or the whole snapshot if ids is
+        None, as stale"""
+        self.lock.acquire()
+        try:
+            if ids is None:
+                self.stale_all = True
+            else:
+                self.stale_ids.update(ids)
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        """Bring the snapshot up to date, returning the current version"""
+        self.lock.acquire()
+        try:
+            stale_all, self.stale_all = self.stale_all, False
+            stale_ids, self.stale_ids = self.stale_ids, set()
+        finally:
+            self.lock.release()
+
+        if stale_all or self.rows is None:
+            # a full load sees everything a poll would
+            self.last_poll = time.time()
+            self._load(self.query.execute(), full=True)
+        else:
+            if self.poll_columns and \
+                    time.time() - self.last_poll >= self.poll_interval:
+                stale_ids.update(self._poll())
+            if stale_ids:
+                q = self.query.where(self.id_column.in_(list(stale_ids)))
+                self._load(q.execute(), ids=stale_ids)
+        return self.version
+
+    def get_rows(self, since=None):
+        """
+        Return the rows that have changed since version C{since}, or all rows
+        if C{since} is None, as a list of dicts sorted by id; and a list of ids
+        that have been deleted since then.
+        """
+        if since is None:
+            return [row for id, (version, row) in sorted(self.rows.items())], []
+        rows = [row for id, (version, row) in sorted(self.rows.items())
+                if version > since]
+        deleted = [id for id, version in sorted(self.deleted.items())
+                   if version > since]
+        return rows, deleted
+
+    def _poll(self):
+        "return the ids of rows that have changed, been added or been deleted"
+        self.last_poll = time.time()
+        q = sa.select([self.id_column] + list(self.poll_columns))
+        changed = set()
+        polled_ids = set()
+        for polled in q.execute():
+            polled_ids.add(polled[0])
+            entry = self.rows.get(polled[0])
+            if not entry:
+                changed.add(polled[0])
+                continue
+            row = entry[1]
+            for col in self.poll_columns:
+                if polled[col.name] != row.get(col.name):
+                    changed.add(polled[0])
+        changed.update(set(self.rows) - polled_ids)
+        return changed
+
+    def _load(self, result, full=False, ids=()):
+        "merge the rows in result into the snapshot"
+        id_name = self.id_column.name
+        new_version = self.version + 1
+        if self.rows is None:
+            self.rows = {}
+        changed = False
+        seen = set()
+        for r in result.fetchall():
+            row = dict(r.items())
+            id = row[id_name]
+            seen.add(id)
+            old = self.rows.get(id)
+            if old and old[1] == row:
+                continue
+            self.rows[id] = (new_version, row)
+            self.deleted.pop(id, None)
+            changed = True
+
+        # anything we asked for and didn't get has been deleted
+        if full:
+            gone = set(self.rows) - seen
+        else:
+            gone = set(ids) - seen
+        for id in gone:
+            if id in self.rows:
+                del self.rows[id]
+                self.deleted[id] = new_version
+                changed = True
+
+        if changed:
+            self.version = new_version
+            self.cache = {}
+
+# the snapshots used by the API
+
+slaves = Snapshot(queries.denormalized_slaves(), model.slaves.c.slaveid,
+                  poll_columns=[model.slaves.c.current_masterid])
+# masters are few, and can be changed by other processes (dbimport, or a
+# daemon only running the UI) in any column, so poll them all
+masters = Snapshot(queries.denormalized_masters, model.masters.c.masterid,
+                   poll_columns=[c for c in model.masters.c
+                                 if c is not model.masters.c.masterid])
+
+
+def invalidate_all():
+    "Invalidate all snapshots, e.g., after a change to a lookup table"
+    slaves.invalidate()
+    masters.invalidate()
@@ -0,0 +1,44 @@
+import sys
+from twisted.internet import defer, reactor
+from slavealloc import client, exceptions
+
+
+def setup_argparse(subparsers):
+    subparser = subparsers.add_parser(
+        'allocate', help='allocate many slaves at once, e.g., before a reimage')
+    subparser.add_argument('slave', nargs='*',
+                           help="slave hostnames to allocate (no domain)")
+    subparser.add_argument('-f', '--file', dest='file',
+                           help="read slave names, one per line, from this "
+                           "file ('-' for stdin)")
+    return subparser
+
+
+def process_args(subparser, args):
+    if args.file:
+        if args.file == '-':
+            f = sys.stdin
+        else:
+            f = open(args.file)
+        args.slave.extend(line.strip() for line in f if line.strip())
+    if not args.slave:
+        subparser.error("at least one slave name is required")
+    if '.' in ''.join(args.slave):
+        subparser.error(
+            "slave name must not contain '.'; give the unqualified hostname")
+
+
+@defer.inlineCallbacks
+def main(args):
+    agent = client.RestAgent(reactor, args.apiurl)
+
+    res = yield agent.restRequest('POST', 'allocate', {'slaves': args.slave})
+    if not res.get('success'):
+        raise exceptions.CmdlineError("bulk allocation failed on server")
+
+    for slave, master in sorted(res['allocated'].items()):
+        print "%s: %s (%s:%s)" % (slave, master['master'], master['fqdn'],
+                                  master['pb_port'])
+    if res['failed']:
+        raise exceptions.CmdlineError(
+            "could not allocate: %s" % ' '.join(res['failed']))
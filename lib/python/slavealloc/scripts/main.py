@@ -5,8 +5,8 @@ from twisted.python import log
 from slavealloc import exceptions
 
 # subcommands
-from slavealloc.scripts import dbinit, gettac, lock, disable, enable, dbdump, dbimport, notes
-subcommands = [dbinit, gettac, lock, disable, enable, dbdump, dbimport, notes]
+from slavealloc.scripts import dbinit, gettac, allocate, lock, disable, enable, dbdump, dbimport, notes
+subcommands = [dbinit, gettac, allocate, lock, disable, enable, dbdump, dbimport, notes]
 
 
 def parse_options():
@@ -6,6 +6,7 @@
 # This recipe is covered under the Python license:
 # http://www.python.org/license
 
+import errno
 import httplib
 import mimetypes
 import urllib2
@@ -15,6 +16,19 @@ socket.setdefaulttimeout(None)
 import urlparse
 
 
+def split_host(host, selector):
+    """
+    Split any path given with host off and prepend it to selector.
+    Return (host, selector).
+    """
+    host = host.replace('http://', '')
+    index = host.find('/')
+    if index > 0:
+        selector = '/'.join([host[index:], selector.lstrip('/')])
+        host = host[0:index]
+    return host, selector
+
+
 def post_multipart(host, selector, fields, files):
     """
     Post fields and files to an http host as multipart/form-data.
@@ -23,11 +37,7 @@ def post_multipart(host, selector, fields, files):
     Return the server's response page.
     """
     try:
-        host = host.replace('http://', '')
-        index = host.find('/')
-        if index > 0:
-            selector = '/'.join([host[index:], selector.lstrip('/')])
-            host = host[0:index]
+        host, selector = split_host(host, selector)
         content_type, body = encode_multipart_formdata(fields, files)
         h = httplib.HTTP(host)
         h.putrequest('POST', selector)
@@ -48,6 +58,68 @@ def post_multipart(host, selector, fields, files):
         raise
 
 
+class MultipartPoster(object):
+    """
+    Post any number of multipart/form-data requests to one http host, like
+    post_multipart, but over a single keep-alive connection rather than a
+    new connection per request.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.conn = None
+
+    def post(self, selector, fields, files):
+        "Post fields and files to selector; return the server's response page"
+        host, selector = split_host(self.host, selector)
+        content_type, body = encode_multipart_formdata(fields, files)
+        headers = {'Content-Type': content_type}
+        # httplib drops the socket when the server closes the connection
+        reused = self.conn is not None and self.conn.sock is not None
+        try:
+            try:
+                return self._post(host, selector, body, headers)
+            except (httplib.BadStatusLine, error), e:
+                # the server may have dropped the idle connection since the
+                # last request; try once more on a new one.  Otherwise the
+                # server may have got the request, and retrying could submit
+                # the results twice
+                if not reused or not self._dropped(e):
+                    raise
+                self.close()
+                return self._post(host, selector, body, headers)
+        except (httplib.HTTPException, error, herror, gaierror, timeout), e:
+            self.close()
+            print "FAIL: graph server unreachable"
+            print "FAIL: " + str(e)
+            raise
+        except:
+            self.close()
+            print "FAIL: graph server unreachable"
+            raise
+
+    def _dropped(self, e):
+        "Whether e is the error from using a connection the server closed"
+        if isinstance(e, httplib.BadStatusLine):
+            return True
+        if isinstance(e, timeout):
+            return False
+        return e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+    def _post(self, host, selector, body, headers):
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(host)
+        self.conn.request('POST', selector, body, headers)
+        # the response has to be read in full before the connection can be
+        # used again
+        return self.conn.getresponse().read()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
 def encode_multipart_formdata(fields, files):
     """
     fields is a sequence of (name, value) elements for regular form fields.
@@ -10,7 +10,8 @@ import site
 # Modify our search path to find our modules
 site.addsitedir(os.path.join(os.path.dirname(__file__), "../../lib/python"))
 
-from signing.client import remote_signfile, buildValidatingOpener
+from signing.client import remote_signfiles, remote_signfiles_batch, \
+    buildValidatingOpener, get_cache
 from util.archives import packtar, unpacktar
 from util.paths import findfiles
 
@@ -58,6 +59,9 @@ def main():
         tokenfile=None,
         noncefile=None,
         cachedir=None,
+        cache_size=None,
+        concurrency=1,
+        batch=False,
     )
 
     parser.add_option(
@@ -86,7 +90,17 @@ def main():
                       help="command to re-sign nss libraries, if required")
     parser.add_option("--cachedir", dest="cachedir",
                       help="local cache directory")
-    # TODO: Concurrency?
+    parser.add_option("--cache-size", dest="cache_size", type="int",
+                      help="maximum size of the cache directory in MB; the "
+                      "least recently used files are removed first")
+    parser.add_option("-j", "--concurrency", dest="concurrency", type="int",
+                      help="how many files to sign at once")
+    parser.add_option("--batch", dest="batch", action="store_true",
+                      help="check, upload and download all files in a few "
+                      "large requests, rather than one file at a time")
+    parser.add_option("--priority", dest="priority", type="int",
+                      help="priority of our files in the server's signing "
+                      "queue; lower numbers are signed first")
     # TODO: Different certs per server?
 
     options, args = parser.parse_args()
@@ -109,6 +123,14 @@ def main():
     if not options.noncefile:
         parser.error("nonce file is required")
 
+    if options.concurrency < 1:
+        parser.error("concurrency must be at least 1")
+
+    if options.cache_size is not None:
+        if options.cache_size < 0:
+            parser.error("cache size can't be negative")
+        options.cache_size *= 1024 * 1024
+
     # Covert nsscmd to win32 path if required
     if sys.platform == 'win32' and options.nsscmd:
         nsscmd = options.nsscmd.strip()
@@ -194,6 +216,7 @@ def main():
         else:
             files = findfiles(args, options.includes, options.excludes)
 
+        jobs = []
         for f in files:
             log.debug("%s", f)
             log.debug("checking %s for signature...", f)
@@ -204,10 +227,18 @@ def main():
                 dest = os.path.join(options.output_dir, os.path.basename(f))
             else:
                 dest = None
+            jobs.append((f, dest))
 
-            if not remote_signfile(options, urls, f, fmt, token, dest):
+        if options.batch:
+            failed = remote_signfiles_batch(options, urls, jobs, fmt, token,
+                                            options.concurrency)
+        else:
+            failed = remote_signfiles(options, urls, jobs, fmt, token,
+                                      options.concurrency)
+        if failed:
+            for f in failed:
                 log.error("Failed to sign %s with %s", f, fmt)
-                sys.exit(1)
+            sys.exit(1)
 
         if fmt == "dmg":
             for fd in args:
@@ -215,6 +246,10 @@ def main():
                 unpacktar(fd + '.tar.gz', os.getcwd())
                 os.unlink(fd + '.tar.gz')
 
+    cache = get_cache(options)
+    if cache:
+        cache.cleanup()
+
 
 if __name__ == '__main__':
     main()
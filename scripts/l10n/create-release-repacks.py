@@ -6,13 +6,15 @@ from os import path
 from traceback import format_exc, print_exc
 import site
 import sys
+import threading
+import Queue
 
 site.addsitedir(path.join(path.dirname(__file__), "../../lib/python"))
 site.addsitedir(path.join(path.dirname(__file__), "../../lib/python/vendor"))
 
 from balrog.submitter.cli import ReleaseSubmitterV3
 from build.checksums import parseChecksumsFile
-from build.l10n import repackLocale, l10nRepackPrep
+from build.l10n import repackLocale, l10nRepackPrep, UpdateCache
 import build.misc
 from build.upload import postUploadCmdPrefix
 from release.download import downloadReleaseBuilds, downloadUpdateIgnore404
@@ -42,7 +44,11 @@ def createRepacks(sourceRepo, revision, l10nRepoDir, l10nBaseRepo,
                   usePymake=False, tooltoolManifest=None,
                   tooltool_script=None, tooltool_urls=None,
                   balrog_submitter=None, balrog_hash="sha512", buildid=None,
-                  mozillaDir=None, mozillaSrcDir=None):
+                  mozillaDir=None, mozillaSrcDir=None, jobs=1,
+                  cacheDir="update-cache"):
+    """Repack `locales`, up to `jobs` at a time. With more than one job,
+    previous releases' MARs are downloaded and unwrapped once into
+    `cacheDir`, and shared between locales."""
     sourceRepoName = path.split(sourceRepo)[-1]
     absObjdir = path.abspath(path.join(sourceRepoName, objdir))
     localeSrcDir = path.join(absObjdir, appName, "locales")
@@ -104,49 +110,68 @@ def createRepacks(sourceRepo, revision, l10nRepoDir, l10nBaseRepo,
                               'usePymake': usePymake})
     env.update(input_env)
 
-    failed = []
-    for l in locales:
-        try:
-            if generatePartials:
-                for oldVersion in partialUpdates:
-                    oldBuildNumber = partialUpdates[oldVersion]['buildNumber']
-                    partialUpdates[oldVersion]['mar'] = retry(
+    if jobs > 1:
+        updateCache = UpdateCache(cacheDir)
+    else:
+        updateCache = None
+    makeLock = threading.Lock()
+    balrogLock = threading.Lock()
+
+    def repack(l):
+        localePartials = partialUpdates
+        if generatePartials:
+            localePartials = {}
+            for oldVersion in partialUpdates:
+                oldBuildNumber = partialUpdates[oldVersion]['buildNumber']
+                if updateCache:
+                    mar = updateCache.downloadUpdate(
+                        stageServer, product, oldVersion, oldBuildNumber,
+                        platform, l)
+                else:
+                    mar = retry(
                         downloadUpdateIgnore404,
                         args=(stageServer, product, oldVersion, oldBuildNumber,
                               platform, l)
                     )
-            checksums_file = repackLocale(locale=l, l10nRepoDir=l10nRepoDir,
-                                          l10nBaseRepo=l10nBaseRepo, revision=revision,
-                                          localeSrcDir=localeSrcDir, l10nIni=l10nIni,
-                                          compareLocalesRepo=compareLocalesRepo, env=env,
-                                          absObjdir=absObjdir, merge=merge,
-                                          productName=product, platform=platform,
-                                          version=version, partialUpdates=partialUpdates,
-                                          buildNumber=buildNumber, stageServer=stageServer,
-                                          mozillaDir=mozillaDir, mozillaSrcDir=mozillaSrcDir)
-
-            if balrog_submitter:
-                # TODO: partials, after bug 797033 is fixed
-                checksums = parseChecksumsFile(open(checksums_file).read())
-                completeInfo = []
-                partialInfo = []
-                for f, info in checksums.iteritems():
-                    if f.endswith('.complete.mar'):
-                        completeInfo.append({
-                            "size": info["size"],
-                            "hash": info["hashes"][balrog_hash],
-                        })
-                    if f.endswith('.partial.mar'):
-                        pathInfo = fileInfo(f, product.lower())
-                        previousVersion = pathInfo["previousVersion"]
-                        partialInfo.append({
-                            "previousVersion": previousVersion,
-                            "previousBuildNumber": partialUpdates[previousVersion]['buildNumber'],
-                            "size": info["size"],
-                            "hash": info["hashes"][balrog_hash],
-                        })
-                if not completeInfo:
-                    raise Exception("Couldn't find complete mar info")
+                localePartials[oldVersion] = dict(partialUpdates[oldVersion],
+                                                  mar=mar)
+        checksums_file = repackLocale(locale=l, l10nRepoDir=l10nRepoDir,
+                                      l10nBaseRepo=l10nBaseRepo, revision=revision,
+                                      localeSrcDir=localeSrcDir, l10nIni=l10nIni,
+                                      compareLocalesRepo=compareLocalesRepo, env=env,
+                                      absObjdir=absObjdir, merge=merge,
+                                      productName=product, platform=platform,
+                                      version=version, partialUpdates=localePartials,
+                                      buildNumber=buildNumber, stageServer=stageServer,
+                                      mozillaDir=mozillaDir, mozillaSrcDir=mozillaSrcDir,
+                                      updateCache=updateCache, makeLock=makeLock)
+
+        if balrog_submitter:
+            # TODO: partials, after bug 797033 is fixed
+            checksums = parseChecksumsFile(open(checksums_file).read())
+            completeInfo = []
+            partialInfo = []
+            for f, info in checksums.iteritems():
+                if f.endswith('.complete.mar'):
+                    completeInfo.append({
+                        "size": info["size"],
+                        "hash": info["hashes"][balrog_hash],
+                    })
+                if f.endswith('.partial.mar'):
+                    pathInfo = fileInfo(f, product.lower())
+                    previousVersion = pathInfo["previousVersion"]
+                    partialInfo.append({
+                        "previousVersion": previousVersion,
+                        "previousBuildNumber": partialUpdates[previousVersion]['buildNumber'],
+                        "size": info["size"],
+                        "hash": info["hashes"][balrog_hash],
+                    })
+            if not completeInfo:
+                raise Exception("Couldn't find complete mar info")
+            # Submissions for the same release update the same blob, so
+            # don't race each other
+            balrogLock.acquire()
+            try:
                 retry(balrog_submitter.run,
                     kwargs={
                         'platform': platform,
@@ -162,9 +187,39 @@ def createRepacks(sourceRepo, revision, l10nRepoDir, l10nBaseRepo,
                         'partialInfo': partialInfo,
                     }
                 )
-        except Exception, e:
-            print_exc()
-            failed.append((l, format_exc()))
+            finally:
+                balrogLock.release()
+
+    work = Queue.Queue()
+    for l in locales:
+        work.put(l)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                l = work.get(block=False)
+            except Queue.Empty:
+                break
+            try:
+                repack(l)
+            except Exception, e:
+                print_exc()
+                failed.append((l, format_exc()))
+
+    jobs = max(1, min(jobs, len(locales)))
+    if jobs == 1:
+        worker()
+    else:
+        log.info("Repacking %i locales with %i workers", len(locales), jobs)
+        threads = []
+        for n in range(jobs):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
 
     if len(failed) > 0:
         log.error("The following tracebacks were detected during repacks:")
@@ -225,7 +280,9 @@ if __name__ == "__main__":
         chunks=None,
         thisChunk=None,
         objdir="obj-l10n",
-        source_repo_key="mozilla"
+        source_repo_key="mozilla",
+        jobs=1,
+        cache_dir="update-cache",
     )
     parser.add_option("-c", "--configfile", dest="configfile")
     parser.add_option("-r", "--release-config", dest="releaseConfig")
@@ -239,6 +296,11 @@ if __name__ == "__main__":
     parser.add_option("--this-chunk", dest="thisChunk", type="int")
     parser.add_option("--generate-partials", dest="generatePartials",
                       action='store_true', default=False)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="number of locales to repack at once")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="where to keep previous releases' MARs, and their "
+                      "unwrapped contents, when repacking in parallel")
     parser.add_option("--stage-ssh-key", dest="stage_ssh_key")
     parser.add_option("--hghost", dest="hghost")
     parser.add_option("--stage-server", dest="stage_server")
@@ -365,5 +427,7 @@ if __name__ == "__main__":
         balrog_submitter=balrog_submitter,
         buildid=options.buildid,
         mozillaDir=mozillaDir,
-        mozillaSrcDir=mozillaSrcDir
+        mozillaSrcDir=mozillaSrcDir,
+        jobs=options.jobs,
+        cacheDir=options.cache_dir,
     )